@@ -1,5 +1,8 @@
 import os
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 
 def read(fname):
     return open(os.path.join(os.path.dirname(__file__), fname)).read()
@@ -15,6 +18,8 @@ setup(
     url='http://github.com/ntoll/workflow',
     packages=[
         'workflow',
+        'workflow.management',
+        'workflow.management.commands',
         'workflow.unit_tests'
     ],
     classifiers=[
@@ -30,7 +35,11 @@ setup(
         'workflow': [
             'fixtures/*.json',
             'templates/graphviz/*.dot',
+            'templates/admin/workflow/workflowactivity/*.html',
         ]
     },
+    extras_require={
+        'analytics': ['numpy'], # required by workflow.analytics.TransitionModel
+    },
     zip_safe=False, # required to convince setuptools/easy_install to unzip the package data
 )
@@ -0,0 +1,10 @@
+def batch(size=None):
+    """
+    Shortcut to workflow.models.batch() so importers can write:
+
+        import workflow
+        with workflow.batch():
+            ...
+    """
+    from workflow.models import batch
+    return batch(size)
@@ -1,6 +1,121 @@
 # -*- coding: UTF-8 -*-
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
+from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.shortcuts import get_object_or_404, render_to_response
+from django.template import RequestContext
 from models import Role, Workflow, State, Transition, EventType, Event
+from models import WorkflowActivity, Participant, WorkflowHistory
+
+# Tables with fewer (estimated) rows than this are counted exactly
+EXACT_COUNT_BELOW = 10000
+
+# The number of WorkflowHistory records shown on each page of an activity's
+# history
+HISTORY_PER_PAGE = 25
+
+def _estimated_count(model):
+    """
+    Returns an estimate of the number of rows in the model's table without
+    scanning it (from the database's statistics where available, otherwise
+    from the largest primary key)
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    engine = settings.DATABASE_ENGINE
+    cursor = connection.cursor()
+    if engine.startswith('postgresql'):
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                [table])
+    elif engine == 'mysql':
+        cursor.execute('SELECT table_rows FROM information_schema.tables'\
+                ' WHERE table_schema = DATABASE() AND table_name = %s', [table])
+    else:
+        cursor.execute('SELECT MAX(%s) FROM %s' % (qn(model._meta.pk.column),
+            qn(table)))
+    row = cursor.fetchone()
+    return row and row[0] and int(row[0]) or 0
+
+class EstimatedCountQuerySet(QuerySet):
+    """
+    Answers count() for an unfiltered query over a large table with an
+    estimate so the admin's paginator doesn't need COUNT(*)
+    """
+    def count(self):
+        if self.query.where.children or self.query.having.children:
+            return super(EstimatedCountQuerySet, self).count()
+        estimate = _estimated_count(self.model)
+        if estimate < EXACT_COUNT_BELOW:
+            return super(EstimatedCountQuerySet, self).count()
+        return estimate
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Administration of the tables that grow with use: lists are ordered by pk,
+    paginated using estimated counts and follow the foreign keys in
+    list_select_related_fields with a join. Foreign keys are edited with
+    raw-id widgets.
+    """
+    list_select_related = True
+    list_select_related_fields = ()
+    ordering = ('-id',)
+
+    def queryset(self, request):
+        qs = self.annotate(super(LargeTableAdmin, self).queryset(request))
+        if self.list_select_related_fields:
+            qs = qs.select_related(*self.list_select_related_fields)
+        return qs._clone(klass=EstimatedCountQuerySet)
+
+    def annotate(self, qs):
+        """
+        Override to use the model's own QuerySet methods on the queryset
+        before it becomes an EstimatedCountQuerySet
+        """
+        return qs
+
+class ScopedForeignKeyAdmin(admin.ModelAdmin):
+    """
+    Limits the choices for the foreign keys named in scoped_fields to things
+    belonging to the same workflow as the object being edited (or the
+    workflow given in the query string when adding). Without a workflow a
+    raw-id widget is used rather than listing everything in the database.
+    """
+    # key = field name, val = function returning the QuerySet of choices
+    # given a workflow pk and the object being edited (or None)
+    scoped_fields = {}
+
+    def get_form(self, request, obj=None, **kwargs):
+        request.workflow_admin_object = obj
+        return super(ScopedForeignKeyAdmin, self).get_form(request, obj,
+                **kwargs)
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        if request and db_field.name in self.scoped_fields:
+            obj = getattr(request, 'workflow_admin_object', None)
+            workflow_id = obj and obj.workflow_id or request.GET.get(
+                    'workflow')
+            if workflow_id:
+                kwargs['queryset'] = self.scoped_fields[db_field.name](
+                        workflow_id, obj)
+            else:
+                kwargs['widget'] = ForeignKeyRawIdWidget(db_field.rel)
+        return super(ScopedForeignKeyAdmin, self).formfield_for_foreignkey(
+                db_field, request, **kwargs)
+
+def _workflow_states(workflow_id, obj):
+    # Versions of a workflow share states with the workflow they're based on
+    try:
+        return Workflow.objects.get(pk=workflow_id).effective_states()
+    except (Workflow.DoesNotExist, ValueError):
+        return State.objects.none()
+
+def _state_transitions(workflow_id, obj):
+    if obj is None:
+        return Transition.objects.none()
+    return Transition.objects.filter(from_state=obj)
 
 class RoleAdmin(admin.ModelAdmin):
     """
@@ -21,21 +136,24 @@ class WorkflowAdmin(admin.ModelAdmin):
     exclude = ['created_on', 'cloned_from']
     list_filter = ['status']
 
-class StateAdmin(admin.ModelAdmin):
+class StateAdmin(ScopedForeignKeyAdmin):
     """
     State administration
     """
     list_display = ['name', 'description']
     search_fields = ['name', 'description']
     save_on_top = True
+    scoped_fields = {'deadline_transition': _state_transitions}
 
-class TransitionAdmin(admin.ModelAdmin):
+class TransitionAdmin(ScopedForeignKeyAdmin):
     """
     Transition administation
     """
     list_display = ['name', 'from_state', 'to_state']
     search_fields = ['name',]
     save_on_top = True
+    scoped_fields = {'from_state': _workflow_states,
+            'to_state': _workflow_states}
 
 class EventTypeAdmin(admin.ModelAdmin):
     """
@@ -45,7 +163,7 @@ class EventTypeAdmin(admin.ModelAdmin):
     save_on_top = True
     search_fields = ['name', 'description']
 
-class EventAdmin(admin.ModelAdmin):
+class EventAdmin(ScopedForeignKeyAdmin):
     """
     Event administration
     """
@@ -53,6 +171,91 @@ class EventAdmin(admin.ModelAdmin):
     save_on_top = True
     search_fields = ['name', 'description']
     list_filter = ['event_types', 'is_mandatory']
+    scoped_fields = {'state': _workflow_states}
+
+class WorkflowActivityAdmin(LargeTableAdmin):
+    """
+    WorkflowActivity administration. The change form shows the history of the
+    activity a page at a time.
+    """
+    list_display = ['id', 'workflow', 'created_by', 'created_on',
+            'current_state', 'completed_on']
+    list_select_related_fields = ('workflow', 'created_by')
+    raw_id_fields = ['workflow', 'created_by']
+    change_form_template = 'admin/workflow/workflowactivity/change_form.html'
+
+    def annotate(self, qs):
+        return qs.annotate_current_state()
+
+    def current_state(self, obj):
+        return obj.current_state_name
+    current_state.short_description = 'Current state'
+
+    def get_urls(self):
+        from django.conf.urls.defaults import patterns, url
+        return patterns('',
+            url(r'^(.+)/workflow-history/$',
+                self.admin_site.admin_view(self.workflow_history_view),
+                name='workflow_workflowactivity_workflow_history'),
+            ) + super(WorkflowActivityAdmin, self).get_urls()
+
+    def _history_page(self, request, activity):
+        paginator = Paginator(activity.history.with_history_related(
+            ).order_by('-created_on', '-id'), HISTORY_PER_PAGE)
+        try:
+            return paginator.page(int(request.GET.get('page', 1)))
+        except (ValueError, InvalidPage, EmptyPage):
+            return paginator.page(1)
+
+    def change_view(self, request, object_id, extra_context=None):
+        context = extra_context or {}
+        try:
+            activity = WorkflowActivity.objects.get(pk=object_id)
+        except (WorkflowActivity.DoesNotExist, ValueError):
+            activity = None
+        if activity:
+            context['history_page'] = self._history_page(request, activity)
+            context['history_url'] = request.path + 'workflow-history/'
+        return super(WorkflowActivityAdmin, self).change_view(request,
+                object_id, context)
+
+    def workflow_history_view(self, request, object_id):
+        activity = get_object_or_404(WorkflowActivity, pk=object_id)
+        return render_to_response(
+                'admin/workflow/workflowactivity/workflow_history.html',
+                {
+                    'title': activity,
+                    'opts': self.model._meta,
+                    'activity': activity,
+                    'history_page': self._history_page(request, activity),
+                    'history_url': request.path,
+                },
+                context_instance=RequestContext(request))
+
+class ParticipantAdmin(LargeTableAdmin):
+    """
+    Participant administration
+    """
+    list_display = ['id', 'user', 'workflowactivity', 'disabled']
+    list_select_related_fields = ('user', 'workflowactivity__workflow')
+    raw_id_fields = ['user', 'workflowactivity']
+
+class WorkflowHistoryAdmin(LargeTableAdmin):
+    """
+    WorkflowHistory administration
+    """
+    list_display = ['id', 'workflowactivity', 'log_type', 'state', 'note',
+            'participant_user', 'created_on']
+    list_filter = ['log_type']
+    list_select_related_fields = ('workflowactivity__workflow', 'state',
+            'participant__user')
+    raw_id_fields = ['workflowactivity', 'state', 'transition', 'event',
+            'participant']
+
+    def participant_user(self, obj):
+        # Participant.__unicode__() would look up the roles for every row
+        return obj.participant.user
+    participant_user.short_description = 'Participant'
 
 admin.site.register(Role, RoleAdmin)
 admin.site.register(Workflow, WorkflowAdmin)
@@ -60,3 +263,6 @@ admin.site.register(State, StateAdmin)
 admin.site.register(Transition, TransitionAdmin)
 admin.site.register(EventType, EventTypeAdmin)
 admin.site.register(Event, EventAdmin)
+admin.site.register(WorkflowActivity, WorkflowActivityAdmin)
+admin.site.register(Participant, ParticipantAdmin)
+admin.site.register(WorkflowHistory, WorkflowHistoryAdmin)
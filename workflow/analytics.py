@@ -0,0 +1,346 @@
+# -*- coding: UTF-8 -*-
+"""
+Compact, column oriented copies of the WorkflowHistory for analysis and a
+Markov model of the transitions taken by the activities of a workflow.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+# python
+import array
+import calendar
+
+# NumPy is needed for the TransitionModel
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# project
+from workflow.models import WorkflowActivity, WorkflowHistory
+
+# The number of activities whose history is read from the database at a time
+CHUNK_SIZE = 500
+
+# The array typecodes of the columns. Activity ids are machine longs whereas
+# the definition and participant ids are unsigned ints. Missing ids are 0. The
+# timestamps are seconds since the epoch (created_on taken as UTC). That's 33
+# bytes a row on 64 bit platforms.
+COLUMNS = (
+        ('activity', 'l'),
+        ('log_type', 'b'),
+        ('state', 'I'),
+        ('transition', 'I'),
+        ('event', 'I'),
+        ('participant', 'I'),
+        ('timestamp', 'd'),
+    )
+
+def _epoch(dt):
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1000000.0
+
+class HistoryColumns(object):
+    """
+    Holds WorkflowHistory records as parallel arrays (one for each of the
+    names in COLUMNS) ordered by activity and then by pk. Use load_history()
+    to create instances.
+    """
+
+    def __init__(self):
+        for name, typecode in COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.activity)
+
+    def nbytes(self):
+        """
+        Returns the number of bytes used by the values in the columns
+        """
+        return sum([len(getattr(self, name)) * getattr(self, name).itemsize
+            for name, typecode in COLUMNS])
+
+    def append(self, activity, log_type, state, transition, event,
+            participant, created_on):
+        self.activity.append(activity)
+        self.log_type.append(log_type)
+        self.state.append(state or 0)
+        self.transition.append(transition or 0)
+        self.event.append(event or 0)
+        self.participant.append(participant or 0)
+        self.timestamp.append(_epoch(created_on))
+
+    def row(self, i):
+        """
+        Returns a tuple of the values of the i'th row (in the order of
+        COLUMNS)
+        """
+        return tuple([getattr(self, name)[i] for name, typecode in COLUMNS])
+
+    def groups(self):
+        """
+        Yields an (activity pk, start, stop) tuple for each activity where
+        start and stop are the bounds of its rows (which are in the order
+        they were written)
+        """
+        activity = self.activity
+        start = 0
+        for i in xrange(1, len(activity)):
+            if activity[i] != activity[start]:
+                yield activity[start], start, i
+                start = i
+        if activity:
+            yield activity[start], start, len(activity)
+
+# The fields of the WorkflowHistory read by iter_history() (in the order of
+# COLUMNS)
+HISTORY_FIELDS = ('workflowactivity', 'log_type', 'state', 'transition',
+        'event', 'participant', 'created_on')
+
+def iter_history(activities=None, fields=HISTORY_FIELDS,
+        chunk_size=CHUNK_SIZE):
+    """
+    Yields a tuple of the referenced fields of each WorkflowHistory record of
+    the referenced WorkflowActivity QuerySet (or of every activity) ordered
+    by activity and then by pk. The history is read with values_list() for a
+    range of activities at a time, so no model instances are made, the query
+    for each range uses the workflowactivity index and only one range is held
+    in memory.
+    """
+    if activities is None:
+        activities = WorkflowActivity.objects.all()
+    last = 0
+    while True:
+        ids = list(activities.filter(id__gt=last).order_by('id').values_list(
+            'id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        history = WorkflowHistory.objects.filter(
+                workflowactivity__gte=ids[0], workflowactivity__lte=ids[-1])
+        if len(ids) < ids[-1] - ids[0] + 1:
+            # The range includes activities that aren't wanted
+            history = history.filter(workflowactivity__in=ids)
+        # Ordered by the column itself (ordering by workflowactivity would
+        # join and use the activity's ordering)
+        table = WorkflowHistory._meta.db_table
+        history = history.extra(order_by=['%s.workflowactivity_id' % table,
+            '%s.id' % table])
+        for row in history.values_list(*fields).iterator():
+            yield row
+        last = ids[-1]
+
+def load_history(activities=None, chunk_size=CHUNK_SIZE):
+    """
+    Returns a HistoryColumns holding the history of the referenced
+    WorkflowActivity QuerySet (or of every activity) as read by
+    iter_history()
+    """
+    columns = HistoryColumns()
+    for row in iter_history(activities, chunk_size=chunk_size):
+        columns.append(*row)
+    return columns
+
+class TransitionModel(object):
+    """
+    A Markov chain estimated from the transitions taken by the activities of
+    a workflow (so each state's next state depends only on how often each
+    transition out of it has been taken). Requires NumPy.
+
+    Counts are added with update() (new WorkflowHistory records since the
+    last update) or add_columns() (a HistoryColumns) so the model can be kept
+    up to date incrementally. End states, states that have never been left
+    and the states of loops that have never been left are absorbing.
+    """
+
+    def __init__(self, workflow):
+        if numpy is None:
+            raise ImportError('NumPy is required for the TransitionModel')
+        self.workflow = workflow
+        graph = workflow.get_graph()
+        # The states and transitions in the order used by the matrices
+        self.states = sorted(graph.states.keys())
+        self.transitions = sorted(graph.transitions.keys())
+        self.start_state = None
+        for pk in self.states:
+            if graph.states[pk].is_start_state:
+                self.start_state = pk
+        self.end_states = set([pk for pk in self.states if
+            graph.states[pk].is_end_state])
+        self._index = dict([(pk, i) for i, pk in enumerate(self.states)])
+        self._from = numpy.array([self._index[graph.transitions[
+            pk].from_state.id] for pk in self.transitions], dtype=numpy.intp)
+        self._to = numpy.array([self._index[graph.transitions[
+            pk].to_state.id] for pk in self.transitions], dtype=numpy.intp)
+        # The (sorted) Transition pks, to find the position of a pk in
+        # self.transitions with searchsorted()
+        self._transition_ids = numpy.array(self.transitions, dtype=numpy.int64)
+        # The number of times each transition has been taken
+        self.transition_counts = numpy.zeros(len(self.transitions),
+                dtype=numpy.int64)
+        # The pk of the latest WorkflowHistory record counted by update()
+        self.last_history_id = 0
+
+    def add(self, transition_ids):
+        """
+        Counts the referenced transitions (a sequence or array of Transition
+        pks, each of which represents the transition being taken once).
+        Transitions that aren't part of the workflow are ignored.
+        """
+        ids = numpy.asarray(transition_ids, dtype=numpy.int64)
+        positions = numpy.searchsorted(self._transition_ids, ids)
+        # Positions past the end or holding another pk aren't part of the
+        # workflow
+        found = positions < len(self._transition_ids)
+        positions = positions[found]
+        positions = positions[self._transition_ids[positions] == ids[found]]
+        self.transition_counts += numpy.bincount(positions,
+                minlength=len(self.transitions))
+
+    def add_columns(self, columns):
+        """
+        Counts the transitions recorded in the referenced HistoryColumns
+        (which should hold the history of activities of this workflow)
+        """
+        log_type = numpy.frombuffer(columns.log_type, dtype=numpy.int8)
+        transition = numpy.frombuffer(columns.transition, dtype=numpy.uint32)
+        self.add(transition[log_type == WorkflowHistory.TRANSITION])
+
+    def update(self, chunk_size=10000):
+        """
+        Counts the transitions recorded in the WorkflowHistory since the last
+        update and returns the number of them
+        """
+        history = WorkflowHistory.objects.filter(
+                workflowactivity__workflow=self.workflow,
+                log_type=WorkflowHistory.TRANSITION,
+                transition__isnull=False)
+        added = 0
+        while True:
+            rows = list(history.filter(id__gt=self.last_history_id).order_by(
+                'id').values_list('id', 'transition')[:chunk_size])
+            if not rows:
+                return added
+            rows = numpy.array(rows, dtype=numpy.int64)
+            self.add(rows[:, 1])
+            self.last_history_id = int(rows[-1, 0])
+            added += len(rows)
+
+    def counts(self):
+        """
+        Returns a matrix of the number of moves from each state (row) to each
+        state (column) in the order of self.states
+        """
+        result = numpy.zeros((len(self.states), len(self.states)),
+                dtype=numpy.int64)
+        numpy.add.at(result, (self._from, self._to), self.transition_counts)
+        return result
+
+    def probabilities(self):
+        """
+        Returns the matrix of the probability of moving from each state (row)
+        to each state (column). Rows of states never left are all zero.
+        """
+        counts = self.counts().astype(float)
+        totals = counts.sum(axis=1)
+        totals[totals == 0] = 1
+        return counts / totals[:, numpy.newaxis]
+
+    def transition_probabilities(self):
+        """
+        Returns a dictionary (keyed by Transition pk) of the probability of
+        each transition being the one taken out of its state
+        """
+        totals = numpy.bincount(self._from, weights=self.transition_counts,
+                minlength=len(self.states))[self._from]
+        totals[totals == 0] = 1
+        return dict(zip(self.transitions, (self.transition_counts /
+            totals).tolist()))
+
+    def _fundamental(self, rhs):
+        """
+        Returns the transient and absorbing states (as lists of indexes) and
+        the solution X of (I - Q)X = rhs(Q, R) where Q and R are the
+        probabilities of moving between transient states and from transient
+        to absorbing states
+        """
+        P = self.probabilities()
+        # reach[i, j] is True if state j can be reached from state i. A state
+        # that can get back from everywhere it can reach (e.g. one that's
+        # never been left or a loop that's never been left) never reaches an
+        # end state so is absorbing too. Otherwise I - Q would be singular.
+        reach = P > 0
+        for i, pk in enumerate(self.states):
+            if pk in self.end_states:
+                reach[i] = False
+        for k in range(len(self.states)):
+            reach |= reach[:, k:k + 1] & reach[k:k + 1, :]
+        closed = (~reach | reach.T).all(axis=1)
+        transient = [i for i, pk in enumerate(self.states) if pk not in
+                self.end_states and not closed[i]]
+        absorbing = [i for i in range(len(self.states)) if i not in
+                transient]
+        Q = P[numpy.ix_(transient, transient)]
+        R = P[numpy.ix_(transient, absorbing)]
+        X = numpy.linalg.solve(numpy.eye(len(transient)) - Q, rhs(Q, R))
+        return transient, absorbing, X
+
+    def expected_visits(self, state=None):
+        """
+        Returns a dictionary (keyed by State pk) of the expected number of
+        visits to each non-absorbing state made by an activity in the
+        referenced state (or pk, defaulting to the start state) before it
+        reaches an absorbing state
+        """
+        state = getattr(state, 'pk', state) or self.start_state
+        transient, absorbing, N = self._fundamental(lambda Q, R:
+                numpy.eye(len(Q)))
+        if self._index[state] not in transient:
+            return {}
+        row = N[transient.index(self._index[state])]
+        return dict([(self.states[i], float(row[j])) for j, i in
+            enumerate(transient)])
+
+    def absorption_probabilities(self, state=None):
+        """
+        Returns a dictionary (keyed by State pk) of the probability of an
+        activity in the referenced state (or pk, defaulting to the start
+        state) ending up in each of the absorbing states
+        """
+        state = getattr(state, 'pk', state) or self.start_state
+        transient, absorbing, B = self._fundamental(lambda Q, R: R)
+        if self._index[state] not in transient:
+            return dict([(self.states[i], float(i == self._index[state]))
+                for i in absorbing])
+        row = B[transient.index(self._index[state])]
+        return dict([(self.states[i], float(row[j])) for j, i in
+            enumerate(absorbing)])
@@ -0,0 +1,308 @@
+# -*- coding: UTF-8 -*-
+"""
+Conformance checking: replays the WorkflowHistory of activities against the
+definition of their workflow to find the moves the engine should never have
+allowed.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+# python
+from itertools import groupby
+
+# django
+from django.db import connection
+
+# project
+from workflow.models import State, Participant, WorkflowActivity,\
+        WorkflowHistory, DeadlineEscalation, RoleChange
+from workflow.graph import load_graphs
+
+# The sorts of violation found
+NOT_STARTED = 'not_started'
+ILLEGAL_START = 'illegal_start'
+ILLEGAL_MOVE = 'illegal_move'
+UNKNOWN_TRANSITION = 'unknown_transition'
+MOVE_AFTER_END = 'move_after_end'
+STATE_MISMATCH = 'state_mismatch'
+MISSING_MANDATORY_EVENT = 'missing_mandatory_event'
+ROLE_VIOLATION = 'role_violation'
+
+class Replay(object):
+    """
+    Replays the history of a single activity against the WorkflowGraph of its
+    workflow. Call record() with each WorkflowHistory row (as a tuple of id,
+    log_type, state, transition, event and participant pks and created_on) in
+    the order they were written and the violations found are appended to
+    self.violations.
+
+    Roles are checked against those held when each row was written. They're
+    worked back from the roles held now (roles) and the activity's
+    RoleChanges (role_changes). Roles given without the engine (so without a
+    RoleChange) are taken to have been held all along.
+
+    Transitions made without checking the participant's authority (those
+    with a guard and the deadline transition of a state whose deadline was
+    escalated) aren't checked for mandatory events or roles.
+    """
+
+    def __init__(self, activity_id, graph, roles, escalated=(),
+            deadline_transitions={}, role_changes=()):
+        self.activity_id = activity_id
+        self.graph = graph
+        # key = participant pk, val = set of role pks
+        self.roles = roles
+        # (created_on, participant pk, role pk, action) tuples in the order
+        # the changes were made
+        self.role_changes = role_changes
+        self.applied = 0
+        # The roles held by the participants whose roles have changed
+        self.held = self._rewind()
+        # pks of the WorkflowHistory records whose deadline was escalated
+        self.escalated = escalated
+        # key = state pk, val = pk of its deadline transition
+        self.deadline_transitions = deadline_transitions
+        self.current = None
+        self.entered_by = None
+        self.ended = False
+        self.events = set()
+        self.violations = []
+
+    def flag(self, history_id, kind, message):
+        self.violations.append({
+                'activity': self.activity_id,
+                'history': history_id,
+                'kind': kind,
+                'message': message,
+            })
+
+    def record(self, history_id, log_type, state_id, transition_id, event_id,
+            participant_id, created_on=None):
+        self._apply_role_changes(created_on)
+        if log_type == WorkflowHistory.EVENT and event_id:
+            self.events.add(event_id)
+        if log_type != WorkflowHistory.TRANSITION:
+            if state_id != self.current:
+                self.flag(history_id, STATE_MISMATCH, 'Recorded in state %s'\
+                        ' when the activity was in state %s' % (state_id,
+                            self.current))
+            return
+        if not transition_id:
+            self._record_start_or_stop(history_id, state_id)
+            return
+        transition = self.graph.transitions.get(transition_id)
+        if transition is None:
+            self.flag(history_id, UNKNOWN_TRANSITION, 'Transition %s is not'\
+                    ' part of the workflow' % transition_id)
+            self._move(history_id, state_id)
+            return
+        if self.current is None:
+            self.flag(history_id, NOT_STARTED, 'Transition %s made before'\
+                    ' the activity was started' % transition_id)
+        elif self.ended:
+            self.flag(history_id, MOVE_AFTER_END, 'Transition %s made after'\
+                    ' the activity ended' % transition_id)
+        elif transition.from_state.id != self.current:
+            self.flag(history_id, ILLEGAL_MOVE, 'Transition %s is not from'\
+                    ' state %s' % (transition_id, self.current))
+        elif not self._unchecked(transition):
+            from_state = transition.from_state
+            for event in self.graph.events.values():
+                if event.is_mandatory and event.state is from_state and \
+                        event.id not in self.events:
+                    self.flag(history_id, MISSING_MANDATORY_EVENT,
+                            'Transition %s made before mandatory event %s' %
+                            (transition_id, event.id))
+            if not self._roles_of(participant_id) & transition.roles:
+                self.flag(history_id, ROLE_VIOLATION, 'Participant %s has'\
+                        ' none of the roles needed for transition %s' % (
+                            participant_id, transition_id))
+        if state_id != transition.to_state.id:
+            self.flag(history_id, STATE_MISMATCH, 'Transition %s recorded'\
+                    ' as moving to state %s' % (transition_id, state_id))
+        self._move(history_id, state_id)
+
+    def _rewind(self):
+        """
+        Returns a dictionary (keyed by participant pk) of the sets of role
+        pks held before the first of the role changes
+        """
+        held = {}
+        seen = set()
+        for created_on, participant_id, role_id, action in self.role_changes:
+            if participant_id not in held:
+                held[participant_id] = set(self.roles.get(participant_id, ()))
+            if (participant_id, role_id) in seen:
+                continue
+            seen.add((participant_id, role_id))
+            if action == RoleChange.ASSIGNED:
+                held[participant_id].discard(role_id)
+            else:
+                held[participant_id].add(role_id)
+        return held
+
+    def _apply_role_changes(self, created_on):
+        """
+        Applies the role changes made on or before created_on (or all of them
+        if it's None)
+        """
+        while self.applied < len(self.role_changes):
+            changed_on, participant_id, role_id, action = self.role_changes[
+                    self.applied]
+            if created_on is not None and changed_on > created_on:
+                break
+            if action == RoleChange.ASSIGNED:
+                self.held[participant_id].add(role_id)
+            else:
+                self.held[participant_id].discard(role_id)
+            self.applied += 1
+
+    def _roles_of(self, participant_id):
+        if participant_id in self.held:
+            return self.held[participant_id]
+        return self.roles.get(participant_id, set())
+
+    def _unchecked(self, transition):
+        return bool(transition.guard) or (self.entered_by in self.escalated
+                and self.deadline_transitions.get(self.current) ==
+                transition.id)
+
+    def _record_start_or_stop(self, history_id, state_id):
+        if self.current is None:
+            node = self.graph.states.get(state_id)
+            if node is None or not node.is_start_state:
+                self.flag(history_id, ILLEGAL_START, 'Started in state %s' %
+                        state_id)
+        elif state_id == self.current:
+            # Stopped with force_stop()
+            self.ended = True
+            return
+        elif self.ended:
+            self.flag(history_id, MOVE_AFTER_END, 'Moved to state %s after'\
+                    ' the activity ended' % state_id)
+        else:
+            self.flag(history_id, ILLEGAL_MOVE, 'Moved from state %s to %s'\
+                    ' without a transition' % (self.current, state_id))
+        self._move(history_id, state_id)
+
+    def _move(self, history_id, state_id):
+        self.current = state_id
+        self.entered_by = history_id
+        node = self.graph.states.get(state_id)
+        if node is not None and node.is_end_state:
+            self.ended = True
+
+def _participant_roles(first, last):
+    """
+    Returns a dictionary (keyed by Participant pk) of the sets of role pks of
+    the participants in the activities with pks in the range
+    """
+    qn = connection.ops.quote_name
+    field = Participant._meta.get_field('roles')
+    cursor = connection.cursor()
+    cursor.execute('SELECT m.%s, m.%s FROM %s m INNER JOIN %s p ON m.%s ='\
+            ' p.%s WHERE p.%s BETWEEN %%s AND %%s' % (
+                qn(field.m2m_column_name()),
+                qn(field.m2m_reverse_name()),
+                qn(field.m2m_db_table()),
+                qn(Participant._meta.db_table),
+                qn(field.m2m_column_name()),
+                qn('id'),
+                qn('workflowactivity_id'),
+            ), [first, last])
+    roles = {}
+    for participant_id, role_id in cursor.fetchall():
+        roles.setdefault(participant_id, set()).add(role_id)
+    return roles
+
+def _role_changes(first, last):
+    """
+    Returns a dictionary (keyed by WorkflowActivity pk) of lists of the
+    (created_on, participant pk, role pk, action) tuples of the changes to
+    roles in the activities with pks in the range, in the order they were made
+    """
+    changes = {}
+    for activity_id, created_on, participant_id, role_id, action in \
+            RoleChange.objects.filter(workflowactivity__gte=first,
+                    workflowactivity__lte=last, role__isnull=False).order_by(
+                        'workflowactivity', 'id').values_list(
+                            'workflowactivity', 'created_on', 'participant',
+                            'role', 'action'):
+        changes.setdefault(activity_id, []).append((created_on,
+            participant_id, role_id, action))
+    return changes
+
+def check_activities(first, last):
+    """
+    Returns a list of the violations (dictionaries with the activity and
+    history pks, the kind of violation and a message) found in the history of
+    the activities with pks between first and last (inclusive). The history
+    is streamed an activity at a time with a fixed number of queries.
+    """
+    workflows = dict(WorkflowActivity.objects.filter(id__gte=first,
+        id__lte=last).values_list('id', 'workflow'))
+    if not workflows:
+        return []
+    graphs = load_graphs(set(workflows.values()))
+    # Versions of a workflow share states so they're found by pk
+    state_ids = set()
+    for graph in graphs.values():
+        state_ids.update(graph.states.keys())
+    state_ids = list(state_ids)
+    deadline_transitions = {}
+    for i in range(0, len(state_ids), 500):
+        deadline_transitions.update(State.objects.filter(
+            pk__in=state_ids[i:i + 500],
+            deadline_action=State.DEADLINE_TRANSITION).values_list('id',
+                'deadline_transition'))
+    escalated = set(DeadlineEscalation.objects.filter(
+        workflowhistory__workflowactivity__gte=first,
+        workflowhistory__workflowactivity__lte=last).values_list(
+            'workflowhistory', flat=True))
+    roles = _participant_roles(first, last)
+    role_changes = _role_changes(first, last)
+    table = WorkflowHistory._meta.db_table
+    history = WorkflowHistory.objects.filter(workflowactivity__gte=first,
+            workflowactivity__lte=last).extra(order_by=[
+                '%s.workflowactivity_id' % table, '%s.id' % table]
+                ).values_list('workflowactivity', 'id', 'log_type', 'state',
+                    'transition', 'event', 'participant', 'created_on')
+    violations = []
+    for activity_id, rows in groupby(history.iterator(), lambda r: r[0]):
+        replay = Replay(activity_id, graphs[workflows[activity_id]], roles,
+                escalated, deadline_transitions, role_changes.get(activity_id,
+                    ()))
+        for row in rows:
+            replay.record(*row[1:])
+        violations.extend(replay.violations)
+    return violations
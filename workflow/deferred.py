@@ -0,0 +1,235 @@
+# -*- coding: UTF-8 -*-
+"""
+Non-blocking access to the workflow engine: calls are run on a pool of worker
+threads and a DeferredResult is returned straight away.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+from django.conf import settings
+from django.db import connection
+from workflow.routers import unpin
+from multiprocessing.pool import ThreadPool
+import collections
+import sys
+import threading
+
+class DeferredResult(object):
+    """
+    The eventual outcome of a call made through an executor. get() blocks
+    until the call has finished and then returns its result or raises the
+    exception it raised (so the behaviour is identical to calling the engine
+    directly)
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._value = None
+        self._exc_info = None
+
+    def ready(self):
+        return self._done.isSet()
+
+    def successful(self):
+        if not self.ready():
+            raise ValueError('%r not ready' % self)
+        return self._exc_info is None
+
+    def get(self, timeout=None):
+        self._done.wait(timeout)
+        if not self.ready():
+            raise RuntimeError('Timed out waiting for the result')
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def add_callback(self, callback):
+        """
+        Calls callback(result) once the call has finished (immediately if it
+        already has). Callbacks are run in the worker thread so should hand
+        the result back to the caller's event loop rather than doing any work
+        """
+        self._lock.acquire()
+        try:
+            if not self.ready():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+
+    def _set(self, value=None, exc_info=None):
+        self._lock.acquire()
+        try:
+            self._value = value
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+    def _run(self, func, args, kwargs):
+        try:
+            value = func(*args, **kwargs)
+        except:
+            self._set(exc_info=sys.exc_info())
+        else:
+            self._set(value)
+
+class ThreadedExecutor(object):
+    """
+    Runs calls on a pool of threads. Calls submitted with the same key (the
+    engine uses the WorkflowActivity) are run one at a time in the order they
+    were submitted so an astart() followed by an aprogress() behave as they
+    would if called directly.
+    """
+    def __init__(self, threads=None):
+        self.threads = threads or getattr(settings, 'WORKFLOW_THREADS', 4)
+        self._pool = None
+        self._lock = threading.Lock()
+        # key = submission key, val = queue of calls waiting to be run
+        self._queues = {}
+
+    def submit(self, key, func, *args, **kwargs):
+        result = DeferredResult()
+        self._lock.acquire()
+        try:
+            queue = self._queues.get(key)
+            if queue is not None:
+                # A worker is already draining this key
+                queue.append((result, func, args, kwargs))
+                return result
+            self._queues[key] = collections.deque([(result, func, args,
+                kwargs)])
+            if not self._pool:
+                self._pool = ThreadPool(self.threads)
+        finally:
+            self._lock.release()
+        self._pool.apply_async(self._drain, (key,))
+        return result
+
+    def close(self):
+        """
+        Waits for the submitted calls to finish and stops the threads
+        """
+        self._lock.acquire()
+        try:
+            pool, self._pool = self._pool, None
+        finally:
+            self._lock.release()
+        if pool:
+            pool.close()
+            pool.join()
+
+    def _drain(self, key):
+        try:
+            while True:
+                self._lock.acquire()
+                try:
+                    queue = self._queues[key]
+                    if not queue:
+                        del self._queues[key]
+                        return
+                    result, func, args, kwargs = queue.popleft()
+                finally:
+                    self._lock.release()
+                result._run(func, args, kwargs)
+        finally:
+            # Each thread has its own connection, don't leave it open
+            connection.close()
+            unpin()
+
+class InlineExecutor(object):
+    """
+    Runs calls straight away in the calling thread. Useful for tests and
+    management commands.
+    """
+    def submit(self, key, func, *args, **kwargs):
+        result = DeferredResult()
+        result._run(func, args, kwargs)
+        return result
+
+    def close(self):
+        pass
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """
+    Returns the executor used by the non-blocking engine methods (a
+    ThreadedExecutor unless set_executor() has been called)
+    """
+    global _executor
+    _executor_lock.acquire()
+    try:
+        if _executor is None:
+            _executor = ThreadedExecutor()
+        return _executor
+    finally:
+        _executor_lock.release()
+
+def set_executor(executor):
+    """
+    Replaces the executor used by the non-blocking engine methods and returns
+    the previous one (which is not closed)
+    """
+    global _executor
+    _executor_lock.acquire()
+    try:
+        previous, _executor = _executor, executor
+        return previous
+    finally:
+        _executor_lock.release()
+
+def deferred(method_name):
+    """
+    Returns a method that calls the named WorkflowActivity method through the
+    executor and returns a DeferredResult. The call is made on a copy of the
+    activity loaded by the worker so the caller's instance (and its session
+    and cached lookups) is never touched by another thread.
+    """
+    def method(self, *args, **kwargs):
+        model, pk = type(self), self.pk
+        def call():
+            activity = model._default_manager.get(pk=pk)
+            return getattr(activity, method_name)(*args, **kwargs)
+        return get_executor().submit(('workflowactivity', pk), call)
+    method.__name__ = 'a' + method_name
+    method.__doc__ = """
+        Non-blocking version of %s(): returns a DeferredResult straight away
+        """ % method_name
+    return method
@@ -0,0 +1,260 @@
+# -*- coding: UTF-8 -*-
+"""
+Rendering of workflow diagrams with graphviz. Diagrams of active and retired
+workflows are rendered ahead of time and kept in storage. Diagrams of the
+progress of an activity are cached until the activity moves on.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template import Context, loader
+from workflow.deferred import get_executor
+from workflow.graph import load_graph
+from workflow.models import WorkflowHistory
+import subprocess
+
+# key = format, val = mimetype
+FORMATS = {
+        'dot': 'text/plain',
+        'png': 'image/png',
+        'svg': 'image/svg+xml',
+    }
+
+# Where the rendered diagrams are kept
+storage = default_storage
+
+class DotError(Exception):
+    """
+    Raised when graphviz's dot command fails or produces nothing
+    """
+
+def get_dotfile(workflow):
+    """
+    Given a workflow will return the appropriate contents of a .dot file for 
+    processing by graphviz
+    """
+    c = Context({
+            'workflow': workflow,
+            'states': workflow.effective_states(),
+            'transitions': workflow.effective_transitions(),
+        })
+    t = loader.get_template('graphviz/workflow.dot')
+    return t.render(c)
+
+def run_dot(dot, format):
+    """
+    Returns the output of graphviz's dot command for the contents of a .dot
+    file in the referenced format. Raises DotError if dot fails or has no
+    output.
+
+    The following constant should be defined in settings.py:
+
+    GRAPHVIZ_DOT_COMMAND - absolute path to graphviz's dot command used to
+    generate the image
+    """
+    if not hasattr(settings, 'GRAPHVIZ_DOT_COMMAND'):
+        # At least provide a helpful exception message
+        raise Exception("GRAPHVIZ_DOT_COMMAND constant not set in settings.py"\
+                " (to specify the absolute path to graphviz's dot command)")
+    # Lots of "pipe" work to avoid hitting the file-system
+    proc = subprocess.Popen('%s -T%s' % (settings.GRAPHVIZ_DOT_COMMAND, format),
+                shell=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                )
+    output, errors = proc.communicate(dot.encode('utf_8'))
+    if proc.returncode:
+        raise DotError('dot exited with status %s: %s' % (proc.returncode,
+            errors.strip()))
+    if not output:
+        raise DotError('dot produced no %s output' % format)
+    return output
+
+def diagram_name(workflow_id, fingerprint, format):
+    """
+    Returns the name the diagram is stored under. The fingerprint means a
+    changed definition never gets a stale diagram.
+    """
+    return 'workflow/diagrams/%s/%s.%s' % (workflow_id, fingerprint, format)
+
+def _save(name, content):
+    if storage.exists(name):
+        storage.delete(name)
+    storage.save(name, ContentFile(content))
+
+def store_diagrams(workflow_id, fingerprint, dot, force=True):
+    """
+    Renders the contents of the .dot file in each format and stores the
+    results. Existing diagrams are kept unless force is True. Doesn't touch
+    the database so can be run in another thread or process. A DotError is
+    raised (and nothing stored for that format) if dot fails.
+    """
+    for format in FORMATS:
+        name = diagram_name(workflow_id, fingerprint, format)
+        if not force and storage.exists(name):
+            continue
+        if format == 'dot':
+            _save(name, dot.encode('utf_8'))
+        else:
+            _save(name, run_dot(dot, format))
+
+def queue_prerender(workflow, force=True):
+    """
+    Queues the rendering of the workflow's diagrams (see store_diagrams())
+    with the executor in workflow.deferred and returns the DeferredResult.
+    Does nothing (returning None) if graphviz isn't configured.
+    """
+    if not hasattr(settings, 'GRAPHVIZ_DOT_COMMAND'):
+        return None
+    # The .dot file is generated here so the rendering needn't use the
+    # database (or see an uncommitted transaction)
+    return get_executor().submit(('diagrams', workflow.pk), store_diagrams,
+            workflow.pk, workflow.get_fingerprint(), get_dotfile(workflow),
+            force)
+
+def get_diagram(workflow, format):
+    """
+    Returns the workflow's diagram in the referenced format. Diagrams of
+    workflows in definition are rendered each time, otherwise the stored
+    diagram is used (rendering and storing it if it isn't there yet).
+    """
+    if workflow.status == workflow.DEFINITION:
+        dot = get_dotfile(workflow)
+        if format == 'dot':
+            return dot.encode('utf_8')
+        return run_dot(dot, format)
+    name = diagram_name(workflow.pk, workflow.get_fingerprint(), format)
+    if not storage.exists(name):
+        store_diagrams(workflow.pk, workflow.get_fingerprint(),
+                get_dotfile(workflow), force=False)
+    f = storage.open(name)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+# The colours used to draw an activity's path through the workflow
+CURRENT_COLOUR = 'blue'
+VISITED_COLOUR = 'darkgreen'
+
+# The widest an edge taken by an activity will be drawn
+MAX_PENWIDTH = 8
+
+def _latest_history_id(activity):
+    latest = WorkflowHistory.objects.filter(workflowactivity=activity
+            ).order_by('-id').values_list('id', flat=True)[:1]
+    return latest and latest[0] or 0
+
+def _activity_cache_key(activity, latest_id, format):
+    fingerprint = activity.workflow.fingerprint or \
+            activity.workflow.get_fingerprint()
+    return 'workflow.diagrams.%s.%d.%d.%s' % (fingerprint, activity.pk,
+            latest_id, format)
+
+def get_activity_dotfile(activity, latest_id=None):
+    """
+    Returns the contents of a .dot file for processing by graphviz that shows
+    the activity's workflow with the current state highlighted and the
+    transitions taken drawn heavier the more often they were taken.
+
+    The activity's path is built from a single query of its history (up to
+    and including the record with the referenced id).
+    """
+    if latest_id is None:
+        latest_id = _latest_history_id(activity)
+    graph = load_graph(activity.workflow_id)
+    visited = set()
+    taken = {}
+    current = None
+    for state_id, transition_id in WorkflowHistory.objects.filter(
+            workflowactivity=activity, id__lte=latest_id).order_by('id'
+            ).values_list('state', 'transition'):
+        if state_id:
+            visited.add(state_id)
+            current = state_id
+        if transition_id:
+            taken[transition_id] = taken.get(transition_id, 0) + 1
+    states = []
+    for state in sorted(graph.states.values(), key=lambda s: s.id):
+        if state.id == current:
+            colour, style = CURRENT_COLOUR, 'filled'
+        elif state.id in visited:
+            colour, style = VISITED_COLOUR, 'solid'
+        else:
+            colour, style = 'black', 'solid'
+        states.append({'node': 'state%d' % state.id, 'state': state,
+            'colour': colour, 'style': style})
+    transitions = []
+    for transition in sorted(graph.transitions.values(), key=lambda t: t.id):
+        count = taken.get(transition.id, 0)
+        transitions.append({
+            'from_node': 'state%d' % transition.from_state.id,
+            'to_node': 'state%d' % transition.to_state.id,
+            'transition': transition, 'count': count,
+            'colour': count and VISITED_COLOUR or 'black',
+            'penwidth': min(1 + count, MAX_PENWIDTH)})
+    c = Context({
+            'workflow': activity.workflow,
+            'activity': activity,
+            'states': states,
+            'transitions': transitions,
+        })
+    t = loader.get_template('graphviz/activity.dot')
+    return t.render(c)
+
+def get_activity_diagram(activity, format):
+    """
+    Returns the activity's diagram (see get_activity_dotfile()) in the
+    referenced format. Diagrams are cached until the activity's history
+    changes so only the latest history id is looked up for repeat views.
+    """
+    latest_id = _latest_history_id(activity)
+    key = _activity_cache_key(activity, latest_id, format)
+    diagram = cache.get(key)
+    if diagram is None:
+        dot_key = _activity_cache_key(activity, latest_id, 'dot')
+        dot = cache.get(dot_key)
+        if dot is None:
+            dot = get_activity_dotfile(activity, latest_id).encode('utf_8')
+            cache.set(dot_key, dot)
+        if format == 'dot':
+            diagram = dot
+        else:
+            diagram = run_dot(dot.decode('utf_8'), format)
+            cache.set(key, diagram)
+    return diagram
@@ -0,0 +1,314 @@
+# -*- coding: UTF-8 -*-
+"""
+Structural differences between workflow definitions. 
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+# Django
+from django.template import Context, loader
+
+# Workflow
+from workflow.graph import load_graphs
+
+# Colours used to highlight changes in the dot rendering
+COLOURS = {
+        'added': 'green',
+        'removed': 'red',
+        'modified': 'orange',
+        None: 'black',
+    }
+
+def _role_names(graph, thing):
+    return sorted([graph.roles[r] for r in thing.roles])
+
+def _state_name(state):
+    if state is None:
+        return None
+    return state.name
+
+# Functions returning the keys used to match things in the old graph with those
+# in the new graph. Each is tried in turn on the things that are still
+# unmatched. The states are matched by name first and then structure so states
+# that share a name are paired up sensibly (see _match_states() for renamed
+# states).
+STATE_KEYS = (
+        lambda g, s: (s.name, s.is_start_state, s.is_end_state,
+            tuple(_role_names(g, s))),
+        lambda g, s: s.name,
+    )
+
+def _transition_keys(pairs):
+    """
+    Transitions are matched through the pairs of matched states they connect
+    (see _pairs()) so renaming a state doesn't unmatch its transitions
+    """
+    return (
+            lambda g, t: (t.name, pairs.get(t.from_state, t.from_state),
+                pairs.get(t.to_state, t.to_state)),
+            lambda g, t: (pairs.get(t.from_state, t.from_state),
+                pairs.get(t.to_state, t.to_state)),
+        )
+
+def _event_keys(pairs):
+    return (
+            lambda g, e: (e.name, pairs.get(e.state, e.state)),
+            lambda g, e: e.name,
+        )
+
+def _match(old_graph, old_items, new_graph, new_items, keys):
+    """
+    Pairs up items from the old and new graphs using the key functions. Returns
+    a list of (old, new) tuples along with lists of the old and new items that
+    couldn't be matched.
+    """
+    matched = []
+    old_items = sorted(old_items, key=lambda x: x.id)
+    new_items = sorted(new_items, key=lambda x: x.id)
+    for key in keys:
+        candidates = {}
+        for item in old_items:
+            candidates.setdefault(key(old_graph, item), []).append(item)
+        unmatched = []
+        for item in new_items:
+            found = candidates.get(key(new_graph, item))
+            if found:
+                matched.append((found.pop(0), item))
+            else:
+                unmatched.append(item)
+        new_items = unmatched
+        old_items = [item for items in candidates.values() for item in items]
+        old_items.sort(key=lambda x: x.id)
+    return matched, old_items, new_items
+
+def _pairs(matched):
+    """
+    Returns a dictionary (keyed by the Node instances of both graphs) of the
+    index of each matched pair of states
+    """
+    pairs = {}
+    for i, (old, new) in enumerate(matched):
+        pairs[old] = i
+        pairs[new] = i
+    return pairs
+
+def _match_states(old_graph, new_graph):
+    """
+    Pairs up the states of the old and new graphs (see _match()). States still
+    unmatched by STATE_KEYS (e.g. renamed states) are then matched by the
+    transitions connecting them to the states already matched.
+    """
+    matched, removed, added = _match(old_graph, old_graph.states.values(),
+            new_graph, new_graph.states.values(), STATE_KEYS)
+    pairs = _pairs(matched)
+    def connections(g, s):
+        key = [('into', t.name, pairs.get(t.from_state)) for t in
+                s.transitions_into] + [('from', t.name, pairs.get(t.to_state))
+                        for t in s.transitions_from]
+        if not [c for c in key if c[2] is not None]:
+            # Nothing to go on so it can't be matched
+            return s
+        return (s.is_start_state, s.is_end_state, tuple(sorted(key)))
+    renamed, removed, added = _match(old_graph, removed, new_graph, added,
+            (connections,))
+    return matched + renamed, removed, added
+
+def _changes(old_graph, old, new_graph, new, fields, pairs):
+    """
+    Returns a dictionary describing the changes between the matched items
+    """
+    changes = {}
+    for field in fields:
+        a = getattr(old, field)
+        b = getattr(new, field)
+        if field in ('from_state', 'to_state', 'state'):
+            # Only a move to a different state is a change
+            if pairs.get(a, a) == pairs.get(b, b):
+                continue
+            a = _state_name(a)
+            b = _state_name(b)
+        if a != b:
+            changes[field] = [a, b]
+    old_roles = set(_role_names(old_graph, old))
+    new_roles = set(_role_names(new_graph, new))
+    if old_roles != new_roles:
+        changes['roles'] = {
+                'added': sorted(new_roles - old_roles),
+                'removed': sorted(old_roles - new_roles),
+            }
+    return changes
+
+def _section(old_graph, new_graph, match, fields, pairs, describe):
+    """
+    Describes the items matched, removed and added (as returned by _match())
+    """
+    matched, removed, added = match
+    result = {'added': [], 'removed': [], 'modified': []}
+    for item in added:
+        result['added'].append(describe(new_graph, item))
+    for item in removed:
+        result['removed'].append(describe(old_graph, item))
+    for old, new in matched:
+        changes = _changes(old_graph, old, new_graph, new, fields, pairs)
+        if changes:
+            entry = describe(new_graph, new)
+            entry['old_id'] = old.id
+            entry['changes'] = changes
+            result['modified'].append(entry)
+    for entries in result.values():
+        entries.sort(key=lambda x: x['id'])
+    return result
+
+def _describe_state(graph, state):
+    return {
+            'id': state.id,
+            'name': state.name,
+            'is_start_state': state.is_start_state,
+            'is_end_state': state.is_end_state,
+            'estimation_value': state.estimation_value,
+            'estimation_unit': state.estimation_unit,
+            'roles': _role_names(graph, state),
+        }
+
+def _describe_transition(graph, transition):
+    return {
+            'id': transition.id,
+            'name': transition.name,
+            'from_state': transition.from_state.name,
+            'to_state': transition.to_state.name,
+            'roles': _role_names(graph, transition),
+        }
+
+def _describe_event(graph, event):
+    return {
+            'id': event.id,
+            'name': event.name,
+            'state': _state_name(event.state),
+            'is_mandatory': event.is_mandatory,
+            'roles': _role_names(graph, event),
+        }
+
+def diff_graphs(old_graph, new_graph):
+    """
+    Compares two WorkflowGraph instances and returns a dictionary (suitable
+    for serializing as JSON) describing the states, transitions and events
+    that have been added, removed or modified in the new graph.
+
+    States are matched by name (falling back to the transitions connecting
+    them to matched states for renamed states), transitions by name and the
+    matched states they connect (falling back to the states they connect for
+    renamed transitions) and events by name and their matched state. Each
+    entry contains the id of the item in the graph it belongs to (the old
+    graph for removed items). Modified entries also contain the old id and
+    the changes as [old, new] values (or lists of the role names added and
+    removed).
+    """
+    states = _match_states(old_graph, new_graph)
+    pairs = _pairs(states[0])
+    transitions = _match(old_graph, old_graph.transitions.values(),
+            new_graph, new_graph.transitions.values(),
+            _transition_keys(pairs))
+    events = _match(old_graph, old_graph.events.values(), new_graph,
+            new_graph.events.values(), _event_keys(pairs))
+    return {
+            'states': _section(old_graph, new_graph, states, ('name',
+                'is_start_state', 'is_end_state', 'estimation_value',
+                'estimation_unit'), pairs, _describe_state),
+            'transitions': _section(old_graph, new_graph, transitions,
+                ('name', 'from_state', 'to_state', 'guard'), pairs,
+                _describe_transition),
+            'events': _section(old_graph, new_graph, events, ('name',
+                'state', 'is_mandatory'), pairs, _describe_event),
+        }
+
+def diff_workflows(old_workflow, new_workflow):
+    """
+    Returns the differences (see diff_graphs()) between the two workflows.
+    Both definitions are loaded with a fixed number of queries.
+    """
+    graphs = load_graphs([old_workflow.id, new_workflow.id])
+    return diff_graphs(graphs[old_workflow.id], graphs[new_workflow.id])
+
+def get_diff_dotfile(old_workflow, new_workflow, diff=None):
+    """
+    Returns the contents of a .dot file for processing by graphviz that shows
+    the new workflow with the differences from the old workflow highlighted
+    (added in green, modified in orange and removed in red)
+    """
+    graphs = load_graphs([old_workflow.id, new_workflow.id])
+    old_graph = graphs[old_workflow.id]
+    new_graph = graphs[new_workflow.id]
+    if diff is None:
+        diff = diff_graphs(old_graph, new_graph)
+    changed = {}
+    for section in ('states', 'transitions'):
+        for change in ('added', 'modified'):
+            for entry in diff[section][change]:
+                changed[(section, entry['id'])] = change
+    states = []
+    for state in sorted(new_graph.states.values(), key=lambda s: s.id):
+        change = changed.get(('states', state.id))
+        states.append({'node': 'state%d' % state.id, 'state': state,
+            'colour': COLOURS[change], 'style': 'solid'})
+    for entry in diff['states']['removed']:
+        state = old_graph.states[entry['id']]
+        states.append({'node': 'removed%d' % state.id, 'state': state,
+            'colour': COLOURS['removed'], 'style': 'dashed'})
+    nodes = dict([(s['state'], s['node']) for s in states])
+    # Removed transitions are drawn between the new states that match the old
+    # states they connected
+    matched, removed, added = _match_states(old_graph, new_graph)
+    for old, new in matched:
+        nodes[old] = nodes[new]
+    transitions = []
+    for transition in sorted(new_graph.transitions.values(),
+            key=lambda t: t.id):
+        change = changed.get(('transitions', transition.id))
+        transitions.append({'from_node': nodes[transition.from_state],
+            'to_node': nodes[transition.to_state], 'transition': transition,
+            'colour': COLOURS[change], 'style': 'solid'})
+    for entry in diff['transitions']['removed']:
+        transition = old_graph.transitions[entry['id']]
+        transitions.append({
+            'from_node': nodes[transition.from_state],
+            'to_node': nodes[transition.to_state],
+            'transition': transition, 'colour': COLOURS['removed'],
+            'style': 'dashed'})
+    c = Context({
+            'workflow': new_workflow,
+            'source': old_workflow,
+            'states': states,
+            'transitions': transitions,
+        })
+    t = loader.get_template('graphviz/diff.dot')
+    return t.render(c)
@@ -0,0 +1,264 @@
+# -*- coding: UTF-8 -*-
+"""
+Discovery of the flow activities actually take through a workflow from the
+WorkflowHistory, for comparison with the flow that was designed.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+# python
+import random
+
+# django
+from django.template import Context, loader
+
+# project
+from workflow.models import State, Transition, Event, WorkflowActivity,\
+        WorkflowHistory
+from workflow.analytics import iter_history, CHUNK_SIZE
+
+# The number of durations kept for each edge to estimate its median
+SAMPLE_SIZE = 101
+
+# The colour of the states, events and moves that aren't part of the design
+UNDESIGNED_COLOUR = 'red'
+
+# The widest the most frequent edge will be drawn
+MAX_PENWIDTH = 8
+
+# The fields of the WorkflowHistory needed to discover the flow
+DISCOVERY_FIELDS = ('workflowactivity', 'log_type', 'state', 'transition',
+        'event', 'created_on')
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+def format_duration(seconds):
+    """
+    Returns a short description of the duration (e.g. "2d 3h" or "5m 10s")
+    using its two most significant units
+    """
+    seconds = int(round(seconds or 0))
+    parts = []
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        if seconds >= size or (unit == 's' and not parts):
+            parts.append('%d%s' % (seconds // size, unit))
+            seconds %= size
+    return ' '.join(parts[:2])
+
+class ObservedEdge(object):
+    """
+    A move observed in the history from one node (a state or an event) to
+    the next with the number of times it was made. The durations of the moves
+    are reservoir sampled so the median can be estimated from a sample of a
+    fixed size however often the move was made.
+    """
+
+    def __init__(self, from_node, to_node, transition_id, sample_size, rng):
+        self.from_node = from_node
+        self.to_node = to_node
+        # The pk of the Transition taken (or None)
+        self.transition_id = transition_id
+        self.count = 0
+        self.sample = []
+        self._sample_size = sample_size
+        self._rng = rng
+
+    def add(self, seconds):
+        self.count += 1
+        if len(self.sample) < self._sample_size:
+            self.sample.append(seconds)
+        else:
+            # Each duration seen so far has the same chance of being sampled
+            i = self._rng.randint(0, self.count - 1)
+            if i < self._sample_size:
+                self.sample[i] = seconds
+
+    def median(self):
+        """
+        Returns the median duration (in seconds) of the sampled moves
+        """
+        if not self.sample:
+            return None
+        ordered = sorted(self.sample)
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+class DirectlyFollowsGraph(object):
+    """
+    The flow the activities of a workflow actually took: which state or event
+    directly followed which (and by which transition), how often and how long
+    it took. Comments and role changes are ignored.
+
+    Built by passing each activity's history (in order) to add() and then
+    calling finish(). Only the previous record of the current activity is
+    kept, so memory depends on the size of the graph rather than the amount
+    of history. Use discover() to build one from the database.
+    """
+
+    def __init__(self, workflow, sample_size=SAMPLE_SIZE, seed=None):
+        self.workflow = workflow
+        self.sample_size = sample_size
+        self._rng = random.Random(seed)
+        # key = node ("state<pk>" or "event<pk>"), val = times it was reached
+        self.nodes = {}
+        # key = node, val = the number of activities that started there
+        self.starts = {}
+        # key = node, val = the number of activities last seen there
+        self.ends = {}
+        # key = (from node, to node, Transition pk or None), val = ObservedEdge
+        self.edges = {}
+        self.activities = 0
+        self._activity = None
+        # The node and created_on of the activity's previous record
+        self._last = None
+
+    def add(self, activity_id, log_type, state_id, transition_id, event_id,
+            created_on):
+        """
+        Adds a WorkflowHistory record. The records of each activity must be
+        added together and in the order they were written.
+        """
+        if log_type == WorkflowHistory.TRANSITION and state_id:
+            node = 'state%d' % state_id
+        elif log_type == WorkflowHistory.EVENT and event_id:
+            node = 'event%d' % event_id
+        else:
+            return
+        if activity_id != self._activity:
+            self.finish()
+            self._activity = activity_id
+            self.activities += 1
+            self.starts[node] = self.starts.get(node, 0) + 1
+        else:
+            from_node, then = self._last
+            key = (from_node, node, transition_id)
+            edge = self.edges.get(key)
+            if edge is None:
+                edge = self.edges[key] = ObservedEdge(from_node, node,
+                        transition_id, self.sample_size, self._rng)
+            edge.add(_seconds(created_on - then))
+        self.nodes[node] = self.nodes.get(node, 0) + 1
+        self._last = (node, created_on)
+
+    def finish(self):
+        """
+        Ends the current activity (call once all the history has been added)
+        """
+        if self._last:
+            node = self._last[0]
+            self.ends[node] = self.ends.get(node, 0) + 1
+        self._activity = None
+        self._last = None
+
+    def _ids(self, prefix):
+        return [int(node[len(prefix):]) for node in self.nodes if
+                node.startswith(prefix)]
+
+def discover(workflow, chunk_size=CHUNK_SIZE, sample_size=SAMPLE_SIZE,
+        seed=None):
+    """
+    Returns the DirectlyFollowsGraph of the activities of the referenced
+    workflow built in a single pass over their history (see
+    workflow.analytics.iter_history())
+    """
+    graph = DirectlyFollowsGraph(workflow, sample_size, seed)
+    for row in iter_history(WorkflowActivity.objects.filter(
+            workflow=workflow), DISCOVERY_FIELDS, chunk_size):
+        graph.add(*row)
+    graph.finish()
+    return graph
+
+def get_discovered_dotfile(graph):
+    """
+    Returns the contents of a .dot file for processing by graphviz that shows
+    the DirectlyFollowsGraph with each edge labelled with the transition
+    taken, the number of times it was taken and the median time it took.
+    States use the same template (and names) as the diagram of the workflow
+    so the two can be compared side by side. States, events and moves that
+    aren't part of the workflow's design are drawn in red.
+    """
+    design = graph.workflow.get_graph()
+    states = State.objects.in_bulk(graph._ids('state'))
+    events = Event.objects.in_bulk(graph._ids('event'))
+    transitions = Transition.objects.in_bulk(list(set([key[2] for key in
+        graph.edges if key[2]])))
+    designed_events = set(design.events.keys())
+    designed_nodes = set(['state%d' % pk for pk in states if pk in
+        design.states] + ['event%d' % pk for pk, event in events.items() if
+            pk in designed_events or event.workflow_id is None])
+
+    def colour(designed):
+        return designed and 'black' or UNDESIGNED_COLOUR
+
+    state_nodes = [{'state': states[pk], 'count': graph.nodes['state%d' % pk],
+        'colour': colour('state%d' % pk in designed_nodes)} for pk in
+        sorted(states)]
+    event_nodes = [{'node': 'event%d' % pk, 'event': events[pk],
+        'count': graph.nodes['event%d' % pk],
+        'colour': colour('event%d' % pk in designed_nodes)} for pk in
+        sorted(events)]
+    most = max([0] + [edge.count for edge in graph.edges.values()])
+    edges = []
+    for key in sorted(graph.edges):
+        edge = graph.edges[key]
+        designed = edge.to_node in designed_nodes
+        if edge.to_node.startswith('state'):
+            # Moves into a state must be by one of the designed transitions
+            # into it (and out of the previous state unless an event was
+            # logged in between)
+            t = design.transitions.get(edge.transition_id)
+            designed = designed and t is not None and \
+                    edge.to_node == 'state%d' % t.to_state.id and \
+                    (edge.from_node.startswith('event') or
+                            edge.from_node == 'state%d' % t.from_state.id)
+        edges.append({
+            'from_node': edge.from_node,
+            'to_node': edge.to_node,
+            'transition': transitions.get(edge.transition_id),
+            'count': edge.count,
+            'median': format_duration(edge.median()),
+            'colour': colour(designed),
+            'penwidth': 1 + (MAX_PENWIDTH - 1) * edge.count // most,
+        })
+    c = Context({
+            'workflow': graph.workflow,
+            'graph': graph,
+            'states': state_nodes,
+            'events': event_nodes,
+            'edges': edges,
+        })
+    t = loader.get_template('graphviz/discovered.dot')
+    return t.render(c)
@@ -0,0 +1,469 @@
+# -*- coding: UTF-8 -*-
+"""
+In-memory (compiled) representations of workflow definitions. 
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+# python
+import threading
+
+# Django
+from django.db import connection
+from django.utils import simplejson
+from django.utils.hashcompat import sha_constructor
+from django.utils.translation import ugettext as __
+
+# Workflow models
+from workflow.models import Workflow, Role, State, Transition, Event
+from workflow.guards import compile_guard, InvalidGuard
+
+class Node(object):
+    """
+    A state in a WorkflowGraph
+    """
+    def __init__(self, id, name, is_start_state, is_end_state,
+            estimation_value, estimation_unit):
+        self.id = id
+        self.name = name
+        self.is_start_state = is_start_state
+        self.is_end_state = is_end_state
+        self.estimation_value = estimation_value
+        self.estimation_unit = estimation_unit
+        # The pk of the transition made when the deadline passes (or None)
+        self.deadline_transition = None
+        # Role pks
+        self.roles = set()
+        # Edge instances
+        self.transitions_from = []
+        self.transitions_into = []
+
+class Edge(object):
+    """
+    A transition in a WorkflowGraph
+    """
+    def __init__(self, id, name, from_state, to_state, guard=''):
+        self.id = id
+        self.name = name
+        # Node instances
+        self.from_state = from_state
+        self.to_state = to_state
+        self.guard = guard
+        # Role pks
+        self.roles = set()
+
+class EventSpec(object):
+    """
+    An event associated with a WorkflowGraph
+    """
+    def __init__(self, id, name, state, is_mandatory):
+        self.id = id
+        self.name = name
+        # Node instance (or None)
+        self.state = state
+        self.is_mandatory = is_mandatory
+        # Role pks
+        self.roles = set()
+
+class WorkflowGraph(object):
+    """
+    A plain (picklable) copy of the directed graph defined by a workflow.
+    Use load_graphs() to create instances.
+    """
+    def __init__(self, workflow_id):
+        self.workflow_id = workflow_id
+        # key = pk, val = Node / Edge / EventSpec
+        self.states = {}
+        self.transitions = {}
+        self.events = {}
+        # key = pk, val = name of the roles referenced by the graph
+        self.roles = {}
+
+    def __getstate__(self):
+        # Flattened so that pickling large graphs doesn't recurse from node to
+        # node (e.g. when sent to another process)
+        states = [(s.id, s.name, s.is_start_state, s.is_end_state,
+            s.estimation_value, s.estimation_unit, s.roles,
+            s.deadline_transition) for s in self.states.values()]
+        transitions = [(t.id, t.name, t.from_state.id, t.to_state.id,
+            t.roles, t.guard) for t in self.transitions.values()]
+        events = [(e.id, e.name, e.state and e.state.id, e.is_mandatory,
+            e.roles) for e in self.events.values()]
+        return self.workflow_id, states, transitions, events, self.roles
+
+    def __setstate__(self, data):
+        workflow_id, states, transitions, events, roles = data
+        self.__init__(workflow_id)
+        for s in states:
+            node = Node(*s[:6])
+            node.roles = s[6]
+            node.deadline_transition = s[7]
+            self.add_state(node)
+        for t in transitions:
+            edge = Edge(t[0], t[1], self.states[t[2]], self.states[t[3]],
+                    t[5])
+            edge.roles = t[4]
+            self.add_transition(edge)
+        for e in events:
+            event = EventSpec(e[0], e[1], e[2] and self.states[e[2]], e[3])
+            event.roles = e[4]
+            self.events[event.id] = event
+        self.roles = roles
+
+    def add_state(self, node):
+        self.states[node.id] = node
+
+    def add_transition(self, edge):
+        edge.from_state.transitions_from.append(edge)
+        edge.to_state.transitions_into.append(edge)
+        self.transitions[edge.id] = edge
+
+def _m2m_pairs(model, field_name, workflow_ids):
+    """
+    Returns a list of (instance pk, related pk) tuples for the referenced
+    many-to-many field of all the instances of the model associated with the
+    workflows
+    """
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(field_name)
+    sql = 'SELECT m.%s, m.%s FROM %s m INNER JOIN %s t ON m.%s = t.%s'\
+            ' WHERE t.%s IN (%s)' % (
+                qn(field.m2m_column_name()),
+                qn(field.m2m_reverse_name()),
+                qn(field.m2m_db_table()),
+                qn(model._meta.db_table),
+                qn(field.m2m_column_name()),
+                qn(model._meta.pk.column),
+                qn(model._meta.get_field('workflow').column),
+                ', '.join(['%s'] * len(workflow_ids))
+            )
+    cursor = connection.cursor()
+    cursor.execute(sql, workflow_ids)
+    return cursor.fetchall()
+
+def _lineages(workflow_ids):
+    """
+    Returns a dictionary (keyed by workflow pk) of the lineage (see
+    Workflow.lineage()) of each of the referenced workflows. Uses a query for
+    each generation of versions.
+    """
+    bases = {}
+    todo = set(workflow_ids)
+    while todo:
+        found = dict(Workflow.objects.filter(pk__in=list(todo)).values_list(
+            'id', 'base'))
+        bases.update(found)
+        todo = set([b for b in found.values() if b and b not in bases])
+    lineages = {}
+    for pk in workflow_ids:
+        lineage = [pk]
+        while bases.get(lineage[-1]):
+            lineage.append(bases[lineage[-1]])
+        lineages[pk] = lineage
+    return lineages
+
+def _hidden(field_name, workflow_ids):
+    """
+    Returns a dictionary (keyed by workflow pk) of the sets of pks of the
+    rows the referenced versions hide (see Workflow.hidden_states etc)
+    """
+    result = dict([(pk, set()) for pk in workflow_ids])
+    if not workflow_ids:
+        return result
+    qn = connection.ops.quote_name
+    field = Workflow._meta.get_field(field_name)
+    cursor = connection.cursor()
+    cursor.execute('SELECT m.%s, m.%s FROM %s m WHERE m.%s IN (%s)' % (
+            qn(field.m2m_column_name()),
+            qn(field.m2m_reverse_name()),
+            qn(field.m2m_db_table()),
+            qn(field.m2m_column_name()),
+            ', '.join(['%s'] * len(workflow_ids)),
+        ), workflow_ids)
+    for pk, hidden_pk in cursor.fetchall():
+        result[pk].add(hidden_pk)
+    return result
+
+def load_graphs(workflow_ids):
+    """
+    Returns a dictionary of WorkflowGraph instances (keyed by workflow pk) for
+    the referenced workflows. The number of queries is the same however many
+    workflows (or states and transitions) there are (apart from a query for
+    each generation of versions).
+
+    The graph of a version (see Workflow.new_version()) is resolved from the
+    rows it shares with the workflows in its lineage and the rows it stores.
+    """
+    workflow_ids = list(workflow_ids)
+    graphs = dict([(pk, WorkflowGraph(pk)) for pk in workflow_ids])
+    if not workflow_ids:
+        return graphs
+    # key = pk of the workflow the rows belong to, val = pks of the graphs
+    # they are part of (unless hidden)
+    used_by = {}
+    lineages = _lineages(workflow_ids)
+    for pk, lineage in lineages.items():
+        for owner in lineage:
+            used_by.setdefault(owner, []).append(pk)
+    owner_ids = used_by.keys()
+    versions = [pk for pk in workflow_ids if len(lineages[pk]) > 1]
+    hidden_states = _hidden('hidden_states', versions)
+    hidden_transitions = _hidden('hidden_transitions', versions)
+    hidden_events = _hidden('hidden_events', versions)
+    def graphs_using(owner, pk, hidden):
+        return [graphs[g] for g in used_by[owner] if pk not in
+                hidden.get(g, ())]
+    # key = pk, val = list of the Node / Edge / EventSpec instances (one for
+    # each graph the row is part of)
+    states = {}
+    for s in State.objects.filter(workflow__in=owner_ids).values('id',
+            'workflow', 'name', 'is_start_state', 'is_end_state',
+            'estimation_value', 'estimation_unit', 'deadline_transition'
+            ).order_by('id'):
+        for graph in graphs_using(s['workflow'], s['id'], hidden_states):
+            node = Node(s['id'], s['name'], s['is_start_state'],
+                    s['is_end_state'], s['estimation_value'],
+                    s['estimation_unit'])
+            node.deadline_transition = s['deadline_transition']
+            graph.add_state(node)
+            states.setdefault(node.id, []).append(node)
+    transitions = {}
+    for t in Transition.objects.filter(workflow__in=owner_ids).values('id',
+            'workflow', 'name', 'from_state', 'to_state', 'guard').order_by(
+                'id'):
+        for graph in graphs_using(t['workflow'], t['id'],
+                hidden_transitions):
+            edge = Edge(t['id'], t['name'], graph.states[t['from_state']],
+                    graph.states[t['to_state']], t['guard'])
+            graph.add_transition(edge)
+            transitions.setdefault(edge.id, []).append(edge)
+    for state_id, role_id in _m2m_pairs(State, 'roles', owner_ids):
+        for node in states.get(state_id, ()):
+            node.roles.add(role_id)
+    for transition_id, role_id in _m2m_pairs(Transition, 'roles',
+            owner_ids):
+        for edge in transitions.get(transition_id, ()):
+            edge.roles.add(role_id)
+    events = {}
+    for e in Event.objects.filter(workflow__in=owner_ids).values('id',
+            'workflow', 'name', 'state', 'is_mandatory').order_by('id'):
+        for graph in graphs_using(e['workflow'], e['id'], hidden_events):
+            event = EventSpec(e['id'], e['name'], graph.states.get(
+                e['state']), e['is_mandatory'])
+            graph.events[event.id] = event
+            events.setdefault(event.id, []).append(event)
+    for event_id, role_id in _m2m_pairs(Event, 'roles', owner_ids):
+        for event in events.get(event_id, ()):
+            event.roles.add(role_id)
+    # Record the names of the roles referenced by each graph
+    role_ids = set()
+    for graph in graphs.values():
+        for thing in graph.states.values() + graph.transitions.values() + \
+                graph.events.values():
+            role_ids.update(thing.roles)
+    if role_ids:
+        names = dict(Role.objects.filter(pk__in=list(role_ids)).values_list(
+            'id', 'name'))
+        for graph in graphs.values():
+            for thing in graph.states.values() + graph.transitions.values() + \
+                    graph.events.values():
+                for role_id in thing.roles:
+                    graph.roles[role_id] = names[role_id]
+    return graphs
+
+def load_graph(workflow_id):
+    """
+    Returns the WorkflowGraph for a single workflow
+    """
+    return load_graphs([workflow_id])[workflow_id]
+
+# key = (workflow pk, fingerprint), val = WorkflowGraph of an active or
+# retired workflow
+_cached = {}
+_cached_lock = threading.Lock()
+
+def cached_graph(workflow):
+    """
+    Returns the WorkflowGraph of the referenced workflow. Active and retired
+    workflows can't change so their graphs are loaded once per process for
+    each version (and shouldn't be changed by the caller).
+    """
+    if workflow.status == Workflow.DEFINITION or not workflow.fingerprint:
+        return load_graph(workflow.pk)
+    key = (workflow.pk, workflow.fingerprint)
+    graph = _cached.get(key)
+    if graph is None:
+        graph = load_graph(workflow.pk)
+        _cached_lock.acquire()
+        try:
+            _cached[key] = graph
+        finally:
+            _cached_lock.release()
+    return graph
+
+def validate(graph):
+    """
+    Checks the directed graph in the same way as Workflow.is_valid(). Returns a
+    tuple containing a boolean and a dictionary of errors (with the same
+    structure as Workflow.errors). Doesn't touch the database.
+    """
+    errors = {
+            'workflow':[], 
+            'states': {},
+            'transitions':{},
+         }
+    valid = True
+    states = sorted(graph.states.values(), key=lambda s: (not s.is_start_state,
+        s.is_end_state, s.id))
+
+    # The graph must have only one start node
+    if len([s for s in states if s.is_start_state]) != 1:
+        errors['workflow'].append(__('There must be only one start state'))
+        valid = False
+
+    # The graph must have at least one end state
+    if len([s for s in states if s.is_end_state]) < 1:
+        errors['workflow'].append(__('There must be at least one end state'))
+        valid = False
+
+    # Check for orphan nodes / cul-de-sac nodes
+    for state in states:
+        if not state.transitions_into and not state.is_start_state:
+            errors['states'].setdefault(state.id, []).append(__('This state is'\
+                    ' orphaned. There is no way to get to it given the'\
+                    ' current workflow topology.'))
+            valid = False
+        if not state.transitions_from and not state.is_end_state:
+            errors['states'].setdefault(state.id, []).append(__('This state is'\
+                    ' a dead end. It is not marked as an end state and there'\
+                    ' is no way to exit from it.'))
+            valid = False
+
+    # Check the role collections are compatible between states and transitions
+    # (i.e. there cannot be any transitions that are only available to
+    # participants with roles that are not also roles associated with the
+    # parent state).
+    for state in states:
+        for transition in state.transitions_from:
+            if not transition.roles & state.roles:
+                errors['transitions'].setdefault(transition.id, []).append(
+                        __('This transition is not navigable because none of'\
+                        ' the roles associated with the parent state have'\
+                        ' permission to use it.'))
+                valid = False
+
+    # The deadline scheduler can only make transitions out of the state
+    for state in states:
+        if state.deadline_transition:
+            transition = graph.transitions.get(state.deadline_transition)
+            if transition is None or transition.from_state is not state:
+                errors['states'].setdefault(state.id, []).append(__('The'\
+                        ' deadline transition is not a transition out of'\
+                        ' this state.'))
+                valid = False
+
+    # Guard expressions must compile
+    for transition in sorted(graph.transitions.values(), key=lambda t: t.id):
+        if transition.guard:
+            try:
+                compile_guard(transition.guard)
+            except InvalidGuard, instance:
+                errors['transitions'].setdefault(transition.id, []).append(
+                        __('The guard is invalid: %s') % instance.args[0])
+                valid = False
+    return valid, errors
+
+def _state_key(graph, state):
+    """
+    A representation of the state that doesn't depend on primary keys
+    """
+    if state is None:
+        return None
+    return [state.name, state.is_start_state, state.is_end_state,
+            state.estimation_value, state.estimation_unit,
+            sorted([graph.roles[r] for r in state.roles])]
+
+def canonical_form(graph):
+    """
+    Returns a representation of the graph that doesn't depend on primary keys:
+    sorted lists of the states, transitions (referencing the states they
+    connect) and mandatory events. Roles are referenced by name.
+    """
+    states = sorted([_state_key(graph, s) for s in graph.states.values()])
+    transitions = sorted([[_state_key(graph, t.from_state), t.name,
+        sorted([graph.roles[r] for r in t.roles]),
+        _state_key(graph, t.to_state)] + (t.guard and [t.guard] or []) for t
+        in graph.transitions.values()])
+    events = sorted([[e.name, _state_key(graph, e.state),
+        sorted([graph.roles[r] for r in e.roles])] for e in
+        graph.events.values() if e.is_mandatory])
+    return {
+            'states': states,
+            'transitions': transitions,
+            'mandatory_events': events,
+        }
+
+def fingerprint(graph):
+    """
+    Returns a hash (40 hex digits) of the structure of the graph. Workflows
+    with the same states, transitions, role sets, mandatory events and
+    estimations have the same fingerprint whatever their primary keys.
+    """
+    data = simplejson.dumps(canonical_form(graph), sort_keys=True)
+    return sha_constructor(data.encode('utf_8')).hexdigest()
+
+def distances_to_end(graph):
+    """
+    Returns a dictionary (keyed by state pk) of tuples containing the fewest
+    transitions needed to get from each state to an end state along with the
+    pk of the first transition to take (None for end states). States from
+    which no end state can be reached are not included.
+
+    Calculated with a breadth first search backwards from the end states.
+    """
+    result = {}
+    queue = []
+    for state in sorted(graph.states.values(), key=lambda s: s.id):
+        if state.is_end_state:
+            result[state.id] = (0, None)
+            queue.append(state)
+    i = 0
+    while i < len(queue):
+        state = queue[i]
+        i += 1
+        distance = result[state.id][0] + 1
+        for transition in sorted(state.transitions_into, key=lambda t: t.id):
+            if not transition.from_state.id in result:
+                result[transition.from_state.id] = (distance, transition.id)
+                queue.append(transition.from_state)
+    return result
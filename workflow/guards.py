@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+"""
+Guard expressions: conditions attached to transitions that, once satisfied,
+make the engine progress a WorkflowActivity automatically.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+from django.utils.translation import ugettext as __
+import ast
+import datetime
+import threading
+
+class InvalidGuard(Exception):
+    """
+    To be raised if a guard expression can't be compiled
+    """
+
+# The names that may be used in a guard expression and their descriptions
+GUARD_NAMES = {
+        'mandatory_events_logged': 'True if all the mandatory events for the'\
+                ' current state have been logged',
+        'events': 'The set of names of the events logged',
+        'roles': 'The set of names of the roles held by enabled participants',
+        'seconds_in_state': 'The number of seconds since the current state'\
+                ' was entered',
+    }
+
+# The syntax allowed in a guard expression: comparisons, boolean logic,
+# arithmetic and literals. No calls, attributes or subscripts.
+_ALLOWED_NODES = tuple([getattr(ast, name) for name in ('Expression',
+    'BoolOp', 'And', 'Or', 'UnaryOp', 'Not', 'USub', 'UAdd', 'BinOp', 'Add',
+    'Sub', 'Mult', 'Div', 'Mod', 'Compare', 'Eq', 'NotEq', 'Lt', 'LtE',
+    'Gt', 'GtE', 'In', 'NotIn', 'Name', 'Load', 'Num', 'Str', 'Tuple', 'List',
+    'Set', 'NameConstant', 'Constant') if hasattr(ast, name)])
+
+_CONSTANTS = ('True', 'False', 'None')
+
+def compile_guard(expression):
+    """
+    Returns a code object for the guard expression. Raises InvalidGuard if the
+    expression isn't valid or uses anything other than the allowed syntax and
+    the names in GUARD_NAMES.
+    """
+    try:
+        tree = ast.parse(expression.strip(), '<guard>', 'eval')
+    except SyntaxError, instance:
+        raise InvalidGuard, __('Invalid syntax: %s') % instance.msg
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise InvalidGuard, __('%s is not allowed') % type(node).__name__
+        if isinstance(node, ast.Name) and node.id not in GUARD_NAMES and \
+                node.id not in _CONSTANTS:
+            raise InvalidGuard, __('Unknown name: %s') % node.id
+    return compile(tree, '<guard>', 'eval')
+
+# key = (workflow pk, fingerprint), val = dictionary with key = state pk, val =
+# list of (transition pk, code) tuples for the transitions out of the state
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+def guards_for(workflow):
+    """
+    Returns the compiled guards for an ACTIVE workflow (an empty dictionary
+    for other workflows). They're compiled once per process for each version
+    of the workflow.
+    """
+    from workflow.models import Workflow
+    if workflow.status != Workflow.ACTIVE:
+        return {}
+    key = (workflow.pk, workflow.fingerprint)
+    guards = _compiled.get(key)
+    if guards is None:
+        guards = {}
+        for pk, from_state, guard in workflow.effective_transitions(
+                ).exclude(guard='').order_by('id').values_list('id',
+                    'from_state', 'guard'):
+            guards.setdefault(from_state, []).append((pk,
+                compile_guard(guard)))
+        _compiled_lock.acquire()
+        try:
+            _compiled[key] = guards
+        finally:
+            _compiled_lock.release()
+    return guards
+
+class GuardContext(dict):
+    """
+    The names available to a guard expression, looked up from the database
+    the first time each is used
+    """
+    def __init__(self, activity, current_state):
+        self.activity = activity
+        self.current_state = current_state
+
+    def __missing__(self, name):
+        from workflow.models import Role, WorkflowHistory
+        if name == 'mandatory_events_logged':
+            value = True
+            for event in self.activity._mandatory_events(
+                    self.current_state.state):
+                if not self.activity._event_logged(event):
+                    value = False
+                    break
+        elif name == 'events':
+            value = frozenset(self.activity.history.filter(
+                event__isnull=False).values_list('event__name', flat=True))
+        elif name == 'roles':
+            value = frozenset(Role.objects.filter(
+                participant__workflowactivity=self.activity,
+                participant__disabled=False).values_list('name', flat=True))
+        elif name == 'seconds_in_state':
+            entered = self.activity.history.filter(
+                    log_type=WorkflowHistory.TRANSITION).order_by(
+                            '-created_on', '-id')[0].created_on
+            delta = datetime.datetime.now() - entered
+            value = delta.days * 86400 + delta.seconds
+        else:
+            raise KeyError(name)
+        self[name] = value
+        return value
+
+# The errors a guard expression can raise when it fails to evaluate. Anything
+# else (e.g. a DatabaseError whilst looking up a name) is passed on.
+EVALUATION_ERRORS = (TypeError, ValueError, ArithmeticError, KeyError,
+        IndexError, NameError)
+
+def evaluate(code, context):
+    """
+    Returns True if the compiled guard is satisfied. Guards that fail to
+    evaluate (e.g. comparing incompatible types) are not satisfied.
+    """
+    try:
+        return bool(eval(code, {'__builtins__': {}}, context))
+    except EVALUATION_ERRORS:
+        return False
+
+def satisfied_transition(activity):
+    """
+    Returns the pk of the first transition (in pk order) out of the
+    activity's current state whose guard is satisfied, or None
+    """
+    if activity.completed_on:
+        return None
+    guards = guards_for(activity.workflow)
+    if not guards:
+        return None
+    current_state = activity.current_state()
+    if not current_state or not current_state.state_id:
+        return None
+    candidates = guards.get(current_state.state_id)
+    if not candidates:
+        return None
+    context = GuardContext(activity, current_state)
+    for pk, code in candidates:
+        if evaluate(code, context):
+            return pk
+    return None
+
+def evaluate_activities(activities, chunk_size=500):
+    """
+    Re-checks the guards of the activities (e.g. after changing a guard or
+    for guards using seconds_in_state) and progresses those whose guards are
+    satisfied. The activities are loaded in chunks with their workflows.
+    Returns the number of activities that were progressed.
+    """
+    from workflow.models import WorkflowActivity
+    if hasattr(activities, 'values_list'):
+        ids = list(activities.values_list('id', flat=True))
+    else:
+        ids = [a.pk for a in activities]
+    progressed = 0
+    for i in range(0, len(ids), chunk_size):
+        for activity in WorkflowActivity.objects.select_related(
+                'workflow').filter(pk__in=ids[i:i + chunk_size],
+                        completed_on__isnull=True):
+            if activity._auto_progress():
+                progressed += 1
+    return progressed
@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+"""
+Checks the history of every activity against the definition of its workflow
+across a pool of processes. Each process checks a range of activities (by pk)
+and the position reached is checkpointed so an interrupted run carries on
+where it left off. Violations are written as JSON, one per line.
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import multiprocessing
+import sys
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Max
+from django.utils import simplejson
+
+# project
+from workflow.models import WorkflowActivity, ConformanceCheckpoint
+from workflow.conformance import check_activities
+
+def _check(bounds):
+    """
+    Run in the worker processes (each with its own database connection)
+    """
+    first, last = bounds
+    return last, check_activities(first, last)
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--name', dest='name', default='conformance',
+            help='The name of the checkpoint to carry on from and update.'),
+        make_option('--restart', action='store_true', dest='restart',
+            default=False,
+            help='Start again from the first activity.'),
+        make_option('--range-size', dest='range_size', type='int',
+            default=10000,
+            help='The number of activity pks each process checks at a time.'),
+        make_option('--processes', dest='processes', type='int',
+            default=multiprocessing.cpu_count(),
+            help='The number of processes to check with.'),
+        make_option('--output', dest='output', default=None,
+            help='Append the violations to the given file rather than'\
+                ' writing them to stdout.'),
+    )
+    help = 'Replays the history of each activity against the definition of'\
+            ' its workflow and reports illegal moves, missing mandatory'\
+            ' events and role violations.'
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        checkpoint, created = ConformanceCheckpoint.objects.get_or_create(
+                name=options.get('name') or 'conformance')
+        if options.get('restart'):
+            checkpoint.position = 0
+        last = WorkflowActivity.objects.aggregate(Max('id'))['id__max'] or 0
+        size = max(1, options.get('range_size') or 1)
+        ranges = [(first, min(first + size - 1, last)) for first in
+                range(checkpoint.position + 1, last + 1, size)]
+
+        processes = max(1, options.get('processes') or 1)
+        if processes > 1 and len(ranges) > 1:
+            # The workers mustn't share the parent's connection
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap(_check, ranges)
+        else:
+            pool = None
+            results = (_check(bounds) for bounds in ranges)
+        if options.get('output'):
+            output = open(options['output'], 'a')
+        else:
+            output = sys.stdout
+        found = 0
+        try:
+            # The ranges are finished in order so the checkpoint never skips
+            # one that hasn't been checked
+            for position, violations in results:
+                for violation in violations:
+                    output.write(simplejson.dumps(violation) + '\n')
+                output.flush()
+                found += len(violations)
+                checkpoint.position = position
+                checkpoint.save()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            if output is not sys.stdout:
+                output.close()
+        if verbosity > 0:
+            sys.stderr.write('Checked activities up to %d: %d violation(s)\n'
+                    % (checkpoint.position, found))
+        checkpoint.save()
@@ -0,0 +1,40 @@
+# -*- coding: UTF-8 -*-
+"""
+Delivers the workflow messages waiting in the outbox to the registered
+handlers.
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import time
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand
+
+# project
+from workflow.outbox import deliver_pending
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', dest='limit', type='int', default=100,
+            help='The number of messages to claim at a time.'),
+        make_option('--poll', dest='poll', type='float', default=None,
+            help='Keep running, checking for new messages every given number'\
+                ' of seconds.'),
+    )
+    help = 'Delivers pending workflow outbox messages to the handlers'\
+            ' registered with workflow.outbox.register().'
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        poll = options.get('poll')
+        while True:
+            delivered, failed = deliver_pending(options.get('limit') or 100)
+            if verbosity > 0 and (delivered or failed or not poll):
+                print 'Delivered %d message(s), %d failed attempt(s)' % (
+                        delivered, failed)
+            if not poll:
+                return
+            time.sleep(poll)
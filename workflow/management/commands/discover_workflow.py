@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+"""
+Discovers the flow the activities of a workflow actually took from its
+history and writes it as a diagram to compare with the designed one.
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import sys
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+
+# project
+from workflow.models import Workflow
+from workflow.diagrams import FORMATS, run_dot, DotError
+from workflow.discovery import discover, get_discovered_dotfile,\
+        SAMPLE_SIZE
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='dot',
+            help='The format of the diagram: %s.' % ', '.join(
+                sorted(FORMATS))),
+        make_option('--output', dest='output', default=None,
+            help='Write the diagram to the given file rather than stdout.'),
+        make_option('--sample-size', dest='sample_size', type='int',
+            default=SAMPLE_SIZE,
+            help='The number of durations sampled to estimate the median'\
+                ' duration of each move.'),
+    )
+    help = 'Writes a diagram of the states, events and transitions the'\
+            ' activities of a workflow went through, how often and how long'\
+            ' each move took.'
+    args = 'workflow_slug'
+
+    def handle(self, *slugs, **options):
+        if len(slugs) != 1:
+            raise CommandError('Enter the slug of one workflow')
+        try:
+            workflow = Workflow.objects.get(slug=slugs[0])
+        except Workflow.DoesNotExist:
+            raise CommandError('No workflow with the slug: %s' % slugs[0])
+        format = options.get('format') or 'dot'
+        if format not in FORMATS:
+            raise CommandError('Unknown format: %s' % format)
+        graph = discover(workflow, sample_size=max(1,
+            options.get('sample_size') or SAMPLE_SIZE))
+        dot = get_discovered_dotfile(graph)
+        if format == 'dot':
+            diagram = dot.encode('utf_8')
+        else:
+            try:
+                diagram = run_dot(dot, format)
+            except DotError, e:
+                raise CommandError(str(e))
+        if options.get('output'):
+            output = open(options['output'], 'wb')
+        else:
+            output = sys.stdout
+        try:
+            output.write(diagram)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        if int(options.get('verbosity', 1)) > 0:
+            sys.stderr.write('Discovered %d move(s) made by %d activities\n'
+                    % (sum([e.count for e in graph.edges.values()]),
+                        graph.activities))
@@ -0,0 +1,29 @@
+# -*- coding: UTF-8 -*-
+"""
+Re-checks the guards of open workflow activities and makes the transitions
+that have become satisfied.
+
+Author: Nicholas H.Tollervey
+
+"""
+# django
+from django.core.management.base import BaseCommand
+
+# project
+from workflow.models import Workflow, WorkflowActivity
+from workflow.guards import evaluate_activities
+
+class Command(BaseCommand):
+    help = 'Makes the guarded transitions of open workflow activities whose'\
+            ' guards are satisfied (run it regularly for guards that use'\
+            ' seconds_in_state).'
+    args = '[workflow_slug workflow_slug ...]'
+
+    def handle(self, *slugs, **options):
+        workflows = Workflow.objects.filter(status=Workflow.ACTIVE)
+        if slugs:
+            workflows = workflows.filter(slug__in=slugs)
+        progressed = evaluate_activities(WorkflowActivity.objects.filter(
+            workflow__in=workflows, completed_on__isnull=True))
+        if int(options.get('verbosity', 1)) > 0:
+            print 'Progressed %d activities' % progressed
@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+"""
+Renders the diagrams of every active (and retired) workflow into storage
+across a pool of processes. Intended to be run at deploy time.
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import multiprocessing
+from optparse import make_option
+
+# django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# project
+from workflow.models import Workflow
+from workflow.diagrams import get_dotfile, store_diagrams, DotError
+
+def _render(args):
+    """
+    Run in the worker processes: doesn't touch the database
+    """
+    workflow_id, fingerprint, dot, force = args
+    store_diagrams(workflow_id, fingerprint, dot, force)
+    return workflow_id
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--retired', action='store_true', dest='retired',
+            default=False,
+            help='Render the diagrams of retired workflows as well.'),
+        make_option('--force', action='store_true', dest='force',
+            default=False,
+            help='Render diagrams that are already in storage again.'),
+        make_option('--processes', dest='processes', type='int',
+            default=multiprocessing.cpu_count(),
+            help='The number of processes to render with.'),
+    )
+    help = 'Renders the diagrams (dot, png and svg) of active workflows into'\
+            ' storage.'
+    args = '[workflow_slug workflow_slug ...]'
+
+    def handle(self, *slugs, **options):
+        if not hasattr(settings, 'GRAPHVIZ_DOT_COMMAND'):
+            raise CommandError('GRAPHVIZ_DOT_COMMAND constant not set in'\
+                    ' settings.py')
+        statuses = [Workflow.ACTIVE]
+        if options.get('retired'):
+            statuses.append(Workflow.RETIRED)
+        workflows = Workflow.objects.filter(status__in=statuses)
+        if slugs:
+            workflows = workflows.filter(slug__in=slugs)
+        # The .dot files are generated here so the workers needn't use the
+        # database
+        force = options.get('force', False)
+        jobs = [(w.id, w.get_fingerprint(), get_dotfile(w), force) for w in
+                workflows.order_by('id')]
+
+        processes = max(1, options.get('processes') or 1)
+        try:
+            if processes > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    rendered = pool.map(_render, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                rendered = map(_render, jobs)
+        except DotError, e:
+            raise CommandError(str(e))
+        if int(options.get('verbosity', 1)) > 0:
+            print 'Rendered the diagrams of %d workflow(s)' % len(rendered)
@@ -0,0 +1,77 @@
+# -*- coding: UTF-8 -*-
+"""
+Deletes the WorkflowHistory records older than the retention policy allows in
+small batches and reports the rows and space reclaimed.
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+
+# project
+from workflow.models import WorkflowHistory
+from workflow.retention import prune_history, get_policy, LOG_TYPES,\
+        BATCH_SIZE, InvalidRetentionPolicy
+
+def _parse_keep(values):
+    """
+    Returns the policy given as a list of log_type=days strings
+    """
+    policy = {}
+    for value in values:
+        try:
+            name, days = value.split('=', 1)
+        except ValueError:
+            raise CommandError('Enter --keep as log_type=days: %s' % value)
+        policy[name.strip().lower()] = days.strip()
+    return policy
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--keep', action='append', dest='keep', default=[],
+            help='The number of days to keep records of a log type for as'\
+                ' log_type=days (%s), e.g. --keep comment=365. Can be given'\
+                ' more than once. Overrides WORKFLOW_HISTORY_RETENTION in'\
+                ' settings.py.' % ', '.join(sorted(LOG_TYPES))),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=BATCH_SIZE,
+            help='The number of primary keys to delete from at a time.'),
+        make_option('--pause', dest='pause', type='float', default=0.1,
+            help='The number of seconds to wait between batches.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='Report what would be deleted without deleting anything.'),
+    )
+    help = 'Deletes old EVENT, ROLE and COMMENT records from the workflow'\
+            ' history according to the retention policy. TRANSITION records'\
+            ' and the records of mandatory events are never deleted.'
+
+    def handle(self, *args, **options):
+        if options.get('keep'):
+            policy = _parse_keep(options['keep'])
+        else:
+            policy = get_policy()
+        if not policy:
+            raise CommandError('No retention policy: set'\
+                    ' WORKFLOW_HISTORY_RETENTION in settings.py or use --keep')
+        try:
+            reclaimed = prune_history(policy,
+                    batch_size=max(1, options.get('batch_size') or 1),
+                    pause=options.get('pause') or 0,
+                    dry_run=options.get('dry_run', False))
+        except InvalidRetentionPolicy, e:
+            raise CommandError(e.args[0])
+        if int(options.get('verbosity', 1)) > 0:
+            names = dict(WorkflowHistory.TYPE_CHOICE_LIST)
+            verb = options.get('dry_run') and 'Would delete' or 'Deleted'
+            for log_type in sorted(reclaimed):
+                rows, size = reclaimed[log_type]
+                print '%s %d %s record(s), about %d bytes' % (verb, rows,
+                        names[log_type], size)
+            print 'Total: %d record(s), about %d bytes' % (
+                    sum([r[0] for r in reclaimed.values()]),
+                    sum([r[1] for r in reclaimed.values()]))
@@ -0,0 +1,45 @@
+# -*- coding: UTF-8 -*-
+"""
+Recalculates the per-state counts of open WorkflowActivity instances from the
+WorkflowHistory and corrects any that have drifted.
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand
+
+# project
+from workflow.models import Workflow, StateActivityCount
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Reconcile workflows in definition as well as those that'\
+                ' are active or retired.'),
+    )
+    help = 'Recalculates the number of open workflow activities in each'\
+            ' state from the workflow history.'
+    args = '[workflow_slug workflow_slug ...]'
+
+    def handle(self, *slugs, **options):
+        workflows = Workflow.objects.all()
+        if slugs:
+            workflows = workflows.filter(slug__in=slugs)
+        elif not options.get('all'):
+            workflows = workflows.exclude(status=Workflow.DEFINITION)
+        verbosity = int(options.get('verbosity', 1))
+        corrected = 0
+        count = 0
+        for workflow in workflows.order_by('id'):
+            wrong = StateActivityCount.objects.reconcile(workflow)
+            if wrong and verbosity > 1:
+                print '%s: corrected %d count(s)' % (workflow.slug, wrong)
+            corrected += wrong
+            count += 1
+        if verbosity > 0:
+            print 'Reconciled %d workflow(s), corrected %d count(s)' % (count,
+                    corrected)
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+"""
+Runs the deadline scheduler that carries out the actions defined against
+states when their deadlines pass.
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import datetime
+import time
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand
+
+# project
+from workflow.scheduler import DeadlineScheduler
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--name', dest='name', default='default',
+            help='The name of the checkpoint to carry on from.'),
+        make_option('--horizon', dest='horizon', type='int', default=60,
+            help='The number of minutes of upcoming deadlines to keep in'\
+                ' memory.'),
+        make_option('--slack', dest='slack', type='int', default=5,
+            help='The longest number of minutes a transaction writing to the'\
+                ' history is expected to take.'),
+        make_option('--poll', dest='poll', type='float', default=10,
+            help='The longest number of seconds to wait before looking for'\
+                ' newly written deadlines.'),
+        make_option('--once', action='store_true', dest='once',
+            default=False, help='Deal with the deadlines that have passed'\
+                ' and stop.'),
+    )
+    help = 'Carries out the deadline actions of workflow states as the'\
+            ' deadlines pass.'
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        scheduler = DeadlineScheduler(options.get('name'),
+                datetime.timedelta(minutes=options.get('horizon')),
+                slack=datetime.timedelta(minutes=options.get('slack')))
+        scheduler.start()
+        poll = options.get('poll')
+        while True:
+            fired = scheduler.run_once()
+            if verbosity > 0 and (fired or options.get('once')):
+                print 'Dealt with %d deadline(s)' % fired
+            if options.get('once'):
+                return
+            wait = poll
+            next_deadline = scheduler.next_deadline()
+            if next_deadline:
+                delta = next_deadline - datetime.datetime.now()
+                wait = min(poll, max(0, delta.days * 86400 + delta.seconds +
+                    delta.microseconds / 1000000.0))
+            time.sleep(wait)
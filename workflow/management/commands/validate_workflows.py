@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+"""
+Validates workflow definitions in bulk across a pool of processes and emits a
+machine-readable (JSON) report.
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import datetime
+import multiprocessing
+import os
+import sys
+import time
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+# project
+from workflow.models import Workflow
+from workflow.graph import load_graphs, validate
+
+# The number of workflows to load from the database at a time
+CHUNK_SIZE = 250
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def _validate(graph):
+    """
+    Run in the worker processes: doesn't touch the database
+    """
+    valid, errors = validate(graph)
+    return graph.workflow_id, valid, errors
+
+def _parse_changed_since(value):
+    """
+    Returns a datetime given either a timestamp or the path to the report
+    written by a previous run
+    """
+    if os.path.isfile(value):
+        value = simplejson.load(open(value))['generated_on']
+    for format in (DATETIME_FORMAT, '%Y-%m-%d'):
+        try:
+            return datetime.datetime(*time.strptime(value, format)[:6])
+        except ValueError:
+            pass
+    raise CommandError('Unable to understand --changed-since: %s' % value)
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Validate active and retired workflows as well as those in'\
+                ' definition.'),
+        make_option('--changed-since', dest='changed_since', default=None,
+            help='Only validate workflows edited since the given time'\
+                ' (YYYY-MM-DD [HH:MM:SS]) or since the run that wrote the'\
+                ' given report file.'),
+        make_option('--processes', dest='processes', type='int',
+            default=multiprocessing.cpu_count(),
+            help='The number of processes to validate with.'),
+        make_option('--output', dest='output', default=None,
+            help='Write the report to the given file rather than stdout.'),
+        make_option('--indent', dest='indent', type='int', default=None,
+            help='The indent level to use when pretty-printing the report.'),
+    )
+    help = 'Validates workflows and reports the errors found (with the same'\
+            ' keys as Workflow.errors) as JSON.'
+    args = '[workflow_slug workflow_slug ...]'
+
+    def handle(self, *slugs, **options):
+        generated_on = datetime.datetime.now()
+        workflows = Workflow.objects.all()
+        if slugs:
+            workflows = workflows.filter(slug__in=slugs)
+        elif not options.get('all'):
+            workflows = workflows.filter(status=Workflow.DEFINITION)
+        changed_since = options.get('changed_since')
+        if changed_since:
+            changed_since = _parse_changed_since(changed_since)
+            workflows = workflows.filter(updated_on__gte=changed_since)
+        details = dict([(w['id'], w) for w in workflows.values('id', 'slug',
+            'name', 'status')])
+        ids = sorted(details.keys())
+
+        processes = max(1, options.get('processes') or 1)
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            validate_all = lambda graphs: pool.imap(_validate, graphs,
+                    max(1, len(graphs) / processes))
+        else:
+            pool = None
+            validate_all = lambda graphs: map(_validate, graphs)
+        report = {}
+        try:
+            for i in range(0, len(ids), CHUNK_SIZE):
+                graphs = load_graphs(ids[i:i + CHUNK_SIZE]).values()
+                for workflow_id, valid, errors in validate_all(graphs):
+                    result = details[workflow_id]
+                    del result['id']
+                    result['valid'] = valid
+                    result['errors'] = errors
+                    report[workflow_id] = result
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        output = simplejson.dumps({
+                'generated_on': generated_on.strftime(DATETIME_FORMAT),
+                'changed_since': changed_since and
+                    changed_since.strftime(DATETIME_FORMAT) or None,
+                'valid': len([r for r in report.values() if r['valid']]),
+                'invalid': len([r for r in report.values() if not r['valid']]),
+                'workflows': report,
+            }, indent=options.get('indent'))
+        if options.get('output'):
+            f = open(options['output'], 'w')
+            f.write(output)
+            f.close()
+        else:
+            sys.stdout.write(output + '\n')
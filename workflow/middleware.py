@@ -0,0 +1,24 @@
+# -*- coding: UTF-8 -*-
+"""
+Middleware for the workflow application.
+
+Author: Nicholas H.Tollervey
+
+"""
+from workflow.routers import unpin
+
+class PrimaryStickinessMiddleware(object):
+    """
+    Makes sure reads pinned to the primary database by a write (see
+    workflow.routers.ReplicaRouter) only stay pinned for the rest of the
+    request that made the write
+    """
+    def process_request(self, request):
+        unpin()
+
+    def process_response(self, request, response):
+        unpin()
+        return response
+
+    def process_exception(self, request, exception):
+        unpin()
@@ -35,12 +35,23 @@ OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
-from django.db import models
+from django.conf import settings
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Q
+from django.db.backends.util import typecast_timestamp
+from django.db.models.query import QuerySet
+from django.db.models.fields.related import \
+        ReverseManyRelatedObjectsDescriptor
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _, ugettext as __
 from django.contrib.auth.models import User
+from django.utils import simplejson
 import django.dispatch
 import datetime
+import threading
+from functools import wraps
+from workflow.deferred import deferred
+from workflow.routers import pin_to_primary
 
 ############
 # Exceptions
@@ -57,6 +68,12 @@ class UnableToCloneWorkflow(Exception):
     To be raised if unable to clone a workflow model (and related models)
     """
 
+class UnableToEditWorkflow(Exception):
+    """
+    To be raised if unable to change the definition of a version of a workflow
+    (or if the change would leave the definition inconsistent)
+    """
+
 class UnableToStartWorkflow(Exception):
     """
     To be raised if a WorkflowActivity is unable to start a workflow
@@ -123,10 +140,74 @@ workflow_commented = django.dispatch.Signal()
 # Fired when an active WorkflowActivity reaches a workflow's end state. The
 # sender is an instance of the WorkflowActivity model
 workflow_ended = django.dispatch.Signal()
+# Fired by the deadline scheduler when a WorkflowActivity is still in a state
+# after its deadline has passed. The sender is the instance of the
+# WorkflowHistory model that recorded the deadline (when the state was entered)
+workflow_deadline_passed = django.dispatch.Signal()
 
 ########
 # Models
 ########
+
+def _touch_workflow(workflow_id):
+    """
+    Updates the updated_on timestamp of the referenced workflow (if any) when
+    part of its definition changes
+    """
+    if workflow_id:
+        Workflow.objects.filter(pk=workflow_id).update(
+                updated_on=datetime.datetime.now())
+
+def _touching(method, instance):
+    def _touch(*args, **kwargs):
+        result = method(*args, **kwargs)
+        _touch_workflow(instance.workflow_id)
+        return result
+    return wraps(method)(_touch)
+
+class _DefinitionRelatedObjectsDescriptor(ReverseManyRelatedObjectsDescriptor):
+    """
+    Wraps add(), remove() and clear() of the related manager so they touch the
+    workflow of the instance (there's no signal for many to many changes)
+    """
+
+    def __get__(self, instance, instance_type=None):
+        manager = super(_DefinitionRelatedObjectsDescriptor, self).__get__(
+                instance, instance_type)
+        if instance is None:
+            return manager
+        for name in ('add', 'remove', 'clear'):
+            setattr(manager, name, _touching(getattr(manager, name),
+                instance))
+        return manager
+
+class DefinitionManyToManyField(models.ManyToManyField):
+    """
+    A ManyToManyField of part of a workflow's definition. Changes made through
+    it (including by the admin) update the workflow's updated_on.
+    """
+
+    def contribute_to_class(self, cls, name):
+        super(DefinitionManyToManyField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, _DefinitionRelatedObjectsDescriptor(self))
+
+def atomic_unless_managed(func):
+    """
+    Decorates functions whose writes must be committed (or rolled back)
+    together. Within a transaction managed by the caller (e.g. by
+    TransactionMiddleware or commit_on_success) they're simply part of it:
+    commit_on_success doesn't nest so it would commit the caller's work early.
+    Otherwise they're run in a transaction of their own.
+
+    The engine methods are decorated with this so the history, counts and
+    completion written by a call are committed together (or not at all).
+    """
+    def _atomic(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+    return wraps(func)(_atomic)
+
 class Role(models.Model):
     """
     Represents a type of user who can be associated with a workflow. Used by
@@ -154,6 +235,112 @@ class Role(models.Model):
                 ('can_define_roles', __('Can define roles')),
             )
 
+class PrefetchingQuerySet(QuerySet):
+    """
+    A QuerySet that loads data related to the instances it returns in bulk (a
+    chunk of instances at a time) rather than with queries per instance. The
+    subclasses define a _prefetch_<name>(instances) method for each sort of
+    related data that can be named in prefetch().
+    """
+
+    # The number of instances related data is loaded for at a time
+    PREFETCH_CHUNK_SIZE = 500
+
+    def __init__(self, *args, **kwargs):
+        super(PrefetchingQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch = ()
+
+    def prefetch(self, *names):
+        """
+        Returns a new QuerySet that loads the referenced related data
+        """
+        c = self._clone()
+        c._prefetch = c._prefetch + tuple([n for n in names if n not in
+            c._prefetch])
+        return c
+
+    def iterator(self):
+        instances = super(PrefetchingQuerySet, self).iterator()
+        if not self._prefetch:
+            for obj in instances:
+                yield obj
+            return
+        chunk = []
+        for obj in instances:
+            chunk.append(obj)
+            if len(chunk) == self.PREFETCH_CHUNK_SIZE:
+                for obj in self._prefetch_chunk(chunk):
+                    yield obj
+                chunk = []
+        for obj in self._prefetch_chunk(chunk):
+            yield obj
+
+    def _prefetch_chunk(self, chunk):
+        if chunk:
+            for name in self._prefetch:
+                getattr(self, '_prefetch_%s' % name)(chunk)
+        return chunk
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        c = super(PrefetchingQuerySet, self)._clone(klass, setup, **kwargs)
+        c._prefetch = self._prefetch
+        return c
+
+def _m2m_related(model, field_name, ids):
+    """
+    Returns a dictionary (keyed by pk) of lists of the instances related to
+    the referenced instances (by pk) through the many-to-many field. Uses two
+    queries however many instances there are.
+    """
+    result = dict([(pk, []) for pk in ids])
+    if not ids:
+        return result
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(field_name)
+    cursor = connection.cursor()
+    cursor.execute('SELECT m.%s, m.%s FROM %s m WHERE m.%s IN (%s)' % (
+            qn(field.m2m_column_name()),
+            qn(field.m2m_reverse_name()),
+            qn(field.m2m_db_table()),
+            qn(field.m2m_column_name()),
+            ', '.join(['%s'] * len(ids)),
+        ), list(ids))
+    owners = {}
+    for pk, related_pk in cursor.fetchall():
+        owners.setdefault(related_pk, []).append(pk)
+    if owners:
+        # In the related model's default order
+        for obj in field.rel.to._default_manager.filter(
+                pk__in=owners.keys()):
+            for pk in owners[obj.pk]:
+                result[pk].append(obj)
+    return result
+
+class WorkflowQuerySet(PrefetchingQuerySet):
+    """
+    Adds methods to load data related to Workflow instances in bulk
+    """
+
+    def with_graph(self):
+        """
+        Loads the WorkflowGraph of each workflow (see get_graph())
+        """
+        return self.prefetch('graph')
+
+    def _prefetch_graph(self, workflows):
+        from workflow.graph import load_graphs
+        graphs = load_graphs([w.pk for w in workflows])
+        for w in workflows:
+            w._prefetched_graph = graphs[w.pk]
+
+class WorkflowManager(models.Manager):
+
+    def get_query_set(self):
+        return WorkflowQuerySet(self.model)
+
+    def with_graph(self):
+        return self.get_query_set().with_graph()
+
 class Workflow(models.Model):
     """
     Instances of this class represent a named workflow that achieve a particular
@@ -213,6 +400,46 @@ class Workflow(models.Model):
             'self', 
             null=True
             )
+    # A version (see new_version()) shares the states, transitions and events
+    # of the workflow it is based on (and that workflow's base and so on)
+    # apart from those it hides. It stores only the rows that it changes.
+    base = models.ForeignKey(
+            'self',
+            null=True,
+            blank=True,
+            related_name='versions'
+            )
+    hidden_states = models.ManyToManyField(
+            'State',
+            blank=True,
+            related_name='hidden_in'
+            )
+    hidden_transitions = models.ManyToManyField(
+            'Transition',
+            blank=True,
+            related_name='hidden_in'
+            )
+    hidden_events = models.ManyToManyField(
+            'Event',
+            blank=True,
+            related_name='hidden_in'
+            )
+    # Updated whenever the workflow or one of its states, transitions or events
+    # is saved or deleted
+    updated_on = models.DateTimeField(
+            auto_now=True
+            )
+    # A hash of the structure of the workflow (see get_fingerprint()) stored
+    # when the workflow is activated
+    fingerprint = models.CharField(
+            _('Fingerprint'),
+            max_length=40,
+            blank=True,
+            db_index=True,
+            editable=False
+            )
+
+    objects = WorkflowManager()
 
     # To hold error messages created in the validate method
     errors = {
@@ -232,61 +459,8 @@ class Workflow(models.Model):
 
         Returns a boolean
         """
-        self.errors = {
-                'workflow':[], 
-                'states': {},
-                'transitions':{},
-             }
-        valid = True
-
-        # The graph must have only one start node
-        if self.states.filter(is_start_state=True).count() != 1:
-            self.errors['workflow'].append(__('There must be only one start'\
-                ' state'))
-            valid = False
-
-        # The graph must have at least one end state
-        if self.states.filter(is_end_state=True).count() < 1:
-            self.errors['workflow'].append(__('There must be at least one end'\
-                ' state'))
-            valid = False
-
-        # Check for orphan nodes / cul-de-sac nodes
-        all_states = self.states.all()
-        for state in all_states:
-            if state.transitions_into.all().count() == 0 and state.is_start_state == False:
-                if not state.id in self.errors['states']:
-                    self.errors['states'][state.id] = list()
-                self.errors['states'][state.id].append(__('This state is'\
-                        ' orphaned. There is no way to get to it given the'\
-                        ' current workflow topology.'))
-                valid = False
-
-            if state.transitions_from.all().count() == 0 and state.is_end_state == False:
-                if not state.id in self.errors['states']:
-                    self.errors['states'][state.id] = list()
-                self.errors['states'][state.id].append(__('This state is a'\
-                        ' dead end. It is not marked as an end state and there'\
-                        ' is no way to exit from it.'))
-                valid = False
-
-        # Check the role collections are compatible between states and
-        # transitions (i.e. there cannot be any transitions that are only
-        # available to participants with roles that are not also roles
-        # associated with the parent state).
-        for state in all_states:
-            # *at least* one role from the state must also be associated
-            # with each transition where the state is the from_state 
-            state_roles = state.roles.all()
-            for transition in state.transitions_from.all():
-                if not transition.roles.filter(pk__in=[r.id for r in state_roles]):
-                    if not transition.id in self.errors['transitions']:
-                        self.errors['transitions'][transition.id] = list()
-                    self.errors['transitions'][transition.id].append(__('This'\
-                            ' transition is not navigable because none of the'\
-                            ' roles associated with the parent state have'\
-                            ' permission to use it.'))
-                    valid = False
+        from workflow.graph import load_graph, validate
+        valid, self.errors = validate(load_graph(self.pk))
         return valid
 
     def has_errors(self, thing):
@@ -318,12 +492,214 @@ class Workflow(models.Model):
         if not self.status == self.DEFINITION:
             raise UnableToActivateWorkflow, __('Only workflows in the'\
                     ' "definition" state may be activated')
-        if not self.is_valid():
+        from workflow.graph import load_graph, validate, fingerprint
+        graph = load_graph(self.pk)
+        valid, self.errors = validate(graph)
+        if not valid:
             raise UnableToActivateWorkflow, __("Cannot activate as the"\
                     " workflow doesn't validate.")
         # Good to go...
         self.status = self.ACTIVE
+        self.fingerprint = fingerprint(graph)
         self.save()
+        self.build_distances(graph)
+        StateActivityCount.objects.reconcile(self)
+        from workflow.diagrams import queue_prerender
+        queue_prerender(self)
+
+    def build_distances(self, graph=None):
+        """
+        (Re)builds the StateDistance records for this workflow from the
+        referenced WorkflowGraph (loaded if not given). Called on activation.
+        """
+        from workflow.graph import load_graph, distances_to_end
+        if graph is None:
+            graph = load_graph(self.pk)
+        StateDistance.objects.filter(workflow=self).delete()
+        distances = distances_to_end(graph)
+        _bulk_insert(StateDistance, [StateDistance(workflow_id=self.pk,
+            state_id=state_id, distance=distance,
+            next_transition_id=transition_id) for state_id, (distance,
+                transition_id) in distances.items()])
+
+    def get_graph(self):
+        """
+        Returns the WorkflowGraph (see workflow.graph) of the workflow, loaded
+        along with the workflow by WorkflowQuerySet.with_graph() or otherwise
+        with workflow.graph.cached_graph()
+        """
+        if '_prefetched_graph' in self.__dict__:
+            return self._prefetched_graph
+        from workflow.graph import cached_graph
+        return cached_graph(self)
+
+    def lineage(self):
+        """
+        Returns a list of the pks of this workflow followed by the workflow it
+        is based on, that workflow's base and so on
+        """
+        if '_lineage' not in self.__dict__:
+            self._lineage = [self.pk]
+            base_id = self.base_id
+            while base_id:
+                self._lineage.append(base_id)
+                base_id = Workflow.objects.filter(pk=base_id).values_list(
+                        'base', flat=True)[0]
+        return self._lineage
+
+    def _versioned(self, qs, hidden):
+        """
+        Restricts a query of states, transitions or events to those used by
+        this workflow (taking its lineage and the rows it hides into account)
+        """
+        if not self.base_id:
+            return qs.filter(workflow=self)
+        return qs.filter(workflow__in=self.lineage()).exclude(
+                pk__in=hidden.values_list('id', flat=True))
+
+    def effective_states(self):
+        """
+        Returns a QuerySet of the states of this workflow (some of which may
+        be shared with the workflow it is based on)
+        """
+        return self._versioned(State.objects.all(), self.hidden_states)
+
+    def effective_transitions(self):
+        """
+        Returns a QuerySet of the transitions of this workflow (some of which
+        may be shared with the workflow it is based on)
+        """
+        return self._versioned(Transition.objects.all(),
+                self.hidden_transitions)
+
+    def effective_events(self):
+        """
+        Returns a QuerySet of the events of this workflow (some of which may
+        be shared with the workflow it is based on)
+        """
+        return self._versioned(Event.objects.all(), self.hidden_events)
+
+    def new_version(self, user):
+        """
+        Returns a new version of the workflow in the DEFINITION state. Unlike
+        clone() nothing is copied: the version shares the states, transitions
+        and events of this workflow until they're changed with override() or
+        remove(). The source workflow *must* be ACTIVE or RETIRED.
+        """
+        if self.status < self.ACTIVE:
+            raise UnableToCloneWorkflow, __('Only active or retired workflows'\
+                    ' may be cloned')
+        version = Workflow(name=self.name, slug=self.slug+'_version',
+                description=self.description, status=self.DEFINITION,
+                created_by=user, cloned_from=self, base=self)
+        version.save()
+        # Whatever this workflow hides stays hidden
+        for field in ('hidden_states', 'hidden_transitions', 'hidden_events'):
+            hidden = list(getattr(self, field).all())
+            if hidden:
+                getattr(version, field).add(*hidden)
+        return version
+
+    def _check_editable(self, obj):
+        if self.status != self.DEFINITION:
+            raise UnableToEditWorkflow, __('Only workflows in definition may'\
+                    ' be changed')
+        if obj.workflow_id != self.pk and obj.workflow_id not in \
+                self.lineage():
+            raise UnableToEditWorkflow, __('Not part of this workflow')
+
+    def _hide(self, obj):
+        getattr(self, 'hidden_%ss' % obj._meta.module_name).add(obj)
+        _touch_workflow(self.pk)
+
+    def override(self, obj):
+        """
+        Returns this workflow's own copy of the referenced state, transition
+        or event which can then be changed and saved. A shared row is copied
+        (and the original hidden) the first time it is overridden: overriding
+        a state also overrides the transitions and events that reference it.
+        """
+        self._check_editable(obj)
+        if obj.workflow_id == self.pk:
+            return obj
+        copy = _copy_definition(obj, self)
+        self._hide(obj)
+        if isinstance(obj, State):
+            deadline_transition = None
+            for tr in self.effective_transitions().filter(Q(from_state=obj) |
+                    Q(to_state=obj)):
+                original_id = tr.pk
+                tr = self.override(tr)
+                if tr.from_state_id == obj.pk:
+                    tr.from_state = copy
+                if tr.to_state_id == obj.pk:
+                    tr.to_state = copy
+                tr.save()
+                if original_id == obj.deadline_transition_id:
+                    deadline_transition = tr
+            for ev in self.effective_events().filter(state=obj):
+                ev = self.override(ev)
+                ev.state = copy
+                ev.save()
+            if deadline_transition:
+                copy.deadline_transition = deadline_transition
+                copy.save()
+        elif isinstance(obj, Transition):
+            for s in self.effective_states().filter(deadline_transition=obj):
+                s = self.override(s)
+                s.deadline_transition = copy
+                s.save()
+        return copy
+
+    def remove(self, obj):
+        """
+        Removes the referenced state, transition or event from this workflow
+        (hiding it if it's shared). Removing a state also removes the
+        transitions and events that reference it.
+        """
+        self._check_editable(obj)
+        if isinstance(obj, State):
+            for tr in self.effective_transitions().filter(Q(from_state=obj) |
+                    Q(to_state=obj)):
+                self.remove(tr)
+            for ev in self.effective_events().filter(state=obj):
+                self.remove(ev)
+        elif isinstance(obj, Transition):
+            for s in self.effective_states().filter(deadline_transition=obj):
+                s = self.override(s)
+                s.deadline_transition = None
+                s.save()
+        if obj.workflow_id == self.pk:
+            obj.delete()
+        else:
+            self._hide(obj)
+
+    def get_fingerprint(self):
+        """
+        Returns a hash of the structure of the workflow (states, transitions,
+        role sets, mandatory events and estimations) that doesn't depend on
+        primary keys. Workflows with the same fingerprint are structurally
+        identical.
+
+        The fingerprint is stored when the workflow is activated (the
+        definition is frozen from that point on) otherwise it is calculated.
+        """
+        if self.fingerprint:
+            return self.fingerprint
+        from workflow.graph import load_graph, fingerprint
+        result = fingerprint(load_graph(self.pk))
+        if self.status != self.DEFINITION:
+            self.fingerprint = result
+            Workflow.objects.filter(pk=self.pk).update(fingerprint=result)
+        return result
+
+    def duplicates(self):
+        """
+        Returns a QuerySet of the other active or retired workflows that are
+        structurally identical to this one
+        """
+        return Workflow.objects.filter(fingerprint=self.get_fingerprint()
+                ).exclude(pk=self.pk)
 
     def retire(self):
         """
@@ -332,6 +708,8 @@ class Workflow(models.Model):
         """
         self.status = self.RETIRED
         self.save()
+        from workflow.diagrams import queue_prerender
+        queue_prerender(self, force=False)
 
     def clone(self, user):
         """
@@ -355,7 +733,7 @@ class Workflow(models.Model):
             clone_workflow.save()
             # Clone the states
             state_dict = dict() # key = old pk of state, val = new clone state
-            for s in self.states.all():
+            for s in self.effective_states():
                 clone_state = State()
                 clone_state.name = s.name
                 clone_state.description = s.description
@@ -364,22 +742,33 @@ class Workflow(models.Model):
                 clone_state.workflow = clone_workflow
                 clone_state.estimation_value = s.estimation_value
                 clone_state.estimation_unit = s.estimation_unit
+                clone_state.deadline_action = s.deadline_action
+                clone_state.deadline_note = s.deadline_note
                 clone_state.save()
                 for r in s.roles.all():
                     clone_state.roles.add(r)
                 state_dict[s.id] = clone_state
             # Clone the transitions
-            for tr in self.transitions.all():
+            trans_dict = dict() # key = old pk of transition, val = new clone
+            for tr in self.effective_transitions():
                 clone_trans = Transition()
                 clone_trans.name = tr.name
                 clone_trans.workflow = clone_workflow
                 clone_trans.from_state = state_dict[tr.from_state.id]
                 clone_trans.to_state = state_dict[tr.to_state.id]
+                clone_trans.guard = tr.guard
                 clone_trans.save()
                 for r in tr.roles.all():
                     clone_trans.roles.add(r)
+                trans_dict[tr.id] = clone_trans
+            for s in self.effective_states().filter(
+                    deadline_transition__isnull=False):
+                clone_state = state_dict[s.id]
+                clone_state.deadline_transition = trans_dict[
+                        s.deadline_transition_id]
+                clone_state.save()
             # Clone the events
-            for ev in self.events.all():
+            for ev in self.effective_events():
                 clone_event = Event()
                 clone_event.name = ev.name
                 clone_event.description = ev.description
@@ -426,6 +815,18 @@ class State(models.Model):
             (WEEK, _('Week(s)')),
             )
 
+    # What happens when the deadline for a state passes (the
+    # workflow_deadline_passed signal is always sent)
+    DEADLINE_SIGNAL = 1
+    DEADLINE_COMMENT = 2
+    DEADLINE_TRANSITION = 3
+
+    DEADLINE_ACTIONS = (
+            (DEADLINE_SIGNAL, _('Send a signal')),
+            (DEADLINE_COMMENT, _('Add a comment')),
+            (DEADLINE_TRANSITION, _('Make a transition')),
+            )
+
     name = models.CharField(
             _('Name'),
             max_length=256
@@ -449,7 +850,7 @@ class State(models.Model):
             related_name='states')
     # The roles defined here define *who* has permission to view the item in
     # this state.
-    roles = models.ManyToManyField(
+    roles = DefinitionManyToManyField(
             Role, 
             blank=True
             )
@@ -470,6 +871,28 @@ class State(models.Model):
             default=DAY,
             choices = DURATIONS
             )
+    # The following fields define what the deadline scheduler does when the
+    # deadline for this state passes.
+    deadline_action = models.IntegerField(
+            _('Action when the deadline passes'),
+            default=DEADLINE_SIGNAL,
+            choices=DEADLINE_ACTIONS
+            )
+    deadline_note = models.CharField(
+            _('Deadline comment'),
+            max_length=256,
+            blank=True,
+            help_text=_('The comment to add (or the note to store against the'\
+                ' transition) when the deadline passes')
+            )
+    deadline_transition = models.ForeignKey(
+            'Transition',
+            null=True,
+            blank=True,
+            related_name='deadline_states',
+            help_text=_('The transition (out of this state) to make when the'\
+                ' deadline passes')
+            )
 
     def deadline(self):
         """
@@ -490,6 +913,19 @@ class State(models.Model):
         """
         return datetime.datetime.today()
 
+    def save(self, *args, **kwargs):
+        # The deadline scheduler can only make transitions out of this state
+        if self.deadline_transition_id and not Transition.objects.filter(
+                pk=self.deadline_transition_id, from_state=self.pk):
+            raise UnableToEditWorkflow, __('The deadline transition must be'\
+                    ' a transition out of the state')
+        super(State, self).save(*args, **kwargs)
+        _touch_workflow(self.workflow_id)
+
+    def delete(self):
+        super(State, self).delete()
+        _touch_workflow(self.workflow_id)
+
     def __unicode__(self):
         return self.name
 
@@ -525,10 +961,27 @@ class Transition(models.Model):
             )
     # The roles referenced here define *who* has permission to use this 
     # transition to move between states.
-    roles = models.ManyToManyField(
+    roles = DefinitionManyToManyField(
             Role,
             blank=True
             )
+    # An optional condition (see workflow.guards) that makes the engine use
+    # this transition automatically once it is satisfied.
+    guard = models.TextField(
+            _('Guard'),
+            blank=True,
+            help_text=_('e.g. "mandatory_events_logged and \'Manager\' in'\
+                ' roles". Available names: mandatory_events_logged, events,'\
+                ' roles and seconds_in_state')
+            )
+
+    def save(self, *args, **kwargs):
+        super(Transition, self).save(*args, **kwargs)
+        _touch_workflow(self.workflow_id)
+
+    def delete(self):
+        super(Transition, self).delete()
+        _touch_workflow(self.workflow_id)
 
     def __unicode__(self):
         return self.name
@@ -537,6 +990,143 @@ class Transition(models.Model):
         verbose_name = _('Transition')
         verbose_name_plural = _('Transitions')
 
+class StateDistance(models.Model):
+    """
+    The fewest transitions needed to get from a state to an end state of a
+    workflow and the transition to take next. Calculated when the workflow is
+    activated so the distance remaining for many WorkflowActivity instances can
+    be found at once.
+    """
+    workflow = models.ForeignKey(
+            Workflow,
+            related_name='distances'
+            )
+    state = models.ForeignKey(
+            State,
+            related_name='distances'
+            )
+    distance = models.IntegerField(
+            _('Transitions to an end state')
+            )
+    # Null for end states
+    next_transition = models.ForeignKey(
+            Transition,
+            null=True,
+            related_name='distances'
+            )
+
+    class Meta:
+        verbose_name = _('State Distance')
+        verbose_name_plural = _('State Distances')
+        unique_together = ('workflow', 'state')
+
+class StateActivityCountManager(models.Manager):
+
+    def for_workflow(self, workflow):
+        """
+        Returns a dictionary (keyed by state pk) of the number of open
+        WorkflowActivity instances in each state of the workflow
+        """
+        return dict(self.filter(workflow=workflow).values_list('state',
+            'count'))
+
+    def adjust(self, workflow_id, deltas):
+        """
+        Adjusts the counts for the workflow by the deltas (a dictionary with
+        key = state pk, val = change) to take in a change already written to
+        the WorkflowHistory.
+
+        The first time a workflow's counts are adjusted they're worked out
+        from the history instead (see reconcile()) so the activities opened
+        before the counts were kept are included.
+        """
+        deltas = dict([(pk, delta) for pk, delta in deltas.items() if delta])
+        if not deltas:
+            return
+        if not self.filter(workflow=workflow_id)[:1] and \
+                self._initialise(workflow_id):
+            return
+        for state_id, delta in deltas.items():
+            self._add(workflow_id, state_id, delta)
+
+    def _initialise(self, workflow_id):
+        """
+        Works out the counts of the workflow from the history. Returns False
+        if another writer initialised them at the same time.
+        """
+        sid = transaction.savepoint()
+        try:
+            self.reconcile(Workflow.objects.get(pk=workflow_id))
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return False
+        transaction.savepoint_commit(sid)
+        return True
+
+    def _add(self, workflow_id, state_id, delta):
+        counts = self.filter(workflow=workflow_id, state=state_id)
+        if counts.update(count=models.F('count') + delta):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(workflow_id=workflow_id, state_id=state_id,
+                    count=delta)
+        except IntegrityError:
+            # Created by another writer since the update: update it instead
+            transaction.savepoint_rollback(sid)
+            counts.update(count=models.F('count') + delta)
+        else:
+            transaction.savepoint_commit(sid)
+
+    @atomic_unless_managed
+    def reconcile(self, workflow):
+        """
+        Recalculates the counts for the workflow from the WorkflowHistory and
+        returns the number of counts that were wrong
+        """
+        counts = dict([(pk, 0) for pk in workflow.effective_states(
+            ).values_list('id', flat=True)])
+        for state_id in WorkflowActivity.objects.filter(workflow=workflow,
+                completed_on__isnull=True).extra(select={
+                    'current_state_id': _current_state_sql('state_id')
+                }).values_list('current_state_id', flat=True):
+            if state_id in counts:
+                counts[state_id] += 1
+        stored = self.for_workflow(workflow)
+        wrong = len([pk for pk in counts if counts[pk] != stored.get(pk)])
+        if wrong:
+            self.filter(workflow=workflow).delete()
+            _bulk_insert(StateActivityCount, [StateActivityCount(
+                workflow_id=workflow.pk, state_id=pk, count=count) for pk,
+                count in counts.items()])
+        return wrong
+
+class StateActivityCount(models.Model):
+    """
+    The number of open (started but not completed) WorkflowActivity instances
+    in a state. Kept up to date by the engine along with the WorkflowHistory
+    record that moves an activity between states, in the same transaction.
+    """
+    workflow = models.ForeignKey(
+            Workflow,
+            related_name='state_counts'
+            )
+    state = models.ForeignKey(
+            State,
+            related_name='activity_counts'
+            )
+    count = models.IntegerField(
+            _('Open activities'),
+            default=0
+            )
+
+    objects = StateActivityCountManager()
+
+    class Meta:
+        verbose_name = _('State Activity Count')
+        verbose_name_plural = _('State Activity Counts')
+        unique_together = ('workflow', 'state')
+
 class EventType(models.Model):
     """
     Defines the types of event that can be associated with a workflow. Examples
@@ -585,7 +1175,7 @@ class Event(models.Model):
             )
     # The roles referenced here indicate *who* is supposed to be a part of the
     # event
-    roles = models.ManyToManyField(Role)
+    roles = DefinitionManyToManyField(Role)
     # The event types referenced here help define what sort of event this is.
     # For example, a meeting and review (an event might be of more than one
     # type)
@@ -599,6 +1189,14 @@ class Event(models.Model):
                     ' out of the associated state.')
             )
 
+    def save(self, *args, **kwargs):
+        super(Event, self).save(*args, **kwargs)
+        _touch_workflow(self.workflow_id)
+
+    def delete(self):
+        super(Event, self).delete()
+        _touch_workflow(self.workflow_id)
+
     def __unicode__(self):
         return self.name
 
@@ -606,6 +1204,219 @@ class Event(models.Model):
         verbose_name = _('Event')
         verbose_name_plural = _('Events')
 
+def _copy_definition(obj, workflow):
+    """
+    Saves and returns a copy of the referenced state, transition or event
+    (with the same roles and event types) that belongs to the referenced
+    workflow
+    """
+    copy = obj.__class__()
+    for field in obj._meta.fields:
+        if not field.primary_key:
+            setattr(copy, field.attname, getattr(obj, field.attname))
+    copy.workflow = workflow
+    if isinstance(obj, State):
+        # The deadline transition is out of the original state: it's set again
+        # by Workflow.override() once the transitions have been copied
+        copy.deadline_transition = None
+    copy.save()
+    for field in obj._meta.many_to_many:
+        related = list(getattr(obj, field.name).all())
+        if related:
+            getattr(copy, field.name).add(*related)
+    return copy
+
+def _evaluates_guards(method):
+    """
+    Decorates the engine methods that write to the WorkflowHistory so any
+    guarded transitions that become satisfied are made straight away (in the
+    same transaction, see atomic_unless_managed())
+    """
+    def _evaluate_guards(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._auto_progress()
+        return result
+    return atomic_unless_managed(wraps(method)(_evaluate_guards))
+
+def _current_state_sql(column):
+    """
+    Returns a correlated sub-query selecting the referenced column of the
+    latest TRANSITION record in the WorkflowHistory of each WorkflowActivity in
+    a query
+    """
+    qn = connection.ops.quote_name
+    return '(SELECT h.%s FROM %s h WHERE h.%s = %s.%s AND h.%s = %d ORDER'\
+            ' BY h.%s DESC, h.%s DESC LIMIT 1)' % (
+                qn(column),
+                qn(WorkflowHistory._meta.db_table),
+                qn('workflowactivity_id'),
+                qn(WorkflowActivity._meta.db_table),
+                qn('id'),
+                qn('log_type'),
+                WorkflowHistory.TRANSITION,
+                qn('created_on'),
+                qn('id'),
+            )
+
+class WorkflowActivityQuerySet(PrefetchingQuerySet):
+    """
+    Adds methods to annotate WorkflowActivity instances and load their
+    related data in bulk
+    """
+
+    def with_graph(self):
+        """
+        Follows the workflow of each activity and loads its WorkflowGraph (see
+        Workflow.get_graph())
+        """
+        return self.select_related('workflow').prefetch('graph')
+
+    def with_participants(self):
+        """
+        Loads the participants of each activity, along with their users and
+        roles (see WorkflowActivity.get_participants())
+        """
+        return self.prefetch('participants')
+
+    def with_current_state(self):
+        """
+        Loads the WorkflowHistory record representing the current state of
+        each activity (see WorkflowActivity.current_state())
+        """
+        return self.prefetch('current_state')
+
+    def annotate_current_state(self):
+        """
+        Annotates each instance with the current_state_id,
+        current_state_name, current_deadline and current_state_since (when
+        the state was entered) taken from the latest TRANSITION record in its
+        WorkflowHistory (all None if the activity is not started). The
+        annotations can be used with order_by().
+        """
+        state_id = _current_state_sql('state_id')
+        return self.extra(select={
+                'current_state_id': state_id,
+                'current_state_name': '(SELECT s.%s FROM %s s WHERE s.%s = %s)'\
+                    % (connection.ops.quote_name('name'),
+                        connection.ops.quote_name(State._meta.db_table),
+                        connection.ops.quote_name('id'), state_id),
+                'current_deadline': _current_state_sql('deadline'),
+                'current_state_since': _current_state_sql('created_on'),
+            }).prefetch('current_state_timestamps')
+
+    def in_current_state(self, *states):
+        """
+        Returns the activities whose current state is one of the referenced
+        states (or their pks)
+        """
+        ids = [getattr(s, 'pk', s) for s in states]
+        if not ids:
+            return self.none()
+        return self.extra(where=['%s IN (%s)' % (_current_state_sql(
+            'state_id'), ', '.join(['%s'] * len(ids)))], params=ids)
+
+    def _prefetch_current_state_timestamps(self, activities):
+        # Some backends return the values of extra selects as strings
+        for wa in activities:
+            for name in ('current_deadline', 'current_state_since'):
+                value = getattr(wa, name)
+                if isinstance(value, basestring):
+                    setattr(wa, name, typecast_timestamp(value))
+
+    def _prefetch_graph(self, activities):
+        from workflow.graph import load_graphs
+        graphs = load_graphs(set([wa.workflow_id for wa in activities]))
+        for wa in activities:
+            wa.workflow._prefetched_graph = graphs[wa.workflow_id]
+
+    def _prefetch_participants(self, activities):
+        participants = dict([(wa.pk, []) for wa in activities])
+        for p in Participant.objects.with_roles().filter(
+                workflowactivity__in=participants.keys()):
+            participants[p.workflowactivity_id].append(p)
+        for wa in activities:
+            wa._prefetched_participants = participants[wa.pk]
+
+    def _prefetch_current_state(self, activities):
+        qn = connection.ops.quote_name
+        table = qn(WorkflowHistory._meta.db_table)
+        latest = '%s.%s = (SELECT h.%s FROM %s h WHERE h.%s = %s.%s ORDER BY'\
+                ' h.%s DESC, h.%s DESC LIMIT 1)' % (table, qn('id'), qn('id'),
+                    table, qn('workflowactivity_id'), table,
+                    qn('workflowactivity_id'), qn('created_on'), qn('id'))
+        current = dict([(wh.workflowactivity_id, wh) for wh in
+            WorkflowHistory.objects.select_related('state', 'transition',
+                'event', 'participant__user').filter(
+                    workflowactivity__in=[wa.pk for wa in activities]).extra(
+                        where=[latest])])
+        for wa in activities:
+            wa._prefetched_current_state = current.get(wa.pk)
+
+    def with_distance_to_end(self):
+        """
+        Annotates each instance with distance_to_end (the fewest transitions
+        needed to get from the current state to an end state) and
+        next_transition_id (the pk of the first transition to take). Both are
+        None if the activity is not started or no end state can be reached.
+        """
+        qn = connection.ops.quote_name
+        subquery = 'SELECT d.%%s FROM %s d WHERE d.%s = %s.%s AND d.%s = %s' % (
+                qn(StateDistance._meta.db_table),
+                qn('workflow_id'),
+                qn(WorkflowActivity._meta.db_table),
+                qn('workflow_id'),
+                qn('state_id'),
+                _current_state_sql('state_id'),
+            )
+        return self.extra(select={
+                'distance_to_end': '(%s)' % (subquery % qn('distance')),
+                'next_transition_id': '(%s)' % (subquery %
+                    qn('next_transition_id')),
+            })
+
+class WorkflowActivityManager(models.Manager):
+
+    def get_query_set(self):
+        return WorkflowActivityQuerySet(self.model)
+
+    def with_distance_to_end(self):
+        return self.get_query_set().with_distance_to_end()
+
+    def with_graph(self):
+        return self.get_query_set().with_graph()
+
+    def with_participants(self):
+        return self.get_query_set().with_participants()
+
+    def with_current_state(self):
+        return self.get_query_set().with_current_state()
+
+    def annotate_current_state(self):
+        return self.get_query_set().annotate_current_state()
+
+    def in_current_state(self, *states):
+        return self.get_query_set().in_current_state(*states)
+
+    def distances_to_end(self, activities):
+        """
+        Returns a dictionary (keyed by WorkflowActivity pk) of tuples
+        containing the fewest transitions needed to get from the current state
+        to an end state and the Transition to take next (either might be None)
+        for the referenced activities (or their pks).
+        """
+        ids = [getattr(a, 'pk', a) for a in activities]
+        result = {}
+        for i in range(0, len(ids), 500):
+            result.update(dict([(a['id'], (a['distance_to_end'],
+                a['next_transition_id'])) for a in self.get_query_set().filter(
+                    pk__in=ids[i:i + 500]).with_distance_to_end().values('id',
+                        'distance_to_end', 'next_transition_id')]))
+        transitions = Transition.objects.in_bulk([t for d, t in
+            result.values() if t])
+        for pk, (distance, transition_id) in result.items():
+            result[pk] = (distance, transitions.get(transition_id))
+        return result
+
 class WorkflowActivity(models.Model):
     """
     Other models in a project reference this model so they become associated 
@@ -622,33 +1433,136 @@ class WorkflowActivity(models.Model):
             blank=True
             )
 
+    objects = WorkflowActivityManager()
+
     def current_state(self):
         """ 
         Returns the instance of the WorkflowHistory model that represents the 
         current state this WorkflowActivity is in.
         """
-        if self.history.all():
-            return self.history.all()[0]
-        else:
-            return None
+        if self._session:
+            return self._session.current_state()
+        return self._load_current_state()
 
+    def get_participants(self):
+        """
+        Returns a list of the participants in this WorkflowActivity, loaded
+        along with the activity by WorkflowActivityQuerySet.with_participants()
+        or otherwise from the database
+        """
+        if '_prefetched_participants' in self.__dict__:
+            return self._prefetched_participants
+        return list(self.participants.select_related('user'))
+
+    def distance_to_end(self):
+        """
+        Returns a tuple containing the fewest transitions needed to get from
+        the current state to an end state and the Transition to take next
+        (either might be None)
+        """
+        current_state = self.current_state()
+        if not current_state or not current_state.state:
+            return None, None
+        try:
+            d = StateDistance.objects.select_related('next_transition').get(
+                    workflow=self.workflow_id, state=current_state.state_id)
+        except StateDistance.DoesNotExist:
+            return None, None
+        return d.distance, d.next_transition
+
+    def _transitions_from(self, state):
+        """
+        Returns a QuerySet of the transitions out of the referenced state that
+        are part of this activity's version of the workflow
+        """
+        transitions = Transition.objects.filter(from_state=state)
+        if self.workflow.base_id:
+            transitions = self.workflow._versioned(transitions,
+                    self.workflow.hidden_transitions)
+        return transitions
+
+    def _mandatory_events(self, state):
+        """
+        Returns a QuerySet of the mandatory events of the referenced state
+        that are part of this activity's version of the workflow
+        """
+        events = state.events.filter(is_mandatory=True)
+        if self.workflow.base_id:
+            events = self.workflow._versioned(events,
+                    self.workflow.hidden_events)
+        return events
+
+    def available_transitions(self, user):
+        """
+        Returns a list of the transitions out of the current state that the
+        referenced user is able to use with progress()
+        """
+        current_state = self.current_state()
+        if not current_state or not current_state.state or self.completed_on:
+            return []
+        try:
+            participant = self._get_participant(user)
+        except Participant.DoesNotExist:
+            return []
+        for me in self._mandatory_events(current_state.state):
+            if not self._event_logged(me):
+                return []
+        return list(self._transitions_from(current_state.state).filter(
+            roles__in=[role.id for role in self._get_roles(participant)]
+            ).distinct().order_by('id'))
+
+    # Non-blocking versions of the engine methods for use from event driven
+    # servers. Each returns a workflow.deferred.DeferredResult and calls made
+    # on the same WorkflowActivity are run in the order they were made. They
+    # run in another thread on a copy of the activity loaded from the
+    # database (so changes such as completed_on aren't seen by the caller's
+    # instance) and won't join a batch() or transaction entered by the
+    # caller: each call is committed on its own.
+    acurrent_state = deferred('current_state')
+    aavailable_transitions = deferred('available_transitions')
+    astart = deferred('start')
+    aprogress = deferred('progress')
+    alog_event = deferred('log_event')
+    aadd_comment = deferred('add_comment')
+    aassign_role = deferred('assign_role')
+    aremove_role = deferred('remove_role')
+    aclear_roles = deferred('clear_roles')
+    adisable_participant = deferred('disable_participant')
+    aenable_participant = deferred('enable_participant')
+    aforce_stop = deferred('force_stop')
+
+    def session(self, user):
+        """
+        Returns a WorkflowSession for the referenced user. Use it in a with
+        block to cache the participants, their roles and the current state
+        whilst making several calls to the engine:
+
+            with activity.session(user) as s:
+                s.assign_role(assignee, role)
+                s.add_comment('Welcome aboard')
+
+        The cache is kept up to date by writes made through the engine. Changes
+        made elsewhere (by other requests) are not seen until the block exits.
+        """
+        return WorkflowSession(self, user)
+
+    @_evaluates_guards
     def start(self, user):
         """
         Starts a WorkflowActivity by putting it into the start state of the
         workflow defined in the "workflow" field after validating the workflow
         activity is in a state appropriate for "starting"
         """
-        participant = Participant.objects.get(workflowactivity=self, user=user,
-                disabled=False)
+        participant = self._get_participant(user)
 
-        start_state_result = State.objects.filter(
-                workflow=self.workflow, 
+        start_state_result = self.workflow.effective_states().filter(
                 is_start_state=True
                 )
         # Validation...
         # 1. The workflow activity isn't already started
-        if self.current_state():
-            if self.current_state().state:
+        current_state = self.current_state()
+        if current_state:
+            if current_state.state:
                 raise UnableToStartWorkflow, __('Already started')
         # 2. The workflow activity hasn't been force_stopped before being 
         # started
@@ -666,9 +1580,11 @@ class WorkflowActivity(models.Model):
                 note=__('Started workflow'),
                 deadline=start_state_result[0].deadline()
             )
-        first_step.save()
+        self._write_history(first_step)
+        self._adjust_counts({start_state_result[0].id: 1})
         return first_step
 
+    @_evaluates_guards
     def progress(self, transition, user, note=''):
         """
         Attempts to progress a workflow activity with the specified transition 
@@ -678,8 +1594,14 @@ class WorkflowActivity(models.Model):
         directed graph) and the method returns the new WorkflowHistory state or
         raises an UnableToProgressWorkflow exception.
         """
-        participant = Participant.objects.get(workflowactivity=self, user=user,
-                disabled=False)
+        return self._progress(transition, self._get_participant(user), note)
+
+    def _progress(self, transition, participant, note='', check_authority=True):
+        """
+        Progresses the workflow activity on behalf of the participant. The
+        deadline scheduler makes automatic transitions without checking the
+        participant's authority or the mandatory events.
+        """
         # Validate the transition
         current_state = self.current_state()
 
@@ -691,16 +1613,20 @@ class WorkflowActivity(models.Model):
         if not transition.from_state == current_state.state:
             raise UnableToProgressWorkflow, __('Transition not valid (wrong'\
                     ' parent)')
+        if self.workflow.base_id and not self._transitions_from(
+                current_state.state).filter(pk=transition.pk):
+            raise UnableToProgressWorkflow, __('Transition not valid (not'\
+                    ' part of this version of the workflow)')
         # 3. Make sure all mandatory events for the current state are found in 
         # the WorkflowHistory
-        mandatory_events = current_state.state.events.filter(is_mandatory=True)
+        mandatory_events = self._mandatory_events(current_state.state)
         for me in mandatory_events:
-            if not me.history.filter(workflowactivity=self):
+            if check_authority and not self._event_logged(me):
                 raise UnableToProgressWorkflow, __('Transition not valid'\
                     ' (mandatory event missing)')
         # 4. Make sure the user has the appropriate role to allow them to make
         # the transition
-        if not transition.roles.filter(pk__in=[role.id for role in participant.roles.all()]):
+        if check_authority and not transition.roles.filter(pk__in=[role.id for role in self._get_roles(participant)]):
             raise UnableToProgressWorkflow, __('Participant has insufficient'\
                     ' authority to use the specified transition')
         # The "progress" request has been validated to store the transition into
@@ -717,7 +1643,16 @@ class WorkflowActivity(models.Model):
                 note=note,
                 deadline=transition.to_state.deadline()
                 )
-        wh.save()
+        self._write_history(wh)
+        # Move the activity between the counts (it is no longer counted once
+        # completed)
+        deltas = {}
+        if self.completed_on is None:
+            deltas[transition.from_state_id] = -1
+            if not transition.to_state.is_end_state:
+                deltas[transition.to_state_id] = deltas.get(
+                        transition.to_state_id, 0) + 1
+        self._adjust_counts(deltas)
         # If we're at the end then mark the workflow activity as completed on
         # today
         if transition.to_state.is_end_state:
@@ -725,6 +1660,7 @@ class WorkflowActivity(models.Model):
             self.save()
         return wh
 
+    @_evaluates_guards
     def log_event(self, event, user, note=''):
         """
         Logs the occurance of an event in the WorkflowHistory of a 
@@ -736,12 +1672,14 @@ class WorkflowActivity(models.Model):
         if the event is mandatory then it must be done whilst in the
         appropriate state.
         """
-        participant = Participant.objects.get(workflowactivity=self, user=user,
-                disabled=False)
+        participant = self._get_participant(user)
         current_state = self.current_state()
-        if event.workflow:
-            # Make sure we have an event for the right workflow
-            if not event.workflow == self.workflow:
+        if event.workflow_id:
+            # Make sure we have an event for the right workflow (versions also
+            # use the events they share with the workflow they're based on)
+            if not event.workflow_id == self.workflow_id and not (
+                    self.workflow.base_id and
+                    self.workflow.effective_events().filter(pk=event.pk)):
                 raise UnableToLogWorkflowEvent, __('The event is not associated'\
                         ' with the workflow for the WorkflowActivity')
             if event.state:
@@ -754,14 +1692,13 @@ class WorkflowActivity(models.Model):
                                 ' state')
         if event.roles.all():
             # Make sure the participant is associated with the event
-            if not event.roles.filter(pk__in=[p.id for p in participant.roles.all()]):
+            if not event.roles.filter(pk__in=[p.id for p in self._get_roles(participant)]):
                 raise UnableToLogWorkflowEvent, __('The participant is not'\
                         ' associated with the specified event')
         if not note:
             note=event.name
         # Good to go...
-        current_state = self.current_state().state if self.current_state() else None
-        deadline = self.current_state().deadline if self.current_state() else None
+        current_state, deadline = self._current_position()
         wh = WorkflowHistory(
                 workflowactivity=self,
                 state=current_state,
@@ -771,9 +1708,10 @@ class WorkflowActivity(models.Model):
                 note=note,
                 deadline=deadline
                 )
-        wh.save()
+        self._write_history(wh)
         return wh
 
+    @_evaluates_guards
     def add_comment(self, user, note):
         """
         In many sorts of workflow it is necessary to add a comment about
@@ -781,10 +1719,8 @@ class WorkflowActivity(models.Model):
         """
         if not note:
             raise UnableToAddCommentToWorkflow, __('Cannot add an empty comment')
-        p, created = Participant.objects.get_or_create(workflowactivity=self,
-                user=user)  
-        current_state = self.current_state().state if self.current_state() else None
-        deadline = self.current_state().deadline if self.current_state() else None
+        p = self._get_or_create_participant(user)
+        current_state, deadline = self._current_position()
         wh = WorkflowHistory(
                 workflowactivity=self,
                 state=current_state,
@@ -793,24 +1729,23 @@ class WorkflowActivity(models.Model):
                 note=note,
                 deadline=deadline
                 )
-        wh.save()
+        self._write_history(wh)
         return wh
 
+    @_evaluates_guards
     def assign_role(self, user, assignee, role):
         """
         Assigns the role to the assignee for this instance of a workflow 
         activity. The arg 'user' logs who made the assignment
         """
-        p_as_user = Participant.objects.get(workflowactivity=self, user=user,
-                disabled=False)
-        p_as_assignee, created = Participant.objects.get_or_create(
-                workflowactivity=self,
-                user=assignee)
-        p_as_assignee.roles.add(role)
+        p_as_user = self._get_participant(user)
+        p_as_assignee = self._get_or_create_participant(assignee)
+        self._add_role(p_as_assignee, role)
+        self._record_role_changes(p_as_user, p_as_assignee,
+                RoleChange.ASSIGNED, [role])
         name = assignee.get_full_name() if assignee.get_full_name() else assignee.username
         note = _('Role "%s" assigned to %s')%(role.__unicode__(), name)
-        current_state = self.current_state().state if self.current_state() else None
-        deadline = self.current_state().deadline if self.current_state() else None
+        current_state, deadline = self._current_position()
         wh = WorkflowHistory(
                 workflowactivity=self,
                 state=current_state,
@@ -819,26 +1754,25 @@ class WorkflowActivity(models.Model):
                 note=note,
                 deadline=deadline
                 )
-        wh.save()
-        role_assigned.send(sender=wh)
+        self._write_history(wh, role_assigned)
         return wh
 
+    @_evaluates_guards
     def remove_role(self, user, assignee, role):
         """
         Removes the role from the assignee. The 'user' argument is used for
         logging purposes.
         """
         try:
-            p_as_user = Participant.objects.get(workflowactivity=self, 
-                        user=user, disabled=False)
-            p_as_assignee = Participant.objects.get(workflowactivity=self, 
-                    user=assignee)
-            if role in p_as_assignee.roles.all():
-                p_as_assignee.roles.remove(role)
+            p_as_user = self._get_participant(user)
+            p_as_assignee = self._get_participant(assignee, enabled_only=False)
+            if role in self._get_roles(p_as_assignee):
+                self._remove_role(p_as_assignee, role)
+                self._record_role_changes(p_as_user, p_as_assignee,
+                        RoleChange.REMOVED, [role])
                 name = assignee.get_full_name() if assignee.get_full_name() else assignee.username
                 note = _('Role "%s" removed from %s')%(role.__unicode__(), name)
-                current_state = self.current_state().state if self.current_state() else None
-                deadline = self.current_state().deadline if self.current_state() else None
+                current_state, deadline = self._current_position()
                 wh = WorkflowHistory(
                         workflowactivity=self,
                         state=current_state,
@@ -847,8 +1781,7 @@ class WorkflowActivity(models.Model):
                         note=note,
                         deadline=deadline
                         )
-                wh.save()
-                role_removed.send(sender=wh)
+                self._write_history(wh, role_removed)
                 return wh
             else:
                 # The role isn't associated with the assignee anyway so there is
@@ -859,21 +1792,22 @@ class WorkflowActivity(models.Model):
             # nothing to do
             return None 
 
+    @_evaluates_guards
     def clear_roles(self, user, assignee):
         """
         Clears all the roles from assignee. The 'user' argument is used for
         logging purposes.
         """
         try:
-            p_as_user = Participant.objects.get(workflowactivity=self, 
-                        user=user, disabled=False)
-            p_as_assignee = Participant.objects.get(workflowactivity=self, 
-                    user=assignee)
-            p_as_assignee.roles.clear()
+            p_as_user = self._get_participant(user)
+            p_as_assignee = self._get_participant(assignee, enabled_only=False)
+            held = list(self._get_roles(p_as_assignee))
+            self._clear_roles(p_as_assignee)
+            self._record_role_changes(p_as_user, p_as_assignee,
+                    RoleChange.CLEARED, held)
             name = assignee.get_full_name() if assignee.get_full_name() else assignee.username
             note = _('All roles removed from %s')%name
-            current_state = self.current_state().state if self.current_state() else None
-            deadline = self.current_state().deadline if self.current_state() else None
+            current_state, deadline = self._current_position()
             wh = WorkflowHistory(
                         workflowactivity=self,
                         state=current_state,
@@ -882,13 +1816,13 @@ class WorkflowActivity(models.Model):
                         note=note,
                         deadline=deadline
                         )
-            wh.save()
-            role_removed.send(sender=wh)
+            self._write_history(wh, role_removed)
             return wh
         except ObjectDoesNotExist:
             # If we can't find the assignee then there is nothing to do
             pass
 
+    @_evaluates_guards
     def disable_participant(self, user, user_to_disable, note):
         """
         Mark the user_to_disable as disabled. Must include a note explaining
@@ -899,17 +1833,16 @@ class WorkflowActivity(models.Model):
             raise UnableToDisableParticipant, __('Must supply a reason for'\
                     ' disabling a participant. None given.')
         try:
-            p_as_user = Participant.objects.get(workflowactivity=self, 
-                            user=user, disabled=False)
-            p_to_disable = Participant.objects.get(workflowactivity=self, 
-                    user=user_to_disable)
+            p_as_user = self._get_participant(user)
+            p_to_disable = self._get_participant(user_to_disable, enabled_only=False)
             if not p_to_disable.disabled:
                 p_to_disable.disabled = True
                 p_to_disable.save()
+                self._record_role_changes(p_as_user, p_to_disable,
+                        RoleChange.DISABLED, None)
                 name = user_to_disable.get_full_name() if user_to_disable.get_full_name() else user_to_disable.username
                 note = _('Participant %s disabled with the reason: %s')%(name, note)
-                current_state = self.current_state().state if self.current_state() else None
-                deadline = self.current_state().deadline if self.current_state() else None
+                current_state, deadline = self._current_position()
                 wh = WorkflowHistory(
                             workflowactivity=self,
                             state=current_state,
@@ -918,7 +1851,7 @@ class WorkflowActivity(models.Model):
                             note=note,
                             deadline=deadline
                             )
-                wh.save()
+                self._write_history(wh)
                 return wh
             else:
                 # They're already disabled
@@ -927,6 +1860,7 @@ class WorkflowActivity(models.Model):
             # If we can't find the assignee then there is nothing to do
             return None 
     
+    @_evaluates_guards
     def enable_participant(self, user, user_to_enable, note):
         """
         Mark the user_to_enable as enabled. Must include a note explaining
@@ -937,18 +1871,17 @@ class WorkflowActivity(models.Model):
             raise UnableToEnableParticipant, __('Must supply a reason for'\
                     ' enabling a disabled participant. None given.')
         try:
-            p_as_user = Participant.objects.get(workflowactivity=self, 
-                            user=user, disabled=False)
-            p_to_enable = Participant.objects.get(workflowactivity=self, 
-                    user=user_to_enable)
+            p_as_user = self._get_participant(user)
+            p_to_enable = self._get_participant(user_to_enable, enabled_only=False)
             if p_to_enable.disabled:
                 p_to_enable.disabled = False 
                 p_to_enable.save()
+                self._record_role_changes(p_as_user, p_to_enable,
+                        RoleChange.ENABLED, None)
                 name = user_to_enable.get_full_name() if user_to_enable.get_full_name() else user_to_enable.username
                 note = _('Participant %s enabled with the reason: %s')%(name, 
                         note)
-                current_state = self.current_state().state if self.current_state() else None
-                deadline = self.current_state().deadline if self.current_state() else None
+                current_state, deadline = self._current_position()
                 wh = WorkflowHistory(
                             workflowactivity=self,
                             state=current_state,
@@ -957,7 +1890,7 @@ class WorkflowActivity(models.Model):
                             note=note,
                             deadline=deadline
                             )
-                wh.save()
+                self._write_history(wh)
                 return wh
             else:
                 # The participant is already enabled
@@ -966,6 +1899,7 @@ class WorkflowActivity(models.Model):
             # If we can't find the participant then there is nothing to do
             return None 
 
+    @atomic_unless_managed
     def force_stop(self, user, reason):
         """
         Should a WorkflowActivity need to be abandoned this method cleanly logs
@@ -974,9 +1908,7 @@ class WorkflowActivity(models.Model):
         """
         # Lets try to create an appropriate entry in the WorkflowHistory table
         current_state = self.current_state()
-        participant = Participant.objects.get(
-                        workflowactivity=self, 
-                        user=user)
+        participant = self._get_participant(user, enabled_only=False)
         if current_state:
             final_step = WorkflowHistory(
                 workflowactivity=self,
@@ -986,11 +1918,228 @@ class WorkflowActivity(models.Model):
                 note=__('Workflow forced to stop! Reason given: %s') % reason,
                 deadline=None
                 )
-            final_step.save()
+            self._write_history(final_step)
+            if current_state.state and self.completed_on is None:
+                self._adjust_counts({current_state.state_id: -1})
 
         self.completed_on = datetime.datetime.today()
         self.save()
 
+    def _auto_progress(self, limit=10):
+        """
+        Makes the transitions whose guards are satisfied (on behalf of the
+        participant who made the latest change) until none are, up to limit
+        transitions. Returns the number of transitions made.
+
+        Within a WorkflowBatch the guards are checked once the batch has been
+        written.
+        """
+        from workflow.guards import satisfied_transition
+        batch = current_batch()
+        if batch:
+            batch._guarded[self.pk] = self
+            return 0
+        made = 0
+        while made < limit:
+            transition_id = satisfied_transition(self)
+            if not transition_id:
+                break
+            self._progress(Transition.objects.get(id=transition_id),
+                    self.current_state().participant, check_authority=False)
+            made += 1
+        return made
+
+    @atomic_unless_managed
+    def _deadline_passed(self, wh):
+        """
+        Called by the deadline scheduler when the deadline recorded by the
+        referenced WorkflowHistory record (the current state) has passed.
+        Carries out the state's deadline action on behalf of the participant
+        who entered the state and sends the workflow_deadline_passed signal.
+
+        Raises IntegrityError if the deadline has already been dealt with.
+        """
+        DeadlineEscalation(workflowhistory=wh).save()
+        state = wh.state
+        if state.deadline_action == State.DEADLINE_COMMENT:
+            current_state, deadline = self._current_position()
+            comment = WorkflowHistory(
+                    workflowactivity=self,
+                    state=current_state,
+                    log_type=WorkflowHistory.COMMENT,
+                    participant=wh.participant,
+                    note=state.deadline_note or __('Deadline passed'),
+                    deadline=deadline
+                    )
+            self._write_history(comment)
+        elif state.deadline_action == State.DEADLINE_TRANSITION and \
+                state.deadline_transition_id:
+            self._progress(state.deadline_transition, wh.participant,
+                    state.deadline_note, check_authority=False)
+        workflow_deadline_passed.send(sender=wh)
+        self._auto_progress()
+
+    def _load_current_state(self):
+        """
+        Fetches the latest WorkflowHistory record (or None) taking into account
+        records waiting to be flushed by a WorkflowBatch
+        """
+        batch = current_batch()
+        if batch and self.pk in batch._latest:
+            return batch._latest[self.pk]
+        if '_prefetched_current_state' in self.__dict__:
+            return self._prefetched_current_state
+        try:
+            return self.history.all()[0]
+        except IndexError:
+            return None
+
+    def _current_position(self):
+        """
+        Returns a tuple containing the current state and deadline (either of
+        which might be None) to be stored against a new WorkflowHistory record
+        """
+        current_state = self.current_state()
+        if current_state:
+            return current_state.state, current_state.deadline
+        return None, None
+
+    def _get_participant(self, user, enabled_only=True):
+        """
+        Returns the Participant referencing the user for this WorkflowActivity.
+        Raises Participant.DoesNotExist if there isn't one (or if it is
+        disabled and enabled_only is True)
+        """
+        if self._session:
+            return self._session._get_participant(user, enabled_only)
+        if enabled_only:
+            return Participant.objects.get(workflowactivity=self, user=user,
+                    disabled=False)
+        return Participant.objects.get(workflowactivity=self, user=user)
+
+    def _get_or_create_participant(self, user):
+        """
+        Returns the Participant referencing the user for this WorkflowActivity
+        creating it if required
+        """
+        if self._session:
+            return self._session._get_or_create_participant(user)
+        p, created = Participant.objects.get_or_create(workflowactivity=self,
+                user=user)
+        return p
+
+    def _get_roles(self, participant):
+        """
+        Returns a list of the roles currently held by the participant
+        """
+        if self._session:
+            return self._session._get_roles(participant)
+        return self._load_roles(participant)
+
+    def _load_roles(self, participant):
+        """
+        Fetches the roles held by the participant taking into account changes
+        waiting to be flushed by a WorkflowBatch
+        """
+        batch = current_batch()
+        if batch:
+            return batch._get_roles(participant)
+        return list(participant.roles.all())
+
+    def _add_role(self, participant, role):
+        batch = current_batch()
+        if batch:
+            batch._add_role(participant, role)
+        else:
+            participant.roles.add(role)
+        self._roles_changed(participant)
+
+    def _remove_role(self, participant, role):
+        batch = current_batch()
+        if batch:
+            batch._remove_role(participant, role)
+        else:
+            participant.roles.remove(role)
+        self._roles_changed(participant)
+
+    def _clear_roles(self, participant):
+        batch = current_batch()
+        if batch:
+            batch._clear_roles(participant)
+        else:
+            participant.roles.clear()
+        self._roles_changed(participant)
+
+    def _record_role_changes(self, changed_by, participant, action, roles):
+        """
+        Writes a RoleChange for each of the roles (or a single one without a
+        role if roles is None). Within a WorkflowBatch they're written when
+        the batch is flushed.
+        """
+        if roles is None:
+            roles = [None]
+        changes = [RoleChange(workflowactivity=self, participant=participant,
+            user_id=participant.user_id, role=role, action=action,
+            changed_by=changed_by) for role in roles]
+        batch = current_batch()
+        if batch:
+            batch._role_changes.extend(changes)
+        else:
+            for change in changes:
+                change.save()
+
+    def _roles_changed(self, participant):
+        """
+        To be called once the roles of the participant have been changed
+        """
+        if self._session:
+            self._session._roles_changed(participant)
+
+    def _event_logged(self, event):
+        """
+        Returns a boolean to indicate if the event has been logged in the
+        history of this WorkflowActivity
+        """
+        batch = current_batch()
+        if batch and batch._event_logged(self, event):
+            return True
+        return bool(event.history.filter(workflowactivity=self))
+
+    def _adjust_counts(self, deltas):
+        """
+        Adjusts the StateActivityCount records of the workflow by the deltas
+        (key = state pk, val = change)
+        """
+        batch = current_batch()
+        if batch:
+            batch._adjust_counts(self.workflow_id, deltas)
+        else:
+            StateActivityCount.objects.adjust(self.workflow_id, deltas)
+
+    def _write_history(self, wh, *signals):
+        """
+        Saves the new WorkflowHistory record (which becomes the current state)
+        and then sends the referenced signals with the record as sender.
+
+        Within a WorkflowBatch the record is queued and the signals are sent
+        once the batch is flushed.
+        """
+        # Anything loaded by WorkflowActivityQuerySet is now out of date
+        for name in ('_prefetched_current_state', '_prefetched_participants'):
+            self.__dict__.pop(name, None)
+        batch = current_batch()
+        if batch:
+            batch._add_history(self, wh, signals)
+        else:
+            _save_with_outbox(wh, signals)
+            for signal in signals:
+                signal.send(sender=wh)
+        if self._session:
+            self._session._history_written(wh)
+
+    # The WorkflowSession (if any) currently caching lookups for this instance
+    _session = None
+
     class Meta:
         ordering = ['-completed_on', '-created_on']
         verbose_name = _('Workflow Activity')
@@ -1000,6 +2149,32 @@ class WorkflowActivity(models.Model):
                 ('can_assign_roles',__('Can assign roles'))
             )
 
+class ParticipantQuerySet(PrefetchingQuerySet):
+    """
+    Adds methods to load data related to Participant instances in bulk
+    """
+
+    def with_roles(self):
+        """
+        Follows the user and loads the roles of each participant (see
+        Participant.get_roles())
+        """
+        return self.select_related('user').prefetch('roles')
+
+    def _prefetch_roles(self, participants):
+        roles = _m2m_related(Participant, 'roles', [p.pk for p in
+            participants])
+        for p in participants:
+            p._prefetched_roles = roles[p.pk]
+
+class ParticipantManager(models.Manager):
+
+    def get_query_set(self):
+        return ParticipantQuerySet(self.model)
+
+    def with_roles(self):
+        return self.get_query_set().with_roles()
+
 class Participant(models.Model):
     """
     Defines which users have what roles in a particular run of a workflow
@@ -1016,10 +2191,23 @@ class Participant(models.Model):
             )
     disabled = models.BooleanField(default=False)
 
+    objects = ParticipantManager()
+
+    def get_roles(self):
+        """
+        Returns a list of the participant's roles, loaded along with the
+        participant by ParticipantQuerySet.with_roles() or otherwise from the
+        database
+        """
+        if '_prefetched_roles' in self.__dict__:
+            return self._prefetched_roles
+        return list(self.roles.all())
+
     def __unicode__(self):
-        name = self.user.get_full_name() if self.user.get_full_name() else self.user.username
-        if self.roles.all():
-            roles = u' - ' + u', '.join([r.__unicode__() for r in self.roles.all()])
+        name = self.user.get_full_name() or self.user.username
+        roles = self.get_roles()
+        if roles:
+            roles = u' - ' + u', '.join([r.__unicode__() for r in roles])
         else:
             roles = '' 
         disabled = _(' (disabled)') if self.disabled else ''
@@ -1031,6 +2219,36 @@ class Participant(models.Model):
         verbose_name_plural = _('Participants')
         unique_together = ('user', 'workflowactivity')
 
+class WorkflowHistoryQuerySet(PrefetchingQuerySet):
+    """
+    Adds methods to load data related to WorkflowHistory instances in bulk
+    """
+
+    def with_history_related(self):
+        """
+        Follows the activity (and its workflow), state, transition, event and
+        participant (and their user) of each record and loads the roles of the
+        participants so displaying the records needs no further queries
+        """
+        return self.select_related('workflowactivity__workflow', 'state',
+                'transition', 'event', 'participant__user').prefetch(
+                    'participant_roles')
+
+    def _prefetch_participant_roles(self, records):
+        ids = set([wh.participant_id for wh in records if wh.participant_id])
+        roles = _m2m_related(Participant, 'roles', list(ids))
+        for wh in records:
+            if wh.participant_id:
+                wh.participant._prefetched_roles = roles[wh.participant_id]
+
+class WorkflowHistoryManager(models.Manager):
+
+    def get_query_set(self):
+        return WorkflowHistoryQuerySet(self.model)
+
+    def with_history_related(self):
+        return self.get_query_set().with_history_related()
+
 class WorkflowHistory(models.Model):
     """
     Records what has happened and when in a particular run of a workflow. The
@@ -1092,24 +2310,46 @@ class WorkflowHistory(models.Model):
             _('Deadline'),
             null=True,
             blank=True,
+            db_index=True,
             help_text=_('The deadline for staying in this state')
             )
 
+    objects = WorkflowHistoryManager()
+
     def save(self):
         workflow_pre_change.send(sender=self)
         super(WorkflowHistory, self).save()
-        workflow_post_change.send(sender=self)
+        self._send_post_save_signals()
+
+    def _post_save_signals(self):
+        """
+        Returns a list of (name, signal, sender) tuples for the signals
+        announcing this record has been written to the database
+        """
+        signals = [('post_change', workflow_post_change, self)]
         if self.log_type==self.TRANSITION:
-            workflow_transitioned.send(sender=self)
+            signals.append(('transitioned', workflow_transitioned, self))
         if self.log_type==self.EVENT:
-            workflow_event_completed.send(sender=self)
+            signals.append(('event_completed', workflow_event_completed,
+                self))
         if self.log_type==self.COMMENT:
-            workflow_commented.send(sender=self)
+            signals.append(('commented', workflow_commented, self))
         if self.state:
             if self.state.is_start_state:
-                workflow_started.send(sender=self.workflowactivity)
+                signals.append(('started', workflow_started,
+                    self.workflowactivity))
             elif self.state.is_end_state:
-                workflow_ended.send(sender=self.workflowactivity)
+                signals.append(('ended', workflow_ended,
+                    self.workflowactivity))
+        return signals
+
+    def _send_post_save_signals(self):
+        """
+        Sends the signals announcing this record has been written to the
+        database
+        """
+        for name, signal, sender in self._post_save_signals():
+            signal.send(sender=sender)
 
     def __unicode__(self):
         return u"%s created by %s"%(self.note, self.participant.__unicode__())
@@ -1118,3 +2358,613 @@ class WorkflowHistory(models.Model):
         ordering = ['-created_on']
         verbose_name = _('Workflow History')
         verbose_name_plural = _('Workflow Histories')
+
+class RoleChangeQuerySet(QuerySet):
+    """
+    Adds methods to work out who held which roles when
+    """
+
+    def as_of(self, when=None):
+        """
+        Returns the latest change to each participant's holding of each role
+        made on or before the referenced time (defaulting to now)
+        """
+        when = when or datetime.datetime.now()
+        qn = connection.ops.quote_name
+        table = qn(RoleChange._meta.db_table)
+        latest = '%s.id = (SELECT MAX(r.id) FROM %s r WHERE r.%s = %s.%s AND'\
+                ' r.%s = %s.%s AND r.%s <= %%s)' % (table, table,
+                        qn('participant_id'), table, qn('participant_id'),
+                        qn('role_id'), table, qn('role_id'),
+                        qn('created_on'))
+        return self.filter(role__isnull=False, created_on__lte=when).extra(
+                where=[latest], params=[when])
+
+    def held(self, role=None, when=None):
+        """
+        Returns the assignments of the referenced role (or of any role) that
+        were still in place at the referenced time (defaulting to now)
+        """
+        changes = self
+        if role:
+            changes = changes.filter(role=role)
+        return changes.as_of(when).filter(action=RoleChange.ASSIGNED)
+
+class RoleChangeManager(models.Manager):
+
+    def get_query_set(self):
+        return RoleChangeQuerySet(self.model)
+
+    def as_of(self, when=None):
+        return self.get_query_set().as_of(when)
+
+    def held(self, role=None, when=None):
+        return self.get_query_set().held(role, when)
+
+    def holders(self, role, when=None, activity=None):
+        """
+        Returns a QuerySet of the users who held the role (in the referenced
+        WorkflowActivity or in any activity) at the referenced time
+        (defaulting to now)
+        """
+        changes = self.get_query_set()
+        if activity:
+            changes = changes.filter(workflowactivity=activity)
+        ids = set(changes.held(role, when).values_list('user', flat=True))
+        return User.objects.filter(id__in=list(ids))
+
+    def intervals(self, **filters):
+        """
+        Returns a list of (participant pk, role pk, started on, ended on)
+        tuples for the periods during which roles were held, filtered by the
+        referenced lookups (e.g. user=, participant=, role= or
+        workflowactivity=) and ordered by when they started. "ended on" is
+        None for roles that are still held.
+        """
+        result = []
+        # key = (participant pk, role pk), val = index into result
+        started = {}
+        for participant_id, role_id, action, created_on in self.filter(
+                role__isnull=False, **filters).order_by('id').values_list(
+                        'participant', 'role', 'action', 'created_on'):
+            key = (participant_id, role_id)
+            if action == RoleChange.ASSIGNED:
+                if key not in started:
+                    started[key] = len(result)
+                    result.append([participant_id, role_id, created_on,
+                        None])
+            elif key in started:
+                result[started.pop(key)][3] = created_on
+        return [tuple(interval) for interval in result]
+
+class RoleChange(models.Model):
+    """
+    A structured record of a change to the roles held by (or the status of) a
+    participant, written by the engine along with the ROLE record in the
+    WorkflowHistory. Unlike the note in the history these can be queried to
+    find out who held which roles when (see RoleChangeManager) and they're
+    kept when old ROLE records are pruned.
+    """
+
+    # The sort of changes recorded
+    ASSIGNED = 1
+    REMOVED = 2
+    CLEARED = 3
+    DISABLED = 4
+    ENABLED = 5
+
+    ACTION_CHOICE_LIST = (
+            (ASSIGNED, _('Assigned')),
+            (REMOVED, _('Removed')),
+            (CLEARED, _('Cleared')),
+            (DISABLED, _('Disabled')),
+            (ENABLED, _('Enabled')),
+            )
+
+    workflowactivity = models.ForeignKey(
+            WorkflowActivity,
+            related_name='role_changes'
+            )
+    participant = models.ForeignKey(
+            Participant,
+            related_name='role_changes',
+            help_text=_('The participant whose roles changed')
+            )
+    # The participant's user (so a user's changes are found without a join)
+    user = models.ForeignKey(
+            User,
+            related_name='workflow_role_changes'
+            )
+    # Not set when a participant is disabled or enabled
+    role = models.ForeignKey(
+            Role,
+            null=True,
+            related_name='changes'
+            )
+    action = models.IntegerField(
+            help_text=_('What happened to the role'),
+            choices=ACTION_CHOICE_LIST
+            )
+    changed_by = models.ForeignKey(
+            Participant,
+            related_name='role_changes_made',
+            help_text=_('The participant who made the change')
+            )
+    created_on = models.DateTimeField(
+            auto_now_add=True,
+            db_index=True
+            )
+
+    objects = RoleChangeManager()
+
+    def __unicode__(self):
+        return u"%s %s %s" % (self.get_action_display(),
+                self.role and self.role.__unicode__() or u'',
+                self.user.get_full_name() or self.user.username)
+
+    class Meta:
+        ordering = ['-created_on']
+        verbose_name = _('Role Change')
+        verbose_name_plural = _('Role Changes')
+
+class DeadlineEscalation(models.Model):
+    """
+    Records that the deadline scheduler has dealt with the deadline recorded
+    against a WorkflowHistory record (so it is only dealt with once)
+    """
+    workflowhistory = models.ForeignKey(
+            WorkflowHistory,
+            unique=True,
+            related_name='escalations'
+            )
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('Deadline Escalation')
+        verbose_name_plural = _('Deadline Escalations')
+
+class SchedulerCheckpoint(models.Model):
+    """
+    The point in time up to which the deadline scheduler has dealt with all
+    the deadlines. The scheduler carries on from here after a restart.
+    """
+    name = models.CharField(
+            _('Name'),
+            max_length=64,
+            unique=True
+            )
+    position = models.DateTimeField(
+            _('Position')
+            )
+
+    class Meta:
+        verbose_name = _('Scheduler Checkpoint')
+        verbose_name_plural = _('Scheduler Checkpoints')
+
+class ConformanceCheckpoint(models.Model):
+    """
+    The pk of the last WorkflowActivity whose history has been checked by a
+    run of the check_conformance command. The next run carries on from here.
+    """
+    name = models.CharField(
+            _('Name'),
+            max_length=64,
+            unique=True
+            )
+    position = models.IntegerField(
+            _('Position'),
+            default=0
+            )
+    updated_on = models.DateTimeField(
+            auto_now=True
+            )
+
+    class Meta:
+        verbose_name = _('Conformance Checkpoint')
+        verbose_name_plural = _('Conformance Checkpoints')
+
+class OutboxMessage(models.Model):
+    """
+    A notification (named after the signal it stands in for) waiting to be
+    delivered to the handlers registered with workflow.outbox. Written in the
+    same transaction as the WorkflowHistory record it describes so it exists
+    if and only if the change does.
+    """
+    workflowactivity = models.ForeignKey(
+            WorkflowActivity,
+            related_name='outbox'
+            )
+    kind = models.CharField(
+            _('Kind'),
+            max_length=32
+            )
+    payload = models.TextField(
+            _('Payload')
+            )
+    created_on = models.DateTimeField(auto_now_add=True)
+    available_on = models.DateTimeField(
+            _('Available on'),
+            default=datetime.datetime.now,
+            db_index=True,
+            help_text=_('When the message can next be claimed for delivery')
+            )
+    claimed_by = models.CharField(
+            _('Claimed by'),
+            max_length=64,
+            blank=True
+            )
+    attempts = models.IntegerField(
+            _('Attempts'),
+            default=0
+            )
+    last_error = models.TextField(
+            _('Last error'),
+            blank=True
+            )
+    delivered_on = models.DateTimeField(
+            _('Delivered on'),
+            null=True,
+            blank=True,
+            db_index=True
+            )
+
+    def data(self):
+        """
+        Returns the decoded payload
+        """
+        return simplejson.loads(self.payload)
+
+    def __unicode__(self):
+        return u"%s (activity %s)" % (self.kind, self.workflowactivity_id)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = _('Outbox Message')
+        verbose_name_plural = _('Outbox Messages')
+
+def _outbox_messages(wh, signals):
+    """
+    Returns a list of unsaved OutboxMessage instances for the newly written
+    WorkflowHistory record: one for each signal (apart from post_change) sent
+    about it. Returns an empty list unless settings.WORKFLOW_OUTBOX is True.
+    """
+    if not getattr(settings, 'WORKFLOW_OUTBOX', False):
+        return []
+    kinds = [name for name, signal, sender in wh._post_save_signals() if
+            name != 'post_change']
+    for name, signal in (('role_assigned', role_assigned), ('role_removed',
+            role_removed)):
+        if signal in signals:
+            kinds.append(name)
+    if not kinds:
+        return []
+    activity = wh.workflowactivity
+    payload = simplejson.dumps({
+            'workflowactivity': activity.pk,
+            'workflow': activity.workflow_id,
+            'log_type': wh.log_type,
+            'state': wh.state_id,
+            'transition': wh.transition_id,
+            'event': wh.event_id,
+            'user': wh.participant.user_id,
+            'note': wh.note,
+            'created_on': wh.created_on and wh.created_on.strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            'deadline': wh.deadline and wh.deadline.strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            })
+    return [OutboxMessage(workflowactivity=activity, kind=kind,
+        payload=payload) for kind in kinds]
+
+##############
+# Unit of work
+##############
+
+@atomic_unless_managed
+def _save_with_outbox(wh, signals):
+    """
+    Saves the WorkflowHistory record and the OutboxMessages standing in for
+    the signals in the same transaction
+    """
+    wh.save()
+    for message in _outbox_messages(wh, signals):
+        message.save()
+
+class WorkflowSession(object):
+    """
+    An identity map for a WorkflowActivity. Whilst the session is in use (see
+    WorkflowActivity.session()) participants, their roles and the current state
+    are looked up only once and the engine keeps them up to date as it writes
+    to the database.
+
+    The engine methods are available with the user bound to that of the
+    session.
+    """
+
+    def __init__(self, activity, user):
+        self.activity = activity
+        self.user = user
+        self._previous = None
+        self.clear()
+
+    def __enter__(self):
+        self._previous = self.activity._session
+        self.activity._session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.activity._session = self._previous
+        self._previous = None
+        self.clear()
+        return False
+
+    def clear(self):
+        """
+        Empties the identity map so subsequent lookups hit the database
+        """
+        # key = user pk, val = Participant
+        self._participants = {}
+        # key = participant pk, val = list of Role instances
+        self._roles = {}
+        self._current_state = None
+        self._current_state_loaded = False
+
+    def current_state(self):
+        if not self._current_state_loaded:
+            self._current_state = self.activity._load_current_state()
+            self._current_state_loaded = True
+        return self._current_state
+
+    def start(self):
+        return self.activity.start(self.user)
+
+    def progress(self, transition, note=''):
+        return self.activity.progress(transition, self.user, note)
+
+    def log_event(self, event, note=''):
+        return self.activity.log_event(event, self.user, note)
+
+    def add_comment(self, note):
+        return self.activity.add_comment(self.user, note)
+
+    def assign_role(self, assignee, role):
+        return self.activity.assign_role(self.user, assignee, role)
+
+    def remove_role(self, assignee, role):
+        return self.activity.remove_role(self.user, assignee, role)
+
+    def clear_roles(self, assignee):
+        return self.activity.clear_roles(self.user, assignee)
+
+    def disable_participant(self, user_to_disable, note):
+        return self.activity.disable_participant(self.user, user_to_disable,
+                note)
+
+    def enable_participant(self, user_to_enable, note):
+        return self.activity.enable_participant(self.user, user_to_enable,
+                note)
+
+    def force_stop(self, reason):
+        return self.activity.force_stop(self.user, reason)
+
+    def _get_participant(self, user, enabled_only=True):
+        key = getattr(user, 'pk', user)
+        if not key in self._participants:
+            self._participants[key] = Participant.objects.get(
+                    workflowactivity=self.activity, user=user)
+        participant = self._participants[key]
+        if enabled_only and participant.disabled:
+            raise Participant.DoesNotExist('Participant matching query does'\
+                    ' not exist.')
+        return participant
+
+    def _get_or_create_participant(self, user):
+        key = getattr(user, 'pk', user)
+        if not key in self._participants:
+            p, created = Participant.objects.get_or_create(
+                    workflowactivity=self.activity, user=user)
+            self._participants[key] = p
+        return self._participants[key]
+
+    def _get_roles(self, participant):
+        if not participant.pk in self._roles:
+            self._roles[participant.pk] = self.activity._load_roles(participant)
+        return self._roles[participant.pk]
+
+    def _roles_changed(self, participant):
+        self._roles.pop(participant.pk, None)
+
+    def _history_written(self, wh):
+        # The latest record in the history *is* the current state
+        self._current_state = wh
+        self._current_state_loaded = True
+
+# Holds the WorkflowBatch (if any) in use by the current thread
+_local = threading.local()
+
+def current_batch():
+    """
+    Returns the WorkflowBatch in use by the current thread (or None)
+    """
+    return getattr(_local, 'batch', None)
+
+def batch(size=None):
+    """
+    Returns a WorkflowBatch for use in a with block. Whilst the block runs any
+    WorkflowHistory records and participant role changes made by the engine are
+    validated and kept in memory. They are written to the database in bulk when
+    the block exits (or every "size" records if given) after which the
+    signals that would have been sent are delivered in order:
+
+        with batch():
+            for row in rows:
+                activity.add_comment(user, row['comment'])
+
+    Because the records are inserted in bulk the WorkflowHistory instances
+    sent as signal senders do not have a primary key.
+    """
+    return WorkflowBatch(size)
+
+def _bulk_insert(model, objects):
+    """
+    Inserts the unsaved model instances with a single prepared statement.
+    Primary keys are not set on the instances.
+    """
+    if not objects:
+        return
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not isinstance(f,
+        models.AutoField)]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(model._meta.db_table),
+            ', '.join([qn(f.column) for f in fields]),
+            ', '.join(['%s'] * len(fields))
+            )
+    params = [[f.get_db_prep_save(f.pre_save(obj, True)) for f in fields] for
+            obj in objects]
+    connection.cursor().executemany(sql, params)
+    transaction.commit_unless_managed()
+    # Raw SQL isn't seen by the database routers
+    pin_to_primary()
+
+class WorkflowBatch(object):
+    """
+    Collects the writes the engine would make so they can be flushed to the
+    database in bulk. See batch().
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self._previous = None
+        self.clear()
+
+    def __enter__(self):
+        self._previous = current_batch()
+        if self._previous:
+            # Nested batches join the outer batch
+            return self._previous
+        _local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._previous:
+            self._previous = None
+            return False
+        _local.batch = None
+        if exc_type:
+            self.clear()
+        else:
+            self.flush()
+        return False
+
+    def clear(self):
+        """
+        Discards everything waiting to be written
+        """
+        # A list of (WorkflowHistory, signals) tuples in the order they were
+        # added
+        self._history = []
+        # key = WorkflowActivity pk, val = most recent WorkflowHistory
+        self._latest = {}
+        # (WorkflowActivity pk, Event pk) tuples for the events logged
+        self._events = set()
+        # key = participant pk, val = list of Role instances held
+        self._roles = {}
+        # key = participant pk, val = set of role pks held in the database
+        self._stored_roles = {}
+        # key = workflow pk, val = dictionary of StateActivityCount deltas
+        self._counts = {}
+        # key = WorkflowActivity pk, val = instance with guards to check
+        self._guarded = {}
+        # RoleChange instances to be written
+        self._role_changes = []
+
+    def flush(self):
+        """
+        Writes the collected history and role changes to the database in a
+        single transaction and then sends the signals for each record in the
+        order they were added.
+        """
+        history = self._history
+        guarded = self._guarded.values()
+        for wh, signals in history:
+            workflow_pre_change.send(sender=wh)
+        self._write()
+        self.clear()
+        for wh, signals in history:
+            wh._send_post_save_signals()
+            for signal in signals:
+                signal.send(sender=wh)
+        for activity in guarded:
+            activity._auto_progress()
+
+    @atomic_unless_managed
+    def _write(self):
+        _bulk_insert(WorkflowHistory, [wh for wh, signals in self._history])
+        messages = []
+        for wh, signals in self._history:
+            messages.extend(_outbox_messages(wh, signals))
+        _bulk_insert(OutboxMessage, messages)
+        _bulk_insert(RoleChange, self._role_changes)
+        for workflow_id, deltas in self._counts.items():
+            StateActivityCount.objects.adjust(workflow_id, deltas)
+        field = Participant._meta.get_field('roles')
+        qn = connection.ops.quote_name
+        added = []
+        removed = []
+        for participant_pk, roles in self._roles.items():
+            current = set([r.pk for r in roles])
+            stored = self._stored_roles[participant_pk]
+            added.extend([(participant_pk, r) for r in current - stored])
+            removed.extend([(participant_pk, r) for r in stored - current])
+        cursor = connection.cursor()
+        if removed:
+            cursor.executemany('DELETE FROM %s WHERE %s = %%s AND %s = %%s' % (
+                    qn(field.m2m_db_table()),
+                    qn(field.m2m_column_name()),
+                    qn(field.m2m_reverse_name())
+                    ), removed)
+        if added:
+            cursor.executemany('INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (
+                    qn(field.m2m_db_table()),
+                    qn(field.m2m_column_name()),
+                    qn(field.m2m_reverse_name())
+                    ), added)
+        transaction.commit_unless_managed()
+        pin_to_primary()
+
+    def _add_history(self, activity, wh, signals):
+        self._history.append((wh, signals))
+        self._latest[activity.pk] = wh
+        if wh.event_id:
+            self._events.add((activity.pk, wh.event_id))
+        if self.size and len(self._history) >= self.size:
+            self.flush()
+
+    def _event_logged(self, activity, event):
+        return (activity.pk, event.pk) in self._events
+
+    def _adjust_counts(self, workflow_id, deltas):
+        counts = self._counts.setdefault(workflow_id, {})
+        for state_id, delta in deltas.items():
+            counts[state_id] = counts.get(state_id, 0) + delta
+
+    def _get_roles(self, participant):
+        if not participant.pk in self._roles:
+            roles = list(participant.roles.all())
+            self._roles[participant.pk] = roles
+            self._stored_roles[participant.pk] = set([r.pk for r in roles])
+        return self._roles[participant.pk]
+
+    def _add_role(self, participant, role):
+        roles = self._get_roles(participant)
+        if not role in roles:
+            roles.append(role)
+
+    def _remove_role(self, participant, role):
+        roles = self._get_roles(participant)
+        if role in roles:
+            roles.remove(role)
+
+    def _clear_roles(self, participant):
+        del self._get_roles(participant)[:]
@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+"""
+Delivery of the messages written to the outbox (see OutboxMessage) to the
+handlers registered for each kind of message.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+from django.conf import settings
+from django.db import connection
+from workflow.models import OutboxMessage
+import datetime
+import traceback
+import uuid
+
+# The longest a claimed message is held by a worker before another can claim
+# it (i.e. the time a delivery attempt is allowed to take)
+LEASE = datetime.timedelta(seconds=getattr(settings, 'WORKFLOW_OUTBOX_LEASE',
+    300))
+
+# The longest wait between attempts to deliver a failing message (seconds)
+MAX_BACKOFF = 3600
+
+# key = kind of message, val = list of handlers
+_handlers = {}
+
+def register(kind, handler):
+    """
+    Registers the callable to be called with each OutboxMessage of the kind
+    (named after the signal it stands in for: "transitioned", "ended" etc).
+    Messages may be delivered more than once so handlers should be idempotent.
+    """
+    handlers = _handlers.setdefault(kind, [])
+    if handler not in handlers:
+        handlers.append(handler)
+
+def unregister(kind, handler):
+    if handler in _handlers.get(kind, []):
+        _handlers[kind].remove(handler)
+
+class InProcessHandler(object):
+    """
+    A handler that keeps the messages delivered to it in memory. Stands in
+    for an integration in tests. It raises an exception for the first "fail"
+    messages it is given.
+    """
+    def __init__(self, fail=0):
+        self.fail = fail
+        self.messages = []
+
+    def __call__(self, message):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError('Delivery failed')
+        self.messages.append(message)
+
+def claim(limit=100):
+    """
+    Claims up to limit messages for delivery and returns them. Only the oldest
+    undelivered message of each WorkflowActivity is claimed so messages are
+    delivered in order. A message stays claimed until it is delivered, the
+    attempt fails or the lease expires (so workers that die don't lose
+    messages). Messages claimed by other workers are skipped.
+    """
+    now = datetime.datetime.now()
+    qn = connection.ops.quote_name
+    table = qn(OutboxMessage._meta.db_table)
+    activity = qn(OutboxMessage._meta.get_field('workflowactivity').column)
+    head = '%s.id = (SELECT MIN(o.id) FROM %s o WHERE o.%s = %s.%s AND'\
+            ' o.delivered_on IS NULL)' % (table, table, activity, table,
+                    activity)
+    pending = OutboxMessage.objects.filter(delivered_on__isnull=True,
+            available_on__lte=now)
+    ids = list(pending.extra(where=[head]).values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+    # The condition is checked again as the rows are updated so when workers
+    # race for a message only one of them gets it
+    token = uuid.uuid4().hex
+    pending.filter(id__in=ids).update(claimed_by=token,
+            available_on=now + LEASE)
+    return list(OutboxMessage.objects.filter(id__in=ids, claimed_by=token))
+
+def deliver(message):
+    """
+    Calls the handlers registered for the message. Returns True and marks it
+    as delivered if they all succeed, otherwise records the error and makes
+    it available for another attempt after an exponential backoff.
+    """
+    messages = OutboxMessage.objects.filter(id=message.id)
+    try:
+        for handler in list(_handlers.get(message.kind, [])):
+            handler(message)
+    except Exception:
+        message.attempts += 1
+        message.last_error = traceback.format_exc()
+        message.available_on = datetime.datetime.now() + datetime.timedelta(
+                seconds=min(2 ** message.attempts, MAX_BACKOFF))
+        message.claimed_by = ''
+        messages.update(attempts=message.attempts,
+                last_error=message.last_error,
+                available_on=message.available_on, claimed_by='')
+        return False
+    message.delivered_on = datetime.datetime.now()
+    message.claimed_by = ''
+    messages.update(delivered_on=message.delivered_on, claimed_by='')
+    return True
+
+def deliver_pending(limit=100):
+    """
+    Claims and delivers messages until there are none left that are ready to
+    be delivered. Returns a tuple containing the number of messages delivered
+    and the number of failed attempts.
+    """
+    delivered = failed = 0
+    while True:
+        messages = claim(limit)
+        if not messages:
+            return delivered, failed
+        for message in messages:
+            if deliver(message):
+                delivered += 1
+            else:
+                failed += 1
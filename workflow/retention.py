@@ -0,0 +1,195 @@
+# -*- coding: UTF-8 -*-
+"""
+Retention of the WorkflowHistory: old records of the log types that no
+activity depends on are deleted in small batches.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+# python
+import datetime
+import time
+
+# django
+from django.conf import settings
+from django.db import connection, transaction
+
+# project
+from workflow.models import WorkflowHistory, DeadlineEscalation, Event,\
+        atomic_unless_managed
+
+# key = name used in a retention policy, val = log type. TRANSITION records
+# are never pruned: they're what the current state of an activity is worked
+# out from.
+LOG_TYPES = {
+        'event': WorkflowHistory.EVENT,
+        'role': WorkflowHistory.ROLE,
+        'comment': WorkflowHistory.COMMENT,
+    }
+
+# The number of primary keys covered by each batch
+BATCH_SIZE = 500
+
+# A rough size (in bytes) of the fixed width columns of a WorkflowHistory row
+# used to estimate the space reclaimed (the note is measured)
+ROW_BYTES = 56
+
+class InvalidRetentionPolicy(Exception):
+    """
+    Raised when a retention policy names a log type that can't be pruned or
+    gives an age that isn't a positive number of days
+    """
+
+def get_policy():
+    """
+    Returns the retention policy set in settings.py as
+    WORKFLOW_HISTORY_RETENTION: a dictionary of the number of days to keep
+    records of each log type for (e.g. {'comment': 365, 'role': 90}). Log
+    types that aren't mentioned are kept for ever.
+    """
+    return getattr(settings, 'WORKFLOW_HISTORY_RETENTION', {})
+
+def cutoffs(policy, now=None):
+    """
+    Returns a dictionary (keyed by log type) of the time before which records
+    of each log type in the referenced policy may be pruned
+    """
+    now = now or datetime.datetime.now()
+    result = {}
+    for name, days in policy.items():
+        if name not in LOG_TYPES:
+            raise InvalidRetentionPolicy, 'Records of the log type "%s"'\
+                    ' can\'t be pruned (only %s)' % (name, ', '.join(
+                        sorted(LOG_TYPES)))
+        try:
+            days = float(days)
+        except (TypeError, ValueError):
+            days = 0
+        if days <= 0:
+            raise InvalidRetentionPolicy, 'The records of the log type "%s"'\
+                    ' must be kept for a positive number of days' % name
+        result[LOG_TYPES[name]] = now - datetime.timedelta(days=days)
+    return result
+
+def _candidates(cutoffs, first, last):
+    """
+    Returns a list of the pk, log type and length of the note of the records
+    with pks between first and last (inclusive) that are older than the
+    cutoff for their log type. Records that aren't older than the latest
+    TRANSITION of their activity are kept as the latest record of an
+    activity holds its current state and deadline. Records of mandatory
+    events are always kept: the engine (and the conformance checker) looks
+    for them anywhere in the history, so an activity that loops back into a
+    state relies on the event logged on an earlier visit. So are records with
+    deadline escalations against them.
+    """
+    qn = connection.ops.quote_name
+    table = qn(WorkflowHistory._meta.db_table)
+    activity = qn(WorkflowHistory._meta.get_field('workflowactivity').column)
+    escalations = qn(DeadlineEscalation._meta.db_table)
+    escalated = qn(DeadlineEscalation._meta.get_field(
+        'workflowhistory').column)
+    events = qn(Event._meta.db_table)
+    event = qn(WorkflowHistory._meta.get_field('event').column)
+    types = []
+    params = [first, last]
+    for log_type, cutoff in sorted(cutoffs.items()):
+        types.append('(h.log_type = %s AND h.created_on < %s)')
+        params.extend([log_type, cutoff])
+    params.extend([WorkflowHistory.TRANSITION, True])
+    cursor = connection.cursor()
+    cursor.execute('SELECT h.id, h.log_type, LENGTH(h.note) FROM %s h WHERE'\
+            ' h.id BETWEEN %%s AND %%s AND (%s) AND h.id < (SELECT MAX(t.id)'\
+            ' FROM %s t WHERE t.%s = h.%s AND t.log_type = %%s) AND NOT'\
+            ' EXISTS (SELECT 1 FROM %s e WHERE e.%s = h.id) AND NOT EXISTS'\
+            ' (SELECT 1 FROM %s m WHERE m.id = h.%s AND m.is_mandatory = %%s)'\
+            % (table, ' OR '.join(types), table, activity, activity,
+                escalations, escalated, events, event), params)
+    return cursor.fetchall()
+
+@atomic_unless_managed
+def _delete(ids):
+    """
+    Deletes the records with the referenced pks with plain DELETE statements
+    (nothing references the pruned records so there's nothing to cascade to)
+    """
+    table = connection.ops.quote_name(WorkflowHistory._meta.db_table)
+    cursor = connection.cursor()
+    # Keeps within the number of parameters a statement may have (999 for
+    # sqlite)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (table,
+            ', '.join(['%s'] * len(chunk))), chunk)
+    transaction.set_dirty()
+
+def prune_history(policy=None, batch_size=BATCH_SIZE, pause=0, now=None,
+        dry_run=False):
+    """
+    Deletes the WorkflowHistory records that are older than the retention
+    policy (see get_policy()) allows. The table is worked through in ranges
+    of batch_size primary keys, oldest first, each deleted in its own short
+    transaction (unless the caller manages one) with a pause (in seconds) in
+    between so other writers aren't held up. Stops at the first range that is
+    too new to have anything to prune.
+
+    Returns a dictionary (keyed by log type) of the number of records and
+    the estimated number of bytes reclaimed. Nothing is deleted if dry_run
+    is True.
+    """
+    if policy is None:
+        policy = get_policy()
+    limits = cutoffs(policy, now)
+    reclaimed = dict([(log_type, [0, 0]) for log_type in limits])
+    if not limits:
+        return reclaimed
+    newest = max(limits.values())
+    first = 0
+    while True:
+        # Skips gaps in the pks (e.g. left by earlier runs)
+        head = list(WorkflowHistory.objects.filter(id__gte=first).order_by(
+            'id').values_list('id', 'created_on')[:1])
+        if not head or head[0][1] >= newest:
+            return reclaimed
+        first = head[0][0]
+        last = first + batch_size - 1
+        rows = _candidates(limits, first, last)
+        if rows:
+            for pk, log_type, length in rows:
+                reclaimed[log_type][0] += 1
+                reclaimed[log_type][1] += ROW_BYTES + (length or 0)
+            if not dry_run:
+                _delete([pk for pk, log_type, length in rows])
+                if pause:
+                    time.sleep(pause)
+        first = last + 1
@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+"""
+Database routers for the workflow application: read replicas.
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+from django.conf import settings
+import threading
+
+# Routers are consulted by Django 1.2 onwards (settings.DATABASE_ROUTERS) and
+# are inert on earlier versions where everything uses the default database.
+
+_local = threading.local()
+
+def _primary():
+    return getattr(settings, 'WORKFLOW_PRIMARY_DB', 'default')
+
+def _replica():
+    return getattr(settings, 'WORKFLOW_REPLICA_DB', 'replica')
+
+def _is_workflow_model(model):
+    return model._meta.app_label == 'workflow'
+
+def pin_to_primary():
+    """
+    Makes subsequent reads made by this thread go to the primary database so
+    it sees its own writes (replicas may lag behind)
+    """
+    _local.pinned = True
+
+def unpin():
+    """
+    Lets reads made by this thread go to the replica again. Called at the end
+    of every request by the middleware.
+    """
+    _local.pinned = False
+
+def is_pinned():
+    return getattr(_local, 'pinned', False)
+
+class ReplicaRouter(object):
+    """
+    Sends reads of workflow models to settings.WORKFLOW_REPLICA_DB (default
+    "replica") and writes to settings.WORKFLOW_PRIMARY_DB (default "default").
+    Once a thread has written, its reads stick to the primary until unpin() is
+    called so users see their own transitions straight away. Add
+    workflow.middleware.PrimaryStickinessMiddleware to unpin at the end of
+    each request.
+    """
+    def db_for_read(self, model, **hints):
+        if not _is_workflow_model(model):
+            return None
+        if is_pinned():
+            return _primary()
+        return _replica()
+
+    def db_for_write(self, model, **hints):
+        if not _is_workflow_model(model):
+            return None
+        pin_to_primary()
+        return _primary()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both databases hold the same data
+        if _is_workflow_model(type(obj1)) or _is_workflow_model(type(obj2)):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        # The replica is populated by replication
+        if not _is_workflow_model(model):
+            return None
+        return db == _primary()
@@ -0,0 +1,219 @@
+# -*- coding: UTF-8 -*-
+"""
+A long running scheduler that deals with WorkflowHistory deadlines as they
+pass (see State.deadline_action).
+
+Copyright (c) 2009 Nicholas H.Tollervey (http://ntoll.org/contact)
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice,
+this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+notice, this list of conditions and the following disclaimer in
+the documentation and/or other materials provided with the
+distribution.
+* Neither the name of ntoll.org nor the names of its
+contributors may be used to endorse or promote products
+derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+from django.db import IntegrityError
+from django.db.models import Max
+from workflow.models import WorkflowHistory, SchedulerCheckpoint,\
+        DeadlineEscalation, UnableToProgressWorkflow, UnableToLogWorkflowEvent,\
+        UnableToAddCommentToWorkflow, atomic_unless_managed
+import collections
+import datetime
+import heapq
+import logging
+
+logger = logging.getLogger('workflow.scheduler')
+
+# The exceptions the engine raises when it refuses a change
+ENGINE_ERRORS = (UnableToProgressWorkflow, UnableToLogWorkflowEvent,
+        UnableToAddCommentToWorkflow)
+
+def _mark_escalated(wh):
+    if not DeadlineEscalation.objects.filter(workflowhistory=wh):
+        DeadlineEscalation(workflowhistory=wh).save()
+
+class DeadlineScheduler(object):
+    """
+    Keeps the deadlines due within the next "horizon" in a min-heap. The
+    window is extended (using the index on WorkflowHistory.deadline) as time
+    passes and newly written records are picked up incrementally by pk, so
+    the scheduler never reads the whole table. A record can be committed
+    after records with higher pks (by up to "slack") so the pks written
+    during the slack before the last refresh are scanned again on each
+    refresh. Only TRANSITION records carry
+    a deadline worth acting upon (it is set when a state is entered) and a
+    deadline is only acted upon if the record is still the current state of
+    an open WorkflowActivity.
+
+    The time up to which all deadlines have been dealt with is saved as a
+    SchedulerCheckpoint so deadlines that pass whilst the scheduler isn't
+    running are dealt with when it starts again.
+    """
+
+    def __init__(self, name='default', horizon=datetime.timedelta(hours=1),
+            now=datetime.datetime.now, slack=datetime.timedelta(minutes=5)):
+        self.name = name
+        self.horizon = horizon
+        self.now = now
+        self.slack = slack
+        # Entries are (deadline, WorkflowHistory pk)
+        self.heap = []
+        self.queued = set()
+        self.position = None
+        self.window_end = None
+        self.last_id = None
+        # (time, last pk) of the recent refreshes
+        self.marks = collections.deque()
+
+    def _candidates(self):
+        return WorkflowHistory.objects.filter(
+                log_type=WorkflowHistory.TRANSITION,
+                deadline__isnull=False,
+                workflowactivity__completed_on__isnull=True
+                )
+
+    def _push(self, rows):
+        for pk, deadline in rows:
+            if pk not in self.queued:
+                self.queued.add(pk)
+                heapq.heappush(self.heap, (deadline, pk))
+
+    def start(self):
+        """
+        Loads the deadlines between the checkpoint (or now if there isn't one)
+        and the end of the horizon
+        """
+        now = self.now()
+        try:
+            self.position = SchedulerCheckpoint.objects.get(
+                    name=self.name).position
+        except SchedulerCheckpoint.DoesNotExist:
+            self.position = now
+        self.last_id = WorkflowHistory.objects.aggregate(
+                last_id=Max('id'))['last_id'] or 0
+        # The pks written during the slack before now may not all be
+        # committed yet
+        since_id = WorkflowHistory.objects.filter(
+                created_on__lte=now - self.slack).order_by('-id').values_list(
+                        'id', flat=True)[:1]
+        self.marks = collections.deque([(now - self.slack, since_id and
+            since_id[0] or 0), (now, self.last_id)])
+        self.window_end = now + self.horizon
+        self._push(self._candidates().filter(deadline__gt=self.position,
+            deadline__lte=self.window_end).values_list('id', 'deadline'))
+
+    def refresh(self):
+        """
+        Adds the deadlines of records written since the last refresh (and
+        those of records with pks written during the slack before it that
+        have yet to be dealt with) and extends the window to the horizon
+        """
+        now = self.now()
+        last_id = WorkflowHistory.objects.aggregate(
+                last_id=Max('id'))['last_id'] or 0
+        # Records committed since the last refresh got their pks after the
+        # slack before it
+        while len(self.marks) > 1 and self.marks[1][0] <= \
+                self.marks[-1][0] - self.slack:
+            self.marks.popleft()
+        since_id = self.marks[0][1]
+        if last_id > since_id:
+            self._push(self._candidates().filter(id__gt=since_id,
+                id__lte=last_id, deadline__lte=self.window_end,
+                escalations__isnull=True).values_list('id', 'deadline'))
+        self.marks.append((now, last_id))
+        self.last_id = last_id
+        window_end = now + self.horizon
+        if window_end > self.window_end:
+            self._push(self._candidates().filter(deadline__gt=self.window_end,
+                deadline__lte=window_end).values_list('id', 'deadline'))
+            self.window_end = window_end
+
+    def fire(self, pk):
+        """
+        Deals with the passed deadline of the referenced WorkflowHistory
+        record. Returns True if the deadline action was carried out. Deadline
+        actions the engine refuses are logged and skipped.
+        """
+        try:
+            wh = WorkflowHistory.objects.select_related('state',
+                    'workflowactivity', 'participant').get(id=pk)
+        except WorkflowHistory.DoesNotExist:
+            return False
+        activity = wh.workflowactivity
+        if activity.completed_on:
+            return False
+        current = activity.history.filter(
+                log_type=WorkflowHistory.TRANSITION).order_by('-created_on',
+                        '-id').values_list('id', flat=True)[:1]
+        if list(current) != [wh.id]:
+            # The activity has moved on
+            return False
+        try:
+            # Each deadline is dealt with in a transaction of its own
+            atomic_unless_managed(activity._deadline_passed)(wh)
+        except IntegrityError:
+            # Already dealt with (by another scheduler or before a restart)
+            return False
+        except ENGINE_ERRORS:
+            # e.g. a deadline transition that isn't valid from the state. It
+            # is marked as dealt with so the scheduler moves on rather than
+            # failing on the same record every time it's restarted.
+            logger.exception('Unable to carry out the deadline action for'\
+                    ' WorkflowHistory %d', wh.pk)
+            atomic_unless_managed(_mark_escalated)(wh)
+            return False
+        return True
+
+    def run_once(self):
+        """
+        Refreshes the heap, deals with the deadlines that have passed and
+        saves the checkpoint. Returns the number of deadline actions carried
+        out.
+        """
+        self.refresh()
+        now = self.now()
+        fired = 0
+        while self.heap and self.heap[0][0] <= now:
+            deadline, pk = heapq.heappop(self.heap)
+            self.queued.discard(pk)
+            if self.fire(pk):
+                fired += 1
+        self.position = now
+        updated = SchedulerCheckpoint.objects.filter(name=self.name).update(
+                position=now)
+        if not updated:
+            SchedulerCheckpoint(name=self.name, position=now).save()
+        return fired
+
+    def next_deadline(self):
+        """
+        Returns the earliest deadline in the heap (or None)
+        """
+        if self.heap:
+            return self.heap[0][0]
+        return None
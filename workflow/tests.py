@@ -214,3 +214,16 @@ Author: Nicholas H.Tollervey
 from unit_tests.test_views import *
 from unit_tests.test_models import *
 from unit_tests.test_forms import *
+from unit_tests.test_graph import *
+from unit_tests.test_commands import *
+from unit_tests.test_diff import *
+from unit_tests.test_deferred import *
+from unit_tests.test_routers import *
+from unit_tests.test_outbox import *
+from unit_tests.test_scheduler import *
+from unit_tests.test_guards import *
+from unit_tests.test_admin import *
+from unit_tests.test_analytics import *
+from unit_tests.test_conformance import *
+from unit_tests.test_discovery import *
+from unit_tests.test_retention import *
@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+Admin tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# django
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.http import HttpRequest
+from django.test import TestCase
+
+# project
+from workflow.models import *
+from workflow import admin as workflow_admin
+
+class AdminTestCase(TestCase):
+        """
+        Testing the admin classes
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def _request(self, **get):
+            request = HttpRequest()
+            request.user = User.objects.get(id=1)
+            request.path = '/admin/workflow/workflowactivity/1/'
+            request.GET.update(get)
+            return request
+
+        def test_estimated_count(self):
+            """
+            Makes sure unfiltered lists of large tables are counted with an
+            estimate
+            """
+            model_admin = workflow_admin.WorkflowHistoryAdmin(WorkflowHistory,
+                    admin.site)
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            Participant(user=u, workflowactivity=wa).save()
+            for i in range(3):
+                wa.add_comment(u, 'test')
+            qs = model_admin.queryset(self._request())
+            self.assertEqual(3, qs.count())
+            workflow_admin.EXACT_COUNT_BELOW = 0
+            try:
+                # Without the database's statistics the largest pk is used
+                WorkflowHistory.objects.filter(id__lt=wa.history.all()[0].id
+                        ).delete()
+                self.assertEqual(3, qs.count())
+                self.assertEqual(1, qs.filter(id=wa.history.all()[0].id).count())
+            finally:
+                workflow_admin.EXACT_COUNT_BELOW = 10000
+            self.assertEqual(1, qs.count())
+
+        def test_activity_current_state(self):
+            """
+            Makes sure the list of activities shows their current state
+            without a query per activity
+            """
+            model_admin = workflow_admin.WorkflowActivityAdmin(
+                    WorkflowActivity, admin.site)
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            Participant(user=u, workflowactivity=wa).save()
+            wa.start(u)
+            obj = model_admin.queryset(self._request()).get(id=wa.id)
+            self.assertEqual(u'Start State', model_admin.current_state(obj))
+
+        def test_scoped_foreign_keys(self):
+            """
+            Makes sure the choices of states are those of the workflow being
+            edited
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            clone = w.clone(User.objects.get(id=1))
+            model_admin = workflow_admin.TransitionAdmin(Transition, admin.site)
+            t = clone.transitions.all()[0]
+            form = model_admin.get_form(self._request(), t)()
+            self.assertEqual(list(clone.states.all().order_by('id')), list(
+                form.fields['from_state'].queryset.order_by('id')))
+            form = model_admin.get_form(self._request(workflow=str(w.id)))()
+            self.assertEqual(list(w.states.all().order_by('id')), list(
+                form.fields['to_state'].queryset.order_by('id')))
+            # Without a workflow a raw-id widget is used
+            form = model_admin.get_form(self._request())()
+            # (wrapped to add the "add another" link)
+            self.assertEqual(True, isinstance(form.fields['to_state'
+                ].widget.widget, admin.widgets.ForeignKeyRawIdWidget))
+            model_admin = workflow_admin.StateAdmin(State, admin.site)
+            s = State.objects.get(id=3)
+            form = model_admin.get_form(self._request(), s)()
+            self.assertEqual([3, 4], [t.id for t in form.fields[
+                'deadline_transition'].queryset.order_by('id')])
+
+        def test_workflow_history_view(self):
+            """
+            Makes sure the history of an activity is shown a page at a time
+            """
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=Workflow.objects.get(id=1),
+                    created_by=u)
+            wa.save()
+            Participant(user=u, workflowactivity=wa).save()
+            for i in range(workflow_admin.HISTORY_PER_PAGE + 1):
+                wa.add_comment(u, 'comment %d' % i)
+            model_admin = workflow_admin.WorkflowActivityAdmin(WorkflowActivity,
+                    admin.site)
+            response = model_admin.workflow_history_view(self._request(),
+                    str(wa.id))
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(True, 'comment %d' %
+                    workflow_admin.HISTORY_PER_PAGE in response.content)
+            self.assertEqual(False, 'comment 0<' in response.content)
+            self.assertEqual(True, 'Page 1 of 2' in response.content)
+            response = model_admin.workflow_history_view(self._request(
+                page='2'), str(wa.id))
+            self.assertEqual(True, 'comment 0<' in response.content)
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+Analytics tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import calendar
+import unittest
+
+# django
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.analytics import *
+from workflow import analytics
+
+class AnalyticsTestCase(TestCase):
+        """
+        Testing the analysis of the WorkflowHistory
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            self.workflow = Workflow.objects.get(id=1)
+            self.workflow.activate()
+            self.user = User.objects.get(id=1)
+            self.role = Role.objects.get(id=1)
+
+        def _activity(self):
+            wa = WorkflowActivity(workflow=self.workflow, created_by=self.user)
+            wa.save()
+            p = Participant(user=self.user, workflowactivity=wa)
+            p.save()
+            p.roles.add(self.role)
+            wa.start(self.user)
+            return wa
+
+        def test_load_history(self):
+            """
+            Makes sure the history is loaded into columns grouped by activity
+            """
+            wa1 = self._activity()
+            wa2 = self._activity()
+            wa3 = self._activity()
+            wa1.progress(Transition.objects.get(id=1), self.user)
+            wa2.add_comment(self.user, 'a comment')
+            wa1.log_event(Event.objects.get(id=1), self.user)
+            for chunk_size in (1, 2, CHUNK_SIZE):
+                columns = load_history(chunk_size=chunk_size)
+                self.assertEqual(WorkflowHistory.objects.count(), len(columns))
+                self.assertEqual([(wa1.id, 0, 3), (wa2.id, 3, 5),
+                    (wa3.id, 5, 6)], list(columns.groups()))
+            wh = wa1.history.get(log_type=WorkflowHistory.TRANSITION,
+                    transition=1)
+            self.assertEqual((wa1.id, WorkflowHistory.TRANSITION, 2, 1, 0,
+                wh.participant_id, calendar.timegm(wh.created_on.timetuple())
+                + wh.created_on.microsecond / 1000000.0), columns.row(1))
+            self.assertEqual([WorkflowHistory.TRANSITION,
+                WorkflowHistory.COMMENT], list(columns.log_type[3:5]))
+            self.assertEqual(True, columns.nbytes() / len(columns) < 50)
+            # Only the history of the referenced activities
+            columns = load_history(WorkflowActivity.objects.exclude(
+                id=wa2.id), chunk_size=2)
+            self.assertEqual([(wa1.id, 0, 3), (wa3.id, 3, 4)],
+                    list(columns.groups()))
+            self.assertEqual([], list(load_history(
+                WorkflowActivity.objects.none()).groups()))
+
+        def _progress(self, wa, *transition_ids):
+            for pk in transition_ids:
+                if pk == 2:
+                    wa.log_event(Event.objects.get(id=1), self.user)
+                wa.progress(Transition.objects.get(id=pk), self.user)
+
+        @unittest.skipIf(analytics.numpy is None, 'NumPy is not installed')
+        def test_transition_model(self):
+            """
+            Makes sure the Markov model is estimated from the transitions taken
+            and can be updated incrementally
+            """
+            self._progress(self._activity(), 1, 2, 3, 6)
+            self._progress(self._activity(), 1, 2, 4, 8, 10, 11)
+            wa = self._activity()
+            self._progress(wa, 1, 2)
+            model = TransitionModel(self.workflow)
+            self.assertEqual(12, model.update())
+            self.assertEqual(0, model.update())
+            counts = model.counts()
+            self.assertEqual(3, counts[model.states.index(1),
+                model.states.index(2)])
+            self.assertEqual(12, counts.sum())
+            p = model.transition_probabilities()
+            self.assertEqual((1.0, 0.5, 0.5, 0.0), (p[1], p[3], p[4], p[5]))
+            self.assertEqual({7: 0.5, 9: 0.5},
+                    model.absorption_probabilities())
+            visits = model.expected_visits()
+            self.assertEqual((1.0, 1.0, 0.5), (round(visits[1], 6),
+                round(visits[3], 6), round(visits[8], 6)))
+            self.assertEqual({}, model.expected_visits(7))
+            self.assertEqual({7: 1.0, 9: 0.0},
+                    model.absorption_probabilities(7))
+            # Incremental updates
+            self._progress(wa, 3)
+            self.assertEqual(1, model.update())
+            p = model.transition_probabilities()
+            self.assertEqual((2, 1), (round(p[3] * 3), round(p[4] * 3)))
+            # The same counts from the columnar history
+            other = TransitionModel(self.workflow)
+            other.add_columns(load_history(WorkflowActivity.objects.filter(
+                workflow=self.workflow)))
+            self.assertEqual(model.transition_counts.tolist(),
+                    other.transition_counts.tolist())
+            # Transitions that aren't part of the workflow are ignored
+            before = other.transition_counts.sum()
+            other.add([0, 1, 10 ** 9, 1])
+            self.assertEqual(before + 2, other.transition_counts.sum())
+            self.assertEqual(2, other.transition_counts[
+                other.transitions.index(1)] - model.transition_counts[
+                    model.transitions.index(1)])
+
+        @unittest.skipIf(analytics.numpy is None, 'NumPy is not installed')
+        def test_transition_model_closed_loop(self):
+            """
+            Makes sure a loop that has never been left is absorbing rather
+            than leaving the model without a solution
+            """
+            self._progress(self._activity(), 1, 2, 3, 5, 2)
+            model = TransitionModel(self.workflow)
+            model.update()
+            self.assertEqual(1.0, model.absorption_probabilities()[2])
+            self.assertEqual({1: 1.0}, model.expected_visits())
@@ -0,0 +1,331 @@
+# -*- coding: UTF-8 -*-
+"""
+Management command tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import datetime
+import os
+import shutil
+import tempfile
+
+# django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import simplejson
+
+# project
+from workflow.models import *
+from workflow import diagrams
+from workflow.deferred import InlineExecutor, get_executor, set_executor
+
+class CommandTestCase(TestCase):
+        """
+        Testing management commands
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            fd, self.output = tempfile.mkstemp()
+            os.close(fd)
+
+        def tearDown(self):
+            os.remove(self.output)
+
+        def _report(self, command, *args, **options):
+            options['output'] = self.output
+            call_command(command, *args, **options)
+            return simplejson.load(open(self.output))
+
+        def test_validate_workflows(self):
+            """
+            Makes sure the validate_workflows command reports the same errors
+            as Workflow.is_valid()
+            """
+            w = Workflow.objects.get(id=1)
+            report = self._report('validate_workflows', processes=1)
+            self.assertEqual(1, report['valid'])
+            self.assertEqual(0, report['invalid'])
+            self.assertEqual(True, report['workflows']['1']['valid'])
+            self.assertEqual('test_workflow', report['workflows']['1']['slug'])
+            # Break the workflow
+            orphan_state = State(name='orphaned_state', workflow=w)
+            orphan_state.save()
+            report = self._report('validate_workflows', processes=1)
+            result = report['workflows']['1']
+            self.assertEqual(False, result['valid'])
+            self.assertEqual(False, w.is_valid())
+            self.assertEqual(w.errors['states'][orphan_state.id],
+                    result['errors']['states'][str(orphan_state.id)])
+            self.assertEqual([], result['errors']['workflow'])
+            self.assertEqual({}, result['errors']['transitions'])
+            # Only workflows in definition are validated unless asked
+            w.status = Workflow.ACTIVE
+            w.save()
+            report = self._report('validate_workflows', processes=1)
+            self.assertEqual({}, report['workflows'])
+            report = self._report('validate_workflows', processes=1, all=True)
+            self.assertEqual(['1'], report['workflows'].keys())
+            report = self._report('validate_workflows', 'test_workflow',
+                    processes=1)
+            self.assertEqual(['1'], report['workflows'].keys())
+
+        def test_validate_workflows_changed_since(self):
+            """
+            Makes sure only workflows edited since the last run are validated
+            when --changed-since is used
+            """
+            w = Workflow.objects.get(id=1)
+            Workflow.objects.filter(id=1).update(
+                    updated_on=datetime.datetime(2009, 1, 1))
+            report = self._report('validate_workflows', processes=1,
+                    changed_since='2010-01-01')
+            self.assertEqual({}, report['workflows'])
+            # Editing a state marks the workflow as changed
+            state = State.objects.get(id=1)
+            state.save()
+            report = self._report('validate_workflows', processes=1,
+                    changed_since='2010-01-01 00:00:00')
+            self.assertEqual(['1'], report['workflows'].keys())
+            # So does changing the roles of a state, transition or event
+            for roles in (state.roles, Transition.objects.get(id=1).roles,
+                    Event.objects.get(id=1).roles):
+                for change in (lambda: roles.add(Role.objects.get(id=3)),
+                        lambda: roles.remove(Role.objects.get(id=3)),
+                        roles.clear):
+                    Workflow.objects.filter(id=1).update(
+                            updated_on=datetime.datetime(2009, 1, 1))
+                    change()
+                    self.assertTrue(Workflow.objects.get(id=1).updated_on >
+                            datetime.datetime(2010, 1, 1))
+            # The report from the last run can be used
+            Workflow.objects.filter(id=1).update(
+                    updated_on=datetime.datetime(2009, 1, 1))
+            report = self._report('validate_workflows', processes=1,
+                    changed_since=self.output)
+            self.assertEqual({}, report['workflows'])
+
+        def test_reconcile_state_counts(self):
+            """
+            Makes sure the reconcile_state_counts command corrects counts that
+            don't agree with the workflow history
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            w.activate()
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(u)
+            StateActivityCount.objects.all().delete()
+            call_command('reconcile_state_counts', verbosity=0)
+            counts = StateActivityCount.objects.for_workflow(w)
+            self.assertEqual(w.states.all().count(), len(counts))
+            self.assertEqual(1, counts[1])
+            self.assertEqual(1, sum(counts.values()))
+
+        def test_deliver_outbox(self):
+            """
+            Makes sure the deliver_outbox command delivers pending messages
+            """
+            settings.WORKFLOW_OUTBOX = True
+            try:
+                u = User.objects.get(id=1)
+                wa = WorkflowActivity(workflow=Workflow.objects.get(id=1),
+                        created_by=u)
+                wa.save()
+                Participant(user=u, workflowactivity=wa).save()
+                wa.add_comment(u, 'test')
+            finally:
+                del settings.WORKFLOW_OUTBOX
+            self.assertEqual(1, wa.outbox.filter(
+                delivered_on__isnull=True).count())
+            call_command('deliver_outbox', verbosity=0)
+            self.assertEqual(0, wa.outbox.filter(
+                delivered_on__isnull=True).count())
+
+        def test_evaluate_guards(self):
+            """
+            Makes sure the evaluate_guards command progresses activities whose
+            guards are satisfied
+            """
+            w = Workflow.objects.get(id=1)
+            t = Transition.objects.get(id=1)
+            t.guard = 'seconds_in_state >= 0'
+            t.save()
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            Participant(user=u, workflowactivity=wa).save()
+            wa.start(u)
+            w.activate()
+            call_command('evaluate_guards', verbosity=0)
+            self.assertEqual(State.objects.get(id=2), wa.current_state().state)
+
+        def test_prerender_diagrams(self):
+            """
+            Makes sure the diagrams of active workflows are rendered into
+            storage
+            """
+            old_storage, old_executor = diagrams.storage, get_executor()
+            location = tempfile.mkdtemp()
+            diagrams.storage = FileSystemStorage(location=location)
+            set_executor(InlineExecutor())
+            try:
+                w = Workflow.objects.get(id=1)
+                w.activate()
+                name = diagrams.diagram_name(w.id, w.get_fingerprint(), 'png')
+                diagrams.storage.delete(name)
+                # workflows in definition are left alone
+                w2 = w.clone(User.objects.get(id=1))
+                call_command('prerender_diagrams', processes=2, verbosity=0)
+                self.assertEqual(True, diagrams.storage.exists(name))
+                self.assertEqual([str(w.id)],
+                        diagrams.storage.listdir('workflow/diagrams')[0])
+                # without --force stored diagrams aren't rendered again
+                diagrams.storage.delete(name)
+                diagrams.storage.save(name, diagrams.ContentFile('STORED'))
+                call_command('prerender_diagrams', processes=1, verbosity=0)
+                self.assertEqual('STORED', diagrams.storage.open(name).read())
+                call_command('prerender_diagrams', processes=1, force=True,
+                        verbosity=0)
+                self.assertEqual('PNGDATA',
+                        diagrams.storage.open(name).read().strip())
+                # nothing is stored when dot fails or has no output
+                old_dot = settings.GRAPHVIZ_DOT_COMMAND
+                try:
+                    for command in ('false', 'true'):
+                        settings.GRAPHVIZ_DOT_COMMAND = command
+                        diagrams.storage.delete(name)
+                        self.assertRaises(diagrams.DotError,
+                                diagrams.store_diagrams, w.id,
+                                w.get_fingerprint(), diagrams.get_dotfile(w))
+                        self.assertEqual(False, diagrams.storage.exists(name))
+                finally:
+                    settings.GRAPHVIZ_DOT_COMMAND = old_dot
+            finally:
+                diagrams.storage = old_storage
+                set_executor(old_executor)
+                shutil.rmtree(location)
+
+        def test_check_conformance(self):
+            """
+            Makes sure violations are reported and the run is checkpointed
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            def activity():
+                wa = WorkflowActivity(workflow=w, created_by=u)
+                wa.save()
+                p = Participant(user=u, workflowactivity=wa)
+                p.save()
+                p.roles.add(Role.objects.get(id=1))
+                wa.start(u)
+                # skip the mandatory event
+                WorkflowHistory(workflowactivity=wa, participant=p,
+                        log_type=WorkflowHistory.TRANSITION,
+                        transition=Transition.objects.get(id=3),
+                        state=State.objects.get(id=4), note='moved').save()
+                return wa
+            wa1 = activity()
+            wa2 = activity()
+            def violations():
+                return [simplejson.loads(line) for line in open(self.output)]
+            call_command('check_conformance', output=self.output,
+                    processes=1, range_size=1, verbosity=0)
+            self.assertEqual([(wa1.id, 'illegal_move'), (wa2.id,
+                'illegal_move')], [(v['activity'], v['kind']) for v in
+                    violations()])
+            self.assertEqual(wa2.id, ConformanceCheckpoint.objects.get(
+                name='conformance').position)
+            # Carries on from the checkpoint
+            wa3 = activity()
+            call_command('check_conformance', output=self.output,
+                    processes=1, verbosity=0)
+            self.assertEqual([wa1.id, wa2.id, wa3.id], [v['activity'] for v
+                in violations()])
+            call_command('check_conformance', output=self.output,
+                    processes=1, verbosity=0)
+            self.assertEqual(3, len(violations()))
+            call_command('check_conformance', output=self.output,
+                    processes=1, restart=True, verbosity=0)
+            self.assertEqual(6, len(violations()))
+
+        def test_discover_workflow(self):
+            """
+            Makes sure the discovered flow is written as a diagram
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(u)
+            wa.progress(Transition.objects.get(id=1), u)
+            call_command('discover_workflow', 'test_workflow',
+                    output=self.output, verbosity=0)
+            result = open(self.output).read()
+            self.assertEqual(True, result.find('state1 -> state2 [label="'\
+                    'Proceed to state 2 (1, 0s)"') > -1)
+            call_command('discover_workflow', 'test_workflow', format='png',
+                    output=self.output, verbosity=0)
+            self.assertEqual('PNGDATA', open(self.output).read().strip())
+            for args, options in ((('no_such_workflow',), {}),
+                    (('test_workflow',), {'format': 'gif'})):
+                try:
+                    call_command('discover_workflow', *args, **options)
+                except SystemExit:
+                    pass
+                else:
+                    self.fail('Exception expected but not thrown')
+
+        def test_prune_history(self):
+            """
+            Makes sure old comments are pruned according to the policy given
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(u)
+            comment = wa.add_comment(u, 'old')
+            wa.progress(Transition.objects.get(id=1), u)
+            WorkflowHistory.objects.all().update(
+                    created_on=datetime.datetime.now() -
+                    datetime.timedelta(days=10))
+            call_command('prune_history', keep=['comment=30'], pause=0,
+                    verbosity=0)
+            self.assertEqual(1, WorkflowHistory.objects.filter(
+                id=comment.id).count())
+            call_command('prune_history', keep=['comment=5'], pause=0,
+                    dry_run=True, verbosity=0)
+            self.assertEqual(1, WorkflowHistory.objects.filter(
+                id=comment.id).count())
+            call_command('prune_history', keep=['comment=5'], pause=0,
+                    verbosity=0)
+            self.assertEqual(0, WorkflowHistory.objects.filter(
+                id=comment.id).count())
+            self.assertEqual(2, wa.history.count())
+            for keep in (['transition=30'], ['comment']):
+                try:
+                    call_command('prune_history', keep=keep, verbosity=0)
+                except SystemExit:
+                    pass
+                else:
+                    self.fail('Exception expected but not thrown')
@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""
+Conformance checking tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# django
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.conformance import *
+
+class ConformanceTestCase(TestCase):
+        """
+        Testing the replay of activities' history against their workflow
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            self.workflow = Workflow.objects.get(id=1)
+            self.workflow.activate()
+            self.user = User.objects.get(id=1)
+
+        def _activity(self, role_id=1):
+            wa = WorkflowActivity(workflow=self.workflow, created_by=self.user)
+            wa.save()
+            p = Participant(user=self.user, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=role_id))
+            wa.start(self.user)
+            return wa, p
+
+        def _write(self, wa, p, transition_id, state_id=None):
+            """
+            Writes a TRANSITION record without the engine (as a data migration
+            might)
+            """
+            transition = transition_id and Transition.objects.get(
+                    id=transition_id)
+            wh = WorkflowHistory(workflowactivity=wa, participant=p,
+                    log_type=WorkflowHistory.TRANSITION,
+                    transition=transition, note='written directly',
+                    state_id=state_id or transition.to_state_id)
+            wh.save()
+            return wh
+
+        def _kinds(self, violations, wa):
+            return [(v['kind'], v['history']) for v in violations if
+                    v['activity'] == wa.id]
+
+        def test_check_activities(self):
+            """
+            Makes sure moves the engine wouldn't allow are found
+            """
+            # Made with the engine
+            wa1, p1 = self._activity()
+            wa1.progress(Transition.objects.get(id=1), self.user)
+            wa1.log_event(Event.objects.get(id=1), self.user)
+            wa1.progress(Transition.objects.get(id=2), self.user)
+            wa1.add_comment(self.user, 'comment')
+            wa1.force_stop(self.user, 'test')
+            # Written directly
+            wa2, p2 = self._activity(role_id=3)
+            role = self._write(wa2, p2, 1)
+            event = self._write(wa2, p2, 2)
+            illegal = self._write(wa2, p2, 8)
+            wrong_state = self._write(wa2, p2, 10, state_id=5)
+            jump = self._write(wa2, p2, None, state_id=8)
+            end = self._write(wa2, p2, 11)
+            after = self._write(wa2, p2, 11)
+            wa3 = WorkflowActivity(workflow=self.workflow, created_by=self.user)
+            wa3.save()
+            p3 = Participant(user=self.user, workflowactivity=wa3)
+            p3.save()
+            bad_start = self._write(wa3, p3, None, state_id=2)
+            violations = check_activities(wa1.id, wa3.id)
+            self.assertEqual([], self._kinds(violations, wa1))
+            self.assertEqual([
+                (ROLE_VIOLATION, role.id),
+                (MISSING_MANDATORY_EVENT, event.id),
+                (ROLE_VIOLATION, event.id),
+                (ILLEGAL_MOVE, illegal.id),
+                (STATE_MISMATCH, wrong_state.id),
+                (ILLEGAL_MOVE, jump.id),
+                (MOVE_AFTER_END, after.id),
+                ], self._kinds(violations, wa2))
+            self.assertEqual([(ILLEGAL_START, bad_start.id)],
+                    self._kinds(violations, wa3))
+            # Only the activities in the range are checked
+            self.assertEqual([wa2.id], list(set([v['activity'] for v in
+                check_activities(wa2.id, wa2.id)])))
+            self.assertEqual([], check_activities(wa3.id + 1, wa3.id + 10))
+
+        def test_roles_held_at_the_time(self):
+            """
+            Makes sure transitions are checked against the roles held when
+            they were made rather than those held now
+            """
+            wa, p = self._activity()
+            wa.progress(Transition.objects.get(id=1), self.user)
+            wa.remove_role(self.user, self.user, Role.objects.get(id=1))
+            wh = self._write(wa, p, 2)
+            self.assertEqual([
+                (MISSING_MANDATORY_EVENT, wh.id),
+                (ROLE_VIOLATION, wh.id),
+                ], self._kinds(check_activities(wa.id, wa.id), wa))
+            # Roles given back are held again
+            wa, p = self._activity()
+            wa.remove_role(self.user, self.user, Role.objects.get(id=1))
+            wa.assign_role(self.user, self.user, Role.objects.get(id=1))
+            wa.progress(Transition.objects.get(id=1), self.user)
+            self.assertEqual([], check_activities(wa.id, wa.id))
+
+        def test_unchecked_transitions(self):
+            """
+            Makes sure transitions made by guards aren't checked for roles or
+            mandatory events
+            """
+            wa, p = self._activity(role_id=3)
+            wh = self._write(wa, p, 1)
+            self.assertEqual([(ROLE_VIOLATION, wh.id)], self._kinds(
+                check_activities(wa.id, wa.id), wa))
+            w = self.workflow.clone(self.user)
+            t = w.transitions.get(from_state__is_start_state=True)
+            t.guard = 'seconds_in_state >= 0'
+            t.save()
+            w.activate()
+            wa = WorkflowActivity(workflow=w, created_by=self.user)
+            wa.save()
+            p = Participant(user=self.user, workflowactivity=wa)
+            p.save()
+            wa.start(self.user)
+            self.assertEqual(t.to_state, wa.current_state().state)
+            self.assertEqual([], check_activities(wa.id, wa.id))
@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+"""
+Non-blocking engine tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import threading
+import unittest
+
+# django
+from django.conf import settings
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.deferred import *
+
+class EngineScenarios(object):
+        """
+        Engine tests shared by the blocking and non-blocking APIs. Sub-classes
+        define call() to invoke the named engine method
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            self.workflow = Workflow.objects.get(id=1)
+            self.workflow.activate()
+            self.user = User.objects.get(id=1)
+            self.wa = WorkflowActivity(workflow=self.workflow,
+                    created_by=self.user)
+            self.wa.save()
+            p = Participant(user=self.user, workflowactivity=self.wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+
+        def test_engine(self):
+            """
+            Makes sure the engine methods give the same results
+            """
+            u2 = User.objects.get(id=2)
+            self.assertEqual(None, self.call('current_state'))
+            self.assertEqual([], self.call('available_transitions', self.user))
+            wh = self.call('start', self.user)
+            self.assertEqual(wh, self.call('current_state'))
+            self.assertEqual(State.objects.get(id=1), wh.state)
+            self.assertEqual([Transition.objects.get(id=1)],
+                    self.call('available_transitions', self.user))
+            wh = self.call('assign_role', self.user, u2, Role.objects.get(id=2))
+            self.assertEqual(WorkflowHistory.ROLE, wh.log_type)
+            self.call('progress', Transition.objects.get(id=1), self.user)
+            # The mandatory event is yet to happen
+            self.assertEqual([], self.call('available_transitions', self.user))
+            self.call('log_event', Event.objects.get(id=1), self.user)
+            self.assertEqual([Transition.objects.get(id=2)],
+                    self.call('available_transitions', self.user))
+            # Users who aren't participants can't use any
+            self.assertEqual([], self.call('available_transitions',
+                User.objects.get(id=3)))
+            wh = self.call('add_comment', self.user, 'test')
+            self.assertEqual(u'test', wh.note)
+            self.call('remove_role', self.user, u2, Role.objects.get(id=2))
+            self.call('clear_roles', self.user, u2)
+            self.call('disable_participant', self.user, u2, 'test')
+            self.call('enable_participant', self.user, u2, 'test')
+            self.call('force_stop', self.user, 'test')
+            self.assertNotEqual(None, WorkflowActivity.objects.get(
+                id=self.wa.id).completed_on)
+            self.assertEqual([], self.call('available_transitions', self.user))
+            self.assertEqual(10, self.wa.history.all().count())
+
+        def test_engine_exceptions(self):
+            """
+            Makes sure the engine raises the same exceptions
+            """
+            try:
+                self.call('progress', Transition.objects.get(id=1), self.user)
+            except UnableToProgressWorkflow, instance:
+                self.assertEqual(u'Start the workflow before attempting to'\
+                        ' transition', instance.args[0])
+            else:
+                self.fail('Exception expected but not thrown')
+            self.call('start', self.user)
+            try:
+                self.call('start', self.user)
+            except UnableToStartWorkflow, instance:
+                self.assertEqual(u'Already started', instance.args[0])
+            else:
+                self.fail('Exception expected but not thrown')
+            try:
+                self.call('start', User.objects.get(id=2))
+            except Participant.DoesNotExist:
+                pass
+            else:
+                self.fail('Exception expected but not thrown')
+
+def _shared_test_database():
+    """
+    Returns True unless the test database is an in-memory sqlite database
+    (which the worker threads' connections can't see)
+    """
+    return settings.DATABASE_ENGINE != 'sqlite3' or \
+            settings.TEST_DATABASE_NAME not in (None, '', ':memory:')
+
+class BlockingEngineTestCase(EngineScenarios, TestCase):
+        """
+        Testing the engine methods on WorkflowActivity
+        """
+        def call(self, name, *args):
+            return getattr(self.wa, name)(*args)
+
+class DeferredEngineTestCase(EngineScenarios, TestCase):
+        """
+        Testing the non-blocking engine methods on WorkflowActivity
+        """
+        def setUp(self):
+            # The test database only exists in this thread
+            self.previous = set_executor(InlineExecutor())
+            EngineScenarios.setUp(self)
+
+        def tearDown(self):
+            set_executor(self.previous)
+
+        def call(self, name, *args):
+            result = getattr(self.wa, 'a' + name)(*args)
+            self.assertEqual(True, isinstance(result, DeferredResult))
+            self.assertEqual(True, result.ready())
+            return result.get()
+
+        def test_threaded_executor(self):
+            """
+            Makes sure calls with the same key are run in order and that
+            results and exceptions are handed back
+            """
+            executor = ThreadedExecutor(4)
+            calls = []
+            release = threading.Event()
+            def call(key, i):
+                if i == 0:
+                    release.wait(5)
+                calls.append((key, i))
+                if i == 4:
+                    raise ValueError(key)
+                return i
+            results = []
+            for i in range(5):
+                for key in ('a', 'b'):
+                    results.append(executor.submit(key, call, key, i))
+            callback_results = []
+            results[-1].add_callback(callback_results.append)
+            release.set()
+            try:
+                self.assertEqual([0, 0, 1, 1, 2, 2, 3, 3],
+                        [r.get(5) for r in results[:8]])
+                for r in results[8:]:
+                    try:
+                        r.get(5)
+                    except ValueError:
+                        pass
+                    else:
+                        self.fail('Exception expected but not thrown')
+                    self.assertEqual(False, r.successful())
+            finally:
+                executor.close()
+            for key in ('a', 'b'):
+                self.assertEqual(range(5), [i for k, i in calls if k == key])
+            self.assertEqual([results[-1]], callback_results)
+
+        def test_caller_instance_untouched(self):
+            """
+            Makes sure the calls are made on a copy of the activity
+            """
+            self.call('start', self.user)
+            self.call('force_stop', self.user, 'test')
+            self.assertEqual(None, self.wa.completed_on)
+            self.assertEqual(None, self.wa._session)
+
+@unittest.skipIf(not _shared_test_database(), 'The worker threads need a test'\
+        ' database they can share')
+class ThreadedEngineTestCase(EngineScenarios, TransactionTestCase):
+        """
+        Testing the non-blocking engine methods run by the ThreadedExecutor
+        (each call committed by a worker thread)
+        """
+        def setUp(self):
+            self.executor = ThreadedExecutor(2)
+            self.previous = set_executor(self.executor)
+            EngineScenarios.setUp(self)
+            transaction.commit_unless_managed()
+
+        def tearDown(self):
+            set_executor(self.previous)
+            self.executor.close()
+
+        def call(self, name, *args):
+            result = getattr(self.wa, 'a' + name)(*args)
+            self.assertEqual(True, isinstance(result, DeferredResult))
+            return result.get(10)
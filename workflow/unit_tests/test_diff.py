@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+"""
+Diff tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# django
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.diff import *
+
+class DiffTestCase(TestCase):
+        """
+        Testing the structural differences between workflows
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            self.workflow = Workflow.objects.get(id=1)
+            self.workflow.activate()
+            self.clone = self.workflow.clone(User.objects.get(id=1))
+
+        def test_diff_workflows_unchanged(self):
+            """
+            A clone is the same as the workflow it was cloned from
+            """
+            empty = {'added': [], 'removed': [], 'modified': []}
+            self.assertEqual({'states': empty, 'transitions': empty,
+                'events': empty}, diff_workflows(self.workflow, self.clone))
+
+        def test_diff_workflows(self):
+            """
+            Makes sure added, removed and modified things are reported
+            """
+            # Modify a state
+            state = self.clone.states.get(name='State2')
+            state.estimation_value = 5
+            state.save()
+            state.roles.remove(Role.objects.get(id=3))
+            # Add a state and a transition into it
+            new_state = State.objects.create(name='New state',
+                    workflow=self.clone, is_end_state=True)
+            new_transition = Transition.objects.create(name='Jump',
+                    workflow=self.clone, from_state=state, to_state=new_state)
+            # Rename and remove transitions
+            renamed = self.clone.transitions.get(name='End early')
+            renamed.name = 'Finish early'
+            renamed.save()
+            removed = self.clone.transitions.get(name='Return to step 3')
+            removed_id = self.workflow.transitions.get(name='Return to step 3'
+                    ).id
+            removed.delete()
+            # Make an event optional
+            event = self.clone.events.get(name='Important meeting')
+            event.is_mandatory = False
+            event.save()
+
+            result = diff_workflows(self.workflow, self.clone)
+            self.assertEqual(['New state'], [s['name'] for s in
+                result['states']['added']])
+            self.assertEqual(new_state.id, result['states']['added'][0]['id'])
+            self.assertEqual([], result['states']['removed'])
+            self.assertEqual(1, len(result['states']['modified']))
+            modified = result['states']['modified'][0]
+            self.assertEqual(state.id, modified['id'])
+            self.assertEqual(self.workflow.states.get(name='State2').id,
+                    modified['old_id'])
+            self.assertEqual({'estimation_value': [1, 5], 'roles': {
+                'added': [], 'removed': [u'Staff']}}, modified['changes'])
+
+            self.assertEqual([{'id': new_transition.id, 'name': u'Jump',
+                'from_state': u'State2', 'to_state': u'New state',
+                'roles': []}], result['transitions']['added'])
+            self.assertEqual([removed_id], [t['id'] for t in
+                result['transitions']['removed']])
+            self.assertEqual(1, len(result['transitions']['modified']))
+            self.assertEqual({'name': [u'End early', u'Finish early']},
+                    result['transitions']['modified'][0]['changes'])
+
+            self.assertEqual([], result['events']['added'])
+            self.assertEqual([], result['events']['removed'])
+            self.assertEqual({'is_mandatory': [True, False]},
+                    result['events']['modified'][0]['changes'])
+
+        def test_diff_renamed_state(self):
+            """
+            Makes sure renaming a state leaves its transitions and events
+            matched
+            """
+            state = self.clone.states.get(name='State2')
+            state.name = 'Second state'
+            state.save()
+            result = diff_workflows(self.workflow, self.clone)
+            self.assertEqual([], result['states']['added'])
+            self.assertEqual([], result['states']['removed'])
+            self.assertEqual([{'name': [u'State2', u'Second state']}],
+                    [s['changes'] for s in result['states']['modified']])
+            for section in ('transitions', 'events'):
+                self.assertEqual({'added': [], 'removed': [], 'modified': []},
+                        result[section])
+
+        def test_get_diff_dotfile(self):
+            """
+            Makes sure the changes are highlighted in the dot file
+            """
+            new_state = State.objects.create(name='New state',
+                    workflow=self.clone, is_end_state=True)
+            removed = self.clone.transitions.get(name='Return to step 3')
+            removed.delete()
+            result = get_diff_dotfile(self.workflow, self.clone)
+            self.assertEqual(True, result.find('state%d [' % new_state.id) >
+                    -1)
+            self.assertEqual(True, result.find('color=green') > -1)
+            self.assertEqual(True, result.find('label="Return to step 3",'\
+                    ' color=red, fontcolor=red, style=dashed') > -1)
+            for state in self.clone.states.all():
+                self.assertEqual(True, result.find('state%d [' % state.id) >
+                        -1)
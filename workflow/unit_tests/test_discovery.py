@@ -0,0 +1,130 @@
+# -*- coding: UTF-8 -*-
+"""
+Process discovery tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import datetime
+
+# django
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.discovery import *
+
+class DiscoveryTestCase(TestCase):
+        """
+        Testing the discovery of the flow taken by activities from their
+        history
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            self.workflow = Workflow.objects.get(id=1)
+            self.workflow.activate()
+            self.user = User.objects.get(id=1)
+
+        def _activity(self):
+            wa = WorkflowActivity(workflow=self.workflow, created_by=self.user)
+            wa.save()
+            p = Participant(user=self.user, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(self.user)
+            return wa, p
+
+        def test_directly_follows_graph(self):
+            """
+            Makes sure the moves between states and events are counted with
+            their median duration
+            """
+            graph = DirectlyFollowsGraph(self.workflow, seed=1)
+            start = datetime.datetime(2009, 1, 1)
+            T, E, C = WorkflowHistory.TRANSITION, WorkflowHistory.EVENT,\
+                    WorkflowHistory.COMMENT
+            for activity, minutes in ((1, (10, 20)), (2, (30, 60))):
+                graph.add(activity, T, 1, None, None, start)
+                graph.add(activity, C, 1, None, None, start)
+                graph.add(activity, T, 2, 1, None, start +
+                        datetime.timedelta(minutes=minutes[0]))
+                graph.add(activity, E, 2, None, 1, start +
+                        datetime.timedelta(minutes=minutes[1]))
+            graph.add(3, T, 1, None, None, start)
+            graph.finish()
+            self.assertEqual(3, graph.activities)
+            self.assertEqual({'state1': 3}, graph.starts)
+            self.assertEqual({'state1': 1, 'event1': 2}, graph.ends)
+            self.assertEqual({'state1': 3, 'state2': 2, 'event1': 2},
+                    graph.nodes)
+            self.assertEqual([('state1', 'state2', 1), ('state2', 'event1',
+                None)], sorted(graph.edges.keys()))
+            edge = graph.edges[('state1', 'state2', 1)]
+            self.assertEqual(2, edge.count)
+            self.assertEqual(1200.0, edge.median())
+            self.assertEqual('20m', format_duration(edge.median()))
+            self.assertEqual(1200.0, graph.edges[('state2', 'event1',
+                None)].median())
+            self.assertEqual('1d 2h', format_duration(93784))
+            self.assertEqual('0s', format_duration(None))
+
+        def test_sampled_durations(self):
+            """
+            Makes sure no more than the sample size of durations are kept
+            however often a move is made
+            """
+            graph = DirectlyFollowsGraph(self.workflow, sample_size=5, seed=1)
+            start = datetime.datetime(2009, 1, 1)
+            for activity in range(1, 1001):
+                graph.add(activity, WorkflowHistory.TRANSITION, 1, None, None,
+                        start)
+                graph.add(activity, WorkflowHistory.TRANSITION, 2, 1, None,
+                        start + datetime.timedelta(seconds=activity))
+            graph.finish()
+            edge = graph.edges[('state1', 'state2', 1)]
+            self.assertEqual(1000, edge.count)
+            self.assertEqual(5, len(edge.sample))
+            self.assertEqual(True, 1 <= edge.median() <= 1000)
+
+        def test_discover(self):
+            """
+            Makes sure the flow is discovered from the database and that moves
+            that aren't part of the design are drawn in red
+            """
+            wa1, p1 = self._activity()
+            wa1.progress(Transition.objects.get(id=1), self.user)
+            wa1.log_event(Event.objects.get(id=1), self.user)
+            wa1.progress(Transition.objects.get(id=2), self.user)
+            wa1.add_comment(self.user, 'comment')
+            wa2, p2 = self._activity()
+            # Skips state 2 (as a data migration might)
+            WorkflowHistory(workflowactivity=wa2, participant=p2,
+                    log_type=WorkflowHistory.TRANSITION,
+                    transition=Transition.objects.get(id=2),
+                    state=State.objects.get(id=3), note='skipped').save()
+            for chunk_size in (1, CHUNK_SIZE):
+                graph = discover(self.workflow, chunk_size=chunk_size)
+                self.assertEqual(2, graph.activities)
+                self.assertEqual([('event1', 'state3', 2), ('state1',
+                    'state2', 1), ('state1', 'state3', 2), ('state2',
+                        'event1', None)], sorted(graph.edges.keys()))
+                self.assertEqual({'state1': 2}, graph.starts)
+                self.assertEqual({'state3': 2}, graph.ends)
+            result = get_discovered_dotfile(graph)
+            self.assertEqual(True, result.find('A diagram of the flow'\
+                    ' observed in the history of the workflow: test'\
+                    ' workflow') > -1)
+            # The same nodes as the designed diagram
+            self.assertEqual(True, result.find('state1 [ \n        shape=box,'\
+                    ' label="START: Start State"') > -1)
+            self.assertEqual(True, result.find('state1 -> state2 [label="'\
+                    'Proceed to state 2 (1, 0s)", color=black') > -1)
+            self.assertEqual(True, result.find('state1 -> state3 [label="'\
+                    '%s (1, 0s)", color=red' % Transition.objects.get(id=2
+                        ).name) > -1)
+            self.assertEqual(True, result.find('event1 [shape=ellipse,'\
+                    ' style=dashed, color=black') > -1)
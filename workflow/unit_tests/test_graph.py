@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+"""
+Compiled graph tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import pickle
+
+# django
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.graph import *
+
+class GraphTestCase(TestCase):
+        """
+        Testing the compiled representation of workflows
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def test_load_graphs(self):
+            """
+            Makes sure the graph reflects the workflow definition
+            """
+            w = Workflow.objects.get(id=1)
+            graphs = load_graphs([w.id])
+            self.assertEqual([w.id], graphs.keys())
+            graph = graphs[w.id]
+            self.assertEqual(w.states.all().count(), len(graph.states))
+            self.assertEqual(w.transitions.all().count(),
+                    len(graph.transitions))
+            for state in w.states.all():
+                node = graph.states[state.id]
+                self.assertEqual(state.name, node.name)
+                self.assertEqual(state.is_start_state, node.is_start_state)
+                self.assertEqual(state.is_end_state, node.is_end_state)
+                self.assertEqual(set([r.id for r in state.roles.all()]),
+                        node.roles)
+                self.assertEqual(set([t.id for t in
+                    state.transitions_from.all()]),
+                    set([e.id for e in node.transitions_from]))
+            for transition in w.transitions.all():
+                edge = graph.transitions[transition.id]
+                self.assertEqual(transition.from_state.id, edge.from_state.id)
+                self.assertEqual(transition.to_state.id, edge.to_state.id)
+                self.assertEqual(set([r.id for r in transition.roles.all()]),
+                        edge.roles)
+            # Nothing to load
+            self.assertEqual({}, load_graphs([]))
+
+        def test_graph_pickle(self):
+            """
+            Makes sure graphs survive being sent to another process
+            """
+            graph = load_graph(1)
+            clone = pickle.loads(pickle.dumps(graph))
+            self.assertEqual(graph.workflow_id, clone.workflow_id)
+            self.assertEqual(sorted(graph.states.keys()),
+                    sorted(clone.states.keys()))
+            self.assertEqual(validate(graph), validate(clone))
+            for edge in clone.transitions.values():
+                self.assertEqual(True, edge in edge.from_state.transitions_from)
+                self.assertEqual(True, edge in edge.to_state.transitions_into)
+
+        def test_validate(self):
+            """
+            Makes sure validate() returns the same result as
+            Workflow.is_valid()
+            """
+            w = Workflow.objects.get(id=1)
+            self.assertEqual((True, {'workflow': [], 'states': {},
+                'transitions': {}}), validate(load_graph(w.id)))
+            orphan_state = State(name='orphaned_state', workflow=w)
+            orphan_state.save()
+            valid, errors = validate(load_graph(w.id))
+            self.assertEqual(False, valid)
+            self.assertEqual(False, w.is_valid())
+            self.assertEqual(w.errors, errors)
+            self.assertEqual([orphan_state.id], errors['states'].keys())
+
+        def test_fingerprint(self):
+            """
+            Makes sure the fingerprint reflects the structure of the workflow
+            rather than primary keys
+            """
+            u = User.objects.get(id=1)
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            clone = w.clone(u)
+            original = fingerprint(load_graph(w.id))
+            self.assertEqual(40, len(original))
+            self.assertEqual(original, fingerprint(load_graph(clone.id)))
+            # Changing estimations, roles, names, transitions and mandatory
+            # events changes the fingerprint
+            state = clone.states.all()[0]
+            state.estimation_value = 99
+            state.save()
+            changed = fingerprint(load_graph(clone.id))
+            self.assertNotEqual(original, changed)
+            state.roles.add(Role.objects.get(id=3))
+            self.assertNotEqual(changed, fingerprint(load_graph(clone.id)))
+            changed = fingerprint(load_graph(clone.id))
+            transition = clone.transitions.all()[0]
+            transition.name = 'Renamed'
+            transition.save()
+            self.assertNotEqual(changed, fingerprint(load_graph(clone.id)))
+            changed = fingerprint(load_graph(clone.id))
+            event = clone.events.filter(is_mandatory=True)[0]
+            event.is_mandatory = False
+            event.save()
+            self.assertNotEqual(changed, fingerprint(load_graph(clone.id)))
+            changed = fingerprint(load_graph(clone.id))
+            # Descriptions and non-mandatory events are not structural
+            state.description = 'Something else'
+            state.save()
+            self.assertEqual(changed, fingerprint(load_graph(clone.id)))
+            event.name = 'Not important'
+            event.save()
+            self.assertEqual(changed, fingerprint(load_graph(clone.id)))
+
+        def test_distances_to_end(self):
+            """
+            Makes sure we get the fewest transitions to an end state and the
+            transition to take next
+            """
+            self.assertEqual({
+                1: (4, 1),
+                2: (3, 2),
+                3: (2, 3),
+                4: (1, 6),
+                5: (3, 8),
+                6: (2, 10),
+                7: (0, None),
+                8: (1, 11),
+                9: (0, None),
+                }, distances_to_end(load_graph(1)))
+            # States that can't reach an end state are left out
+            w = Workflow.objects.get(id=1)
+            stuck = State.objects.create(name='Stuck', workflow=w)
+            Transition.objects.create(name='Get stuck', workflow=w,
+                    from_state=State.objects.get(id=1), to_state=stuck)
+            self.assertEqual(False, stuck.id in distances_to_end(load_graph(1)))
+
+        def test_deadline_transition_validation(self):
+            """
+            Makes sure a deadline transition must be a transition out of its
+            state
+            """
+            w = Workflow.objects.get(id=1)
+            s1 = State.objects.get(id=1)
+            s1.deadline_transition = Transition.objects.get(id=2)
+            try:
+                s1.save()
+            except UnableToEditWorkflow, instance:
+                self.assertEqual(u'The deadline transition must be a'\
+                        ' transition out of the state', instance.args[0])
+            else:
+                self.fail('Exception expected but not thrown')
+            s1.deadline_transition = Transition.objects.get(id=1)
+            s1.save()
+            graph = load_graph(w.id)
+            self.assertEqual(1, graph.states[1].deadline_transition)
+            self.assertEqual(1, pickle.loads(pickle.dumps(graph)).states[
+                1].deadline_transition)
+            self.assertEqual(True, validate(graph)[0])
+            # Saved before the check existed
+            State.objects.filter(id=1).update(deadline_transition=2)
+            valid, errors = validate(load_graph(w.id))
+            self.assertEqual(False, valid)
+            self.assertEqual([u'The deadline transition is not a transition'\
+                    ' out of this state.'], errors['states'][1])
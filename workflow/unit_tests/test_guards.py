@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+"""
+Guard expression tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# django
+from django.db import DatabaseError
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.graph import load_graph, validate
+from workflow.guards import *
+
+class GuardTestCase(TestCase):
+        """
+        Testing guarded transitions
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            self.workflow = Workflow.objects.get(id=1)
+            self.user = User.objects.get(id=1)
+
+        def _activity(self):
+            wa = WorkflowActivity(workflow=self.workflow, created_by=self.user)
+            wa.save()
+            p = Participant(user=self.user, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            return wa
+
+        def _guard(self, transition_id, guard):
+            t = Transition.objects.get(id=transition_id)
+            t.guard = guard
+            t.save()
+
+        def test_compile_guard(self):
+            """
+            Makes sure only the allowed syntax and names compile
+            """
+            code = compile_guard("mandatory_events_logged and ('Manager' in"\
+                    " roles or seconds_in_state > 2 * 3600)")
+            self.assertEqual(True, evaluate(code, {'mandatory_events_logged':
+                True, 'roles': frozenset(['Manager']), 'seconds_in_state': 0}))
+            self.assertEqual(False, evaluate(code, {'mandatory_events_logged':
+                False, 'roles': frozenset(), 'seconds_in_state': 0}))
+            # Guards that fail to evaluate aren't satisfied but database
+            # errors are passed on
+            self.assertEqual(False, evaluate(compile_guard('roles + 1'),
+                {'roles': frozenset()}))
+            class FailingContext(dict):
+                def __missing__(self, name):
+                    raise DatabaseError('lookup failed')
+            self.assertRaises(DatabaseError, evaluate, code, FailingContext())
+            for guard in ("__import__('os')", "roles.pop()", "events[0]",
+                    "foo == 1", "lambda: 1", "roles and"):
+                try:
+                    compile_guard(guard)
+                except InvalidGuard:
+                    pass
+                else:
+                    self.fail('Exception expected but not thrown')
+            # Invalid guards make the workflow invalid
+            self._guard(2, 'roles.pop()')
+            valid, errors = validate(load_graph(self.workflow.id))
+            self.assertEqual(False, valid)
+            self.assertEqual([u'The guard is invalid: Call is not allowed'],
+                    errors['transitions'][2])
+            self.assertEqual(False, self.workflow.is_valid())
+
+        def test_auto_progress(self):
+            """
+            Makes sure the engine makes guarded transitions as soon as their
+            guards are satisfied
+            """
+            self._guard(1, "'Manager' in roles")
+            self._guard(2, 'mandatory_events_logged')
+            # Guards are ignored until the workflow is active
+            wa = self._activity()
+            wa.start(self.user)
+            wa.assign_role(self.user, User.objects.get(id=2),
+                    Role.objects.get(id=2))
+            self.assertEqual(State.objects.get(id=1), wa.current_state().state)
+            self.workflow.activate()
+            wa = self._activity()
+            wa.start(self.user)
+            self.assertEqual(State.objects.get(id=1), wa.current_state().state)
+            wh = wa.assign_role(self.user, User.objects.get(id=2),
+                    Role.objects.get(id=2))
+            self.assertEqual(WorkflowHistory.ROLE, wh.log_type)
+            current = wa.current_state()
+            self.assertEqual(State.objects.get(id=2), current.state)
+            self.assertEqual(Transition.objects.get(id=1), current.transition)
+            self.assertEqual(self.user, current.participant.user)
+            # Changes within a batch are checked once it has been written
+            with batch():
+                wa.log_event(Event.objects.get(id=1), self.user)
+                self.assertEqual(State.objects.get(id=2),
+                        wa.current_state().state)
+            self.assertEqual(State.objects.get(id=3), wa.current_state().state)
+            self.assertEqual(StateActivityCount.objects.for_workflow(
+                self.workflow)[3], 1)
+
+        def test_evaluate_activities(self):
+            """
+            Makes sure the batch evaluator progresses activities whose guards
+            were satisfied by changes made outside the engine
+            """
+            self._guard(1, "'Staff' in roles")
+            self.workflow.activate()
+            activities = [self._activity() for i in range(3)]
+            for wa in activities:
+                wa.start(self.user)
+            Participant.objects.get(workflowactivity=activities[0],
+                    user=self.user).roles.add(Role.objects.get(id=3))
+            self.assertEqual(1, evaluate_activities(
+                WorkflowActivity.objects.filter(workflow=self.workflow)))
+            self.assertEqual(State.objects.get(id=2),
+                    activities[0].current_state().state)
+            self.assertEqual(State.objects.get(id=1),
+                    activities[1].current_state().state)
+            self.assertEqual(0, evaluate_activities(activities))
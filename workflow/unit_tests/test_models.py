@@ -5,14 +5,18 @@ Model tests for Workflow
 Author: Nicholas H.Tollervey
 
 """
+from __future__ import with_statement
+
 # python
 import datetime
 import sys
 
 # django
 from django.test.client import Client
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.db import connection, transaction
 
 # project
 from workflow.models import *
@@ -278,6 +282,28 @@ class ModelTestCase(TestCase):
             self.assertEqual(w.states.all().count(), clone.states.all().count())
             self.assertEqual(w.events.all().count(), clone.events.all().count())
 
+        def test_workflow_fingerprint(self):
+            """
+            Makes sure the fingerprint is stored on activation and can be used
+            to find structurally identical workflows
+            """
+            u = User.objects.get(id=1)
+            w = Workflow.objects.get(id=1)
+            self.assertEqual('', w.fingerprint)
+            # Workflows in definition are not stored as they might change
+            fingerprint = w.get_fingerprint()
+            self.assertEqual('', Workflow.objects.get(id=1).fingerprint)
+            w.activate()
+            self.assertEqual(fingerprint, w.fingerprint)
+            self.assertEqual(fingerprint,
+                    Workflow.objects.get(id=1).fingerprint)
+            self.assertEqual([], list(w.duplicates()))
+            clone = w.clone(u)
+            self.assertEqual(fingerprint, clone.get_fingerprint())
+            clone.activate()
+            self.assertEqual([clone], list(w.duplicates()))
+            self.assertEqual([w], list(clone.duplicates()))
+
         def test_state_deadline(self):
             """
             Makes sure we get the right result from the deadline() method in the
@@ -965,6 +991,232 @@ class ModelTestCase(TestCase):
                     wh.note)
             self.assertEqual(None, wh.deadline)
 
+        def test_workflowactivity_distance_to_end(self):
+            """
+            Makes sure the distances calculated on activation are used to
+            annotate WorkflowActivity instances
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            r = Role.objects.get(id=1)
+            w.activate()
+            self.assertEqual(w.states.all().count(), w.distances.all().count())
+            activities = []
+            for i in range(3):
+                wa = WorkflowActivity(workflow=w, created_by=u)
+                wa.save()
+                p = Participant(user=u, workflowactivity=wa)
+                p.save()
+                p.roles.add(r)
+                activities.append(wa)
+            wa1, wa2, wa3 = activities
+            wa1.start(u)
+            wa2.start(u)
+            wa2.progress(Transition.objects.get(id=1), u)
+            # wa3 isn't started
+            self.assertEqual((None, None), wa3.distance_to_end())
+            self.assertEqual((4, Transition.objects.get(id=1)),
+                    wa1.distance_to_end())
+            self.assertEqual((3, Transition.objects.get(id=2)),
+                    wa2.distance_to_end())
+            result = dict([(a.id, (a.distance_to_end, a.next_transition_id))
+                for a in WorkflowActivity.objects.filter(
+                    workflow=w).with_distance_to_end()])
+            self.assertEqual({wa1.id: (4, 1), wa2.id: (3, 2), wa3.id: (None,
+                None)}, result)
+            self.assertEqual({wa1.id: (4, Transition.objects.get(id=1)),
+                wa2.id: (3, Transition.objects.get(id=2)),
+                wa3.id: (None, None)},
+                WorkflowActivity.objects.distances_to_end(activities))
+            # The annotation can be used for ordering
+            self.assertEqual([wa2, wa1], list(WorkflowActivity.objects.filter(
+                pk__in=[wa1.id, wa2.id]).with_distance_to_end().order_by(
+                    'distance_to_end')))
+
+        def test_state_activity_counts(self):
+            """
+            Makes sure the number of open activities in each state is kept up
+            to date as activities are started, progressed and stopped
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            r = Role.objects.get(id=1)
+            w.activate()
+            # Every state starts with a count of zero
+            self.assertEqual(dict([(s.id, 0) for s in w.states.all()]),
+                    StateActivityCount.objects.for_workflow(w))
+            activities = []
+            for i in range(3):
+                wa = WorkflowActivity(workflow=w, created_by=u)
+                wa.save()
+                p = Participant(user=u, workflowactivity=wa)
+                p.save()
+                p.roles.add(r)
+                wa.start(u)
+                activities.append(wa)
+            wa1, wa2, wa3 = activities
+            counts = StateActivityCount.objects.for_workflow(w)
+            self.assertEqual(3, counts[1])
+            wa1.progress(Transition.objects.get(id=1), u)
+            wa1.log_event(Event.objects.get(id=1), u)
+            wa1.progress(Transition.objects.get(id=2), u)
+            wa2.progress(Transition.objects.get(id=1), u)
+            counts = StateActivityCount.objects.for_workflow(w)
+            self.assertEqual((1, 1, 1), (counts[1], counts[2], counts[3]))
+            # Stopped activities are no longer counted
+            wa3.force_stop(u, 'test')
+            self.assertEqual(0, StateActivityCount.objects.for_workflow(w)[1])
+            # Completed activities are no longer counted
+            wa1.progress(Transition.objects.get(id=3), u)
+            wa1.progress(Transition.objects.get(id=6), u)
+            counts = StateActivityCount.objects.for_workflow(w)
+            self.assertEqual((0, 0, 0), (counts[3], counts[4], counts[7]))
+            # Changes made in a batch are applied when it is written
+            with batch():
+                wa2.log_event(Event.objects.get(id=1), u)
+                wa2.progress(Transition.objects.get(id=2), u)
+                self.assertEqual(1,
+                        StateActivityCount.objects.for_workflow(w)[2])
+            counts = StateActivityCount.objects.for_workflow(w)
+            self.assertEqual((0, 1), (counts[2], counts[3]))
+            # The counts agree with the history
+            self.assertEqual(0, StateActivityCount.objects.reconcile(w))
+            StateActivityCount.objects.filter(workflow=w, state=1).update(
+                    count=5)
+            self.assertEqual(1, StateActivityCount.objects.reconcile(w))
+            self.assertEqual(0, StateActivityCount.objects.for_workflow(w)[1])
+            # Counts that were never kept are worked out from the history
+            # rather than going negative
+            StateActivityCount.objects.filter(workflow=w).delete()
+            wa2.progress(Transition.objects.get(id=3), u)
+            counts = StateActivityCount.objects.for_workflow(w)
+            self.assertEqual((0, 1), (counts[3], counts[4]))
+            self.assertEqual(0, StateActivityCount.objects.reconcile(w))
+
+        def test_workflowactivity_session(self):
+            """
+            Makes sure a WorkflowSession caches lookups and keeps them up to
+            date as the engine writes to the database
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            u2 = User.objects.get(id=2)
+            r = Role.objects.get(id=1)
+            r2 = Role.objects.get(id=2)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(r)
+            with wa.session(u) as s:
+                self.assertEqual(s, wa._session)
+                self.assertEqual(None, s.current_state())
+                wh = s.start()
+                # The new record is the current state without a further query
+                self.assertEqual(wh, s.current_state())
+                self.assertEqual(State.objects.get(id=1), wa.current_state().state)
+                # Participants are only looked up once
+                self.assertEqual(True, s._get_participant(u) is s._get_participant(u))
+                # Roles are reloaded once they've been changed
+                s.assign_role(u2, r2)
+                p2 = s._get_participant(u2)
+                self.assertEqual([r2], s._get_roles(p2))
+                s.remove_role(u2, r2)
+                self.assertEqual([], s._get_roles(p2))
+                wh = s.progress(Transition.objects.get(id=1))
+                self.assertEqual(wh, wa.current_state())
+                self.assertEqual(State.objects.get(id=2), wa.current_state().state)
+                # Disabled participants are not returned
+                s.disable_participant(u2, 'test')
+                try:
+                    s._get_participant(u2)
+                except Participant.DoesNotExist:
+                    pass
+                else:
+                    self.fail('Exception expected but not thrown')
+                wh = s.add_comment('test')
+            # Once the block exits everything comes from the database again
+            self.assertEqual(None, wa._session)
+            self.assertEqual(wh.id, wa.current_state().id)
+            self.assertEqual(True, Participant.objects.get(user=u2,
+                workflowactivity=wa).disabled)
+
+        def test_batch(self):
+            """
+            Makes sure history and role changes made within a batch are
+            validated in memory and written (with signals sent in order) when
+            the batch exits
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            u2 = User.objects.get(id=2)
+            r = Role.objects.get(id=1)
+            r2 = Role.objects.get(id=2)
+            r3 = Role.objects.get(id=3)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(r)
+            received = []
+            def on_change(sender, **kwargs):
+                received.append(('change', sender.note))
+            def on_role(sender, **kwargs):
+                received.append(('role', sender.note))
+            workflow_post_change.connect(on_change)
+            role_assigned.connect(on_role)
+            try:
+                with batch():
+                    wa.assign_role(u, u2, r2)
+                    wa.start(u)
+                    wa.progress(Transition.objects.get(id=1), u)
+                    wa.log_event(Event.objects.get(id=1), u)
+                    # The mandatory event is found even though it is yet to be
+                    # written
+                    wa.progress(Transition.objects.get(id=2), u)
+                    wa.remove_role(u, u2, r2)
+                    wa.assign_role(u, u2, r3)
+                    # Nothing has been written or sent yet
+                    self.assertEqual(0, wa.history.all().count())
+                    self.assertEqual([], received)
+                    p2 = Participant.objects.get(user=u2, workflowactivity=wa)
+                    self.assertEqual([], list(p2.roles.all()))
+                    self.assertEqual(State.objects.get(id=3),
+                            wa.current_state().state)
+            finally:
+                workflow_post_change.disconnect(on_change)
+                role_assigned.disconnect(on_role)
+            self.assertEqual(7, wa.history.all().count())
+            self.assertEqual(State.objects.get(id=3), wa.current_state().state)
+            self.assertEqual([r3], list(p2.roles.all()))
+            self.assertEqual([
+                ('change', u'Role "Manager" assigned to test_manager'),
+                ('role', u'Role "Manager" assigned to test_manager'),
+                ('change', u'Started workflow'),
+                ('change', u'Proceed to state 2'),
+                ('change', u'Important meeting'),
+                ('change', u'Proceed to state 3'),
+                ('change', u'Role "Manager" removed from test_manager'),
+                ('change', u'Role "Staff" assigned to test_manager'),
+                ('role', u'Role "Staff" assigned to test_manager'),
+                ], received)
+            # Nothing is written if the block raises an exception
+            try:
+                with batch():
+                    wa.add_comment(u, 'test')
+                    raise ValueError('test')
+            except ValueError:
+                pass
+            self.assertEqual(7, wa.history.all().count())
+            # Records are flushed every "size" records
+            with batch(size=2):
+                wa.add_comment(u, 'test')
+                wa.add_comment(u, 'test')
+                self.assertEqual(9, wa.history.all().count())
+                wa.add_comment(u, 'test')
+                self.assertEqual(9, wa.history.all().count())
+            self.assertEqual(10, wa.history.all().count())
+
         def test_participant_unicode(self):
             """
             Make sure the __unicode__() method returns the correct string in
@@ -1004,3 +1256,431 @@ class ModelTestCase(TestCase):
             wh = wa.start(p)
             self.assertEqual(u'Started workflow created by test_admin - Administrator', wh.__unicode__())
 
+
+        def _count_queries(self, func):
+            """
+            Returns the number of queries made by calling func
+            """
+            old_debug = settings.DEBUG
+            settings.DEBUG = True
+            connection.queries = []
+            try:
+                func()
+                return len(connection.queries)
+            finally:
+                settings.DEBUG = old_debug
+
+        def test_prefetching_querysets(self):
+            """
+            Makes sure the querysets load related data with a fixed number of
+            queries and that the loaded data is used (and then discarded once
+            out of date)
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            r = Role.objects.get(id=1)
+            for i in range(3):
+                wa = WorkflowActivity(workflow=w, created_by=u)
+                wa.save()
+                p = Participant(user=u, workflowactivity=wa)
+                p.save()
+                p.roles.add(r)
+                wa.start(u)
+                wa.add_comment(u, 'comment %d' % i)
+            render = lambda qs: [unicode(x) for x in qs]
+            # one query for the records, two for the roles of the participants
+            qs = WorkflowHistory.objects.with_history_related()
+            self.assertEqual(3, self._count_queries(lambda: render(qs)))
+            self.assertEqual(render(WorkflowHistory.objects.all()), render(
+                WorkflowHistory.objects.with_history_related()))
+            self.assertEqual(u'comment 0 created by test_admin -'\
+                    ' Administrator', unicode(WorkflowHistory.objects.filter(
+                        note='comment 0').with_history_related()[0]))
+            qs = Participant.objects.with_roles()
+            self.assertEqual(3, self._count_queries(lambda: render(qs)))
+            # activities with their participants and current state
+            qs = WorkflowActivity.objects.with_participants(
+                    ).with_current_state()
+            start_state = State.objects.get(id=1)
+            def check():
+                for wa in qs:
+                    self.assertEqual(1, len(wa.get_participants()))
+                    self.assertEqual([r], wa.get_participants()[0].get_roles())
+                    self.assertEqual(True, wa.current_state().note.startswith(
+                        'comment'))
+                    self.assertEqual(start_state, wa.current_state().state)
+            self.assertEqual(5, self._count_queries(check))
+            # out of date once the activity moves on
+            wa = WorkflowActivity.objects.with_current_state().get(id=wa.id)
+            wa.progress(Transition.objects.get(id=1), u)
+            self.assertEqual(State.objects.get(id=2), wa.current_state().state)
+            # the graph of the workflow
+            qs = Workflow.objects.with_graph().filter(id=1)
+            self.assertEqual(9, self._count_queries(lambda: [x.get_graph() for
+                x in qs]))
+            graph = Workflow.objects.with_graph().get(id=1).get_graph()
+            self.assertEqual(set(w.states.values_list('id', flat=True)),
+                    set(graph.states.keys()))
+            wa = WorkflowActivity.objects.with_graph().get(id=wa.id)
+            self.assertEqual(graph.transitions.keys(),
+                    wa.workflow.get_graph().transitions.keys())
+
+        def test_annotate_current_state(self):
+            """
+            Makes sure activities are annotated with their current state and
+            can be filtered and ordered by it in the query
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            r = Role.objects.get(id=1)
+            activities = []
+            for i in range(3):
+                wa = WorkflowActivity(workflow=w, created_by=u)
+                wa.save()
+                p = Participant(user=u, workflowactivity=wa)
+                p.save()
+                p.roles.add(r)
+                activities.append(wa)
+            wa1, wa2, wa3 = activities
+            wa1.start(u)
+            wa2.start(u)
+            wh = wa2.progress(Transition.objects.get(id=1), u)
+            # comments don't change the current state
+            wa2.add_comment(u, 'a comment')
+            result = dict([(wa.id, wa) for wa in
+                WorkflowActivity.objects.annotate_current_state()])
+            self.assertEqual((1, u'Start State'), (
+                result[wa1.id].current_state_id,
+                result[wa1.id].current_state_name))
+            self.assertEqual((2, u'State2', wh.deadline, wh.created_on), (
+                result[wa2.id].current_state_id,
+                result[wa2.id].current_state_name,
+                result[wa2.id].current_deadline,
+                result[wa2.id].current_state_since))
+            self.assertEqual(True, isinstance(result[wa2.id].current_deadline,
+                datetime.datetime))
+            self.assertEqual((None, None, None, None), (
+                result[wa3.id].current_state_id,
+                result[wa3.id].current_state_name,
+                result[wa3.id].current_deadline,
+                result[wa3.id].current_state_since))
+            # filtering and ordering
+            self.assertEqual([wa2.id], [wa.id for wa in
+                WorkflowActivity.objects.in_current_state(State.objects.get(
+                    id=2))])
+            self.assertEqual([wa1.id, wa2.id], [wa.id for wa in
+                WorkflowActivity.objects.in_current_state(1, 2
+                    ).annotate_current_state().order_by('current_state_id')])
+            self.assertEqual([], list(
+                WorkflowActivity.objects.in_current_state()))
+
+        def test_workflow_versions(self):
+            """
+            Makes sure a version of a workflow shares the states, transitions
+            and events it doesn't change and stores only those it does
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            r = Role.objects.get(id=1)
+            w.activate()
+            counts = (State.objects.count(), Transition.objects.count(),
+                    Event.objects.count())
+            v = w.new_version(u)
+            self.assertEqual(Workflow.DEFINITION, v.status)
+            self.assertEqual([v.id, w.id], v.lineage())
+            self.assertEqual(counts, (State.objects.count(),
+                Transition.objects.count(), Event.objects.count()))
+            self.assertEqual(list(w.states.all().order_by('id')),
+                    list(v.effective_states().order_by('id')))
+            self.assertEqual(w.get_fingerprint(), v.get_fingerprint())
+            # Overriding a state copies it along with the transitions and
+            # events referencing it
+            s2 = State.objects.get(id=2)
+            copy = v.override(s2)
+            copy.name = 'Changed'
+            copy.save()
+            self.assertEqual(copy, v.override(copy))
+            self.assertEqual((counts[0] + 1, counts[1] + 3, counts[2] + 1), (
+                State.objects.count(), Transition.objects.count(),
+                Event.objects.count()))
+            self.assertEqual(w.states.count(), v.effective_states().count())
+            self.assertEqual(w.transitions.count(),
+                    v.effective_transitions().count())
+            self.assertEqual(False, s2 in v.effective_states())
+            t1 = v.effective_transitions().get(from_state=1)
+            self.assertEqual((v.id, copy), (t1.workflow_id, t1.to_state))
+            self.assertEqual([copy.id], [e.state_id for e in
+                v.effective_events().filter(workflow=v)])
+            self.assertEqual(w.events.count(), v.effective_events().count())
+            self.assertNotEqual(w.get_fingerprint(), v.get_fingerprint())
+            graph = v.get_graph()
+            self.assertEqual('Changed', graph.states[copy.id].name)
+            self.assertEqual(False, s2.id in graph.states)
+            # The source workflow is untouched
+            self.assertEqual('State2', w.get_graph().states[2].name)
+            # Removing a shared transition hides it
+            v.remove(Transition.objects.get(id=7))
+            self.assertEqual(False, 7 in v.get_graph().transitions)
+            self.assertEqual(True, 7 in w.get_graph().transitions)
+            self.assertEqual(True, v.is_valid())
+            v.activate()
+            # Only active workflows in definition can be changed
+            try:
+                v.override(State.objects.get(id=3))
+            except UnableToEditWorkflow, instance:
+                self.assertEqual(u'Only workflows in definition may be'\
+                        ' changed', instance.args[0])
+            else:
+                self.fail('Exception expected but not thrown')
+            # Activities use the version's definition
+            wa = WorkflowActivity(workflow=v, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(r)
+            wa.start(u)
+            self.assertEqual(State.objects.get(id=1), wa.current_state().state)
+            self.assertEqual([t1], wa.available_transitions(u))
+            try:
+                wa.progress(Transition.objects.get(id=1), u)
+            except UnableToProgressWorkflow, instance:
+                self.assertEqual(u'Transition not valid (not part of this'\
+                        ' version of the workflow)', instance.args[0])
+            else:
+                self.fail('Exception expected but not thrown')
+            wa.progress(t1, u)
+            self.assertEqual(copy, wa.current_state().state)
+            # the copied event is mandatory
+            self.assertEqual([], wa.available_transitions(u))
+            wa.log_event(v.effective_events().get(workflow=v), u)
+            self.assertEqual(1, len(wa.available_transitions(u)))
+            # A version of a version shares with both
+            v2 = v.new_version(u)
+            self.assertEqual([v2.id, v.id, w.id], v2.lineage())
+            self.assertEqual(list(v.effective_states().order_by('id')),
+                    list(v2.effective_states().order_by('id')))
+            self.assertEqual(v.get_fingerprint(), v2.get_fingerprint())
+            # Clones copy the definition of the version
+            clone = v.clone(u)
+            self.assertEqual(None, clone.base)
+            self.assertEqual(v.get_fingerprint(), clone.get_fingerprint())
+            self.assertEqual(True, clone.is_valid())
+
+        def test_role_changes(self):
+            """
+            Makes sure changes to roles are recorded as RoleChanges and that
+            who held a role when can be found from them
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            other = User.objects.create_user('role_changes', 'a@b.com')
+            admin, manager, staff = Role.objects.get(id=1),\
+                    Role.objects.get(id=2), Role.objects.get(id=3)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(admin)
+            wa.start(u)
+            wa.assign_role(u, other, manager)
+            wa.assign_role(u, other, staff)
+            wa.remove_role(u, other, manager)
+            # Nothing to remove so nothing recorded
+            wa.remove_role(u, other, manager)
+            wa.disable_participant(u, other, 'on leave')
+            wa.enable_participant(u, other, 'back')
+            with batch():
+                wa.assign_role(u, other, manager)
+                wa.clear_roles(u, other)
+            p_other = Participant.objects.get(user=other, workflowactivity=wa)
+            changes = list(RoleChange.objects.filter(workflowactivity=wa
+                ).order_by('id'))
+            self.assertEqual([(RoleChange.ASSIGNED, manager),
+                (RoleChange.ASSIGNED, staff), (RoleChange.REMOVED, manager),
+                (RoleChange.DISABLED, None), (RoleChange.ENABLED, None),
+                (RoleChange.ASSIGNED, manager), (RoleChange.CLEARED, staff),
+                (RoleChange.CLEARED, manager)], [(c.action, c.role) for c in
+                    changes])
+            for c in changes:
+                self.assertEqual(p_other, c.participant)
+                self.assertEqual(other, c.user)
+                self.assertEqual(p, c.changed_by)
+            # Spread the changes out a day apart
+            start = datetime.datetime(2009, 1, 1)
+            for i, c in enumerate(changes):
+                RoleChange.objects.filter(id=c.id).update(created_on=start +
+                        datetime.timedelta(days=i))
+            day = lambda i: start + datetime.timedelta(days=i, hours=1)
+            self.assertEqual([], list(RoleChange.objects.holders(manager,
+                start - datetime.timedelta(days=1))))
+            self.assertEqual([other], list(RoleChange.objects.holders(manager,
+                day(0))))
+            self.assertEqual([other], list(RoleChange.objects.holders(staff,
+                day(2), activity=wa)))
+            self.assertEqual([], list(RoleChange.objects.holders(manager,
+                day(2))))
+            self.assertEqual([other], list(RoleChange.objects.holders(manager,
+                day(5))))
+            self.assertEqual([], list(RoleChange.objects.holders(staff)))
+            self.assertEqual([], list(RoleChange.objects.held()))
+            self.assertEqual(set([manager.id, staff.id]), set(
+                RoleChange.objects.held(when=day(1)).values_list('role',
+                    flat=True)))
+            self.assertEqual([(p_other.id, manager.id, start, start +
+                datetime.timedelta(days=2)), (p_other.id, staff.id, start +
+                    datetime.timedelta(days=1), start +
+                    datetime.timedelta(days=6)), (p_other.id, manager.id,
+                        start + datetime.timedelta(days=5), start +
+                        datetime.timedelta(days=7))],
+                    RoleChange.objects.intervals(user=other))
+            self.assertEqual([(p_other.id, staff.id, start +
+                datetime.timedelta(days=1), start +
+                datetime.timedelta(days=6))], RoleChange.objects.intervals(
+                    role=staff, workflowactivity=wa))
+
+        def test_engine_joins_callers_transaction(self):
+            """
+            Makes sure the engine methods neither commit nor roll back a
+            transaction managed by the caller
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            calls = []
+            old_commit, old_rollback = transaction.commit, transaction.rollback
+            transaction.commit = lambda: calls.append('commit')
+            transaction.rollback = lambda: calls.append('rollback')
+            try:
+                self.assertEqual(True, transaction.is_managed())
+                wa.start(u)
+                wa.add_comment(u, 'a comment')
+                wa.assign_role(u, u, Role.objects.get(id=2))
+                try:
+                    wa.progress(Transition.objects.get(id=2), u)
+                except UnableToProgressWorkflow:
+                    pass
+                else:
+                    self.fail('Exception expected but not thrown')
+                wa.progress(Transition.objects.get(id=1), u)
+                wa.force_stop(u, 'test')
+            finally:
+                transaction.commit, transaction.rollback = old_commit,\
+                        old_rollback
+            self.assertEqual([], calls)
+
+        def test_shared_event_on_version(self):
+            """
+            Makes sure activities of a version can log the events it shares
+            with the workflow it is based on but not those it has removed
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            w.activate()
+            v = w.new_version(u)
+            v.activate()
+            e1 = Event.objects.get(id=1)
+            self.assertEqual(w.id, e1.workflow_id)
+            self.assertEqual(True, e1 in v.effective_events())
+            wa = WorkflowActivity(workflow=v, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(u)
+            wa.progress(Transition.objects.get(id=1), u)
+            wh = wa.log_event(e1, u)
+            self.assertEqual(e1, wh.event)
+            # the shared mandatory event was logged so the activity can move on
+            wa.progress(Transition.objects.get(id=2), u)
+            self.assertEqual(3, wa.current_state().state_id)
+            # A version that removes the event can't log it
+            v2 = v.new_version(u)
+            v2.remove(e1)
+            v2.activate()
+            wa2 = WorkflowActivity(workflow=v2, created_by=u)
+            wa2.save()
+            p2 = Participant(user=u, workflowactivity=wa2)
+            p2.save()
+            p2.roles.add(Role.objects.get(id=1))
+            wa2.start(u)
+            wa2.progress(Transition.objects.get(id=1), u)
+            try:
+                wa2.log_event(e1, u)
+            except UnableToLogWorkflowEvent, instance:
+                self.assertEqual(u'The event is not associated with the'\
+                        ' workflow for the WorkflowActivity',
+                        instance.args[0])
+            else:
+                self.fail('Exception expected but not thrown')
+
+        def test_override_deadline_transition(self):
+            """
+            Makes sure overriding a state or its deadline transition in a
+            version keeps the deadline transition out of the state
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            s1 = State.objects.get(id=1)
+            s1.deadline_transition = Transition.objects.get(id=1)
+            s1.save()
+            w.activate()
+            v = w.new_version(u)
+            copy = v.override(s1)
+            self.assertNotEqual(1, copy.deadline_transition_id)
+            self.assertEqual((v.id, copy.id), (
+                copy.deadline_transition.workflow_id,
+                copy.deadline_transition.from_state_id))
+            self.assertEqual(True, v.is_valid())
+            v.activate()
+            v2 = v.new_version(u)
+            t = v2.override(copy.deadline_transition)
+            s = v2.effective_states().get(is_start_state=True)
+            self.assertEqual((t.id, s.id), (s.deadline_transition_id,
+                Transition.objects.get(id=t.id).from_state_id))
+            self.assertEqual(True, v2.is_valid())
+
+class ModelTransactionTestCase(TransactionTestCase):
+        """
+        Testing the transactions of the engine methods when the caller doesn't
+        manage one
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def test_progress_is_atomic(self):
+            """
+            Makes sure nothing written by progress() is committed if adjusting
+            the counts fails
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(u)
+            transaction.commit_unless_managed()
+            self.assertEqual(False, transaction.is_managed())
+            def adjust(workflow_id, deltas):
+                raise ValueError('counts')
+            StateActivityCount.objects.adjust = adjust
+            try:
+                self.assertRaises(ValueError, wa.progress,
+                        Transition.objects.get(id=1), u)
+            finally:
+                del StateActivityCount.objects.adjust
+            self.assertEqual([WorkflowHistory.TRANSITION], [wh.log_type for wh
+                in WorkflowHistory.objects.filter(workflowactivity=wa)])
+            self.assertEqual(State.objects.get(id=1),
+                    WorkflowActivity.objects.get(id=wa.id).current_state(
+                        ).state)
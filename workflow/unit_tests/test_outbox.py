@@ -0,0 +1,133 @@
+# -*- coding: UTF-8 -*-
+"""
+Outbox tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import datetime
+
+# django
+from django.conf import settings
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow import outbox
+
+class OutboxTestCase(TestCase):
+        """
+        Testing the outbox
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            settings.WORKFLOW_OUTBOX = True
+            self.handler = outbox.InProcessHandler()
+            for kind in ('transitioned', 'ended'):
+                outbox.register(kind, self.handler)
+            self.user = User.objects.get(id=1)
+            self.activities = []
+            for i in range(2):
+                wa = WorkflowActivity(workflow=Workflow.objects.get(id=1),
+                        created_by=self.user)
+                wa.save()
+                p = Participant(user=self.user, workflowactivity=wa)
+                p.save()
+                p.roles.add(Role.objects.get(id=1))
+                self.activities.append(wa)
+
+        def tearDown(self):
+            del settings.WORKFLOW_OUTBOX
+            for kind in ('transitioned', 'ended'):
+                outbox.unregister(kind, self.handler)
+
+        def _make_available(self):
+            OutboxMessage.objects.all().update(
+                    available_on=datetime.datetime.now())
+
+        def test_messages_written(self):
+            """
+            Makes sure a message is written for each signal sent about a new
+            WorkflowHistory record (in or out of a batch)
+            """
+            wa1, wa2 = self.activities
+            wa1.start(self.user)
+            wa1.add_comment(self.user, 'test')
+            with batch():
+                wa2.start(self.user)
+                wa2.assign_role(self.user, User.objects.get(id=2),
+                        Role.objects.get(id=2))
+                self.assertEqual(0, wa2.outbox.all().count())
+            self.assertEqual(['transitioned', 'started', 'commented',
+                'started'], [m.kind for m in wa1.outbox.all()])
+            self.assertEqual(['transitioned', 'started', 'started',
+                'role_assigned'], [m.kind for m in wa2.outbox.all()])
+            data = wa2.outbox.all()[0].data()
+            self.assertEqual(wa2.id, data['workflowactivity'])
+            self.assertEqual(1, data['state'])
+            self.assertEqual(WorkflowHistory.TRANSITION, data['log_type'])
+            self.assertEqual(u'Started workflow', data['note'])
+            self.assertNotEqual(None, data['created_on'])
+            # Nothing is written unless the outbox is switched on
+            settings.WORKFLOW_OUTBOX = False
+            wa1.add_comment(self.user, 'test')
+            self.assertEqual(4, wa1.outbox.all().count())
+
+        def test_deliver_pending(self):
+            """
+            Makes sure messages are delivered in order for each activity and
+            that failed deliveries are retried
+            """
+            wa1, wa2 = self.activities
+            for wa in self.activities:
+                wa.start(self.user)
+                wa.progress(Transition.objects.get(id=1), self.user)
+            # Messages without handlers are simply marked as delivered
+            self.assertEqual((6, 0), outbox.deliver_pending())
+            self.assertEqual(0, OutboxMessage.objects.filter(
+                delivered_on__isnull=True).count())
+            self.assertEqual([(wa1.id, 1), (wa2.id, 1), (wa1.id, 2),
+                (wa2.id, 2)], [(m.workflowactivity_id, m.data()['state']) for m
+                    in self.handler.messages])
+            # A failure holds up later messages for the same activity only
+            self.handler.messages = []
+            self.handler.fail = 1
+            wa1.log_event(Event.objects.get(id=1), self.user)
+            wa1.progress(Transition.objects.get(id=2), self.user)
+            wa1.progress(Transition.objects.get(id=3), self.user)
+            wa2.add_comment(self.user, 'test')
+            self.assertEqual((2, 1), outbox.deliver_pending())
+            self.assertEqual([], self.handler.messages)
+            self.assertEqual(0, wa2.outbox.filter(
+                delivered_on__isnull=True).count())
+            failed = OutboxMessage.objects.get(workflowactivity=wa1,
+                    kind='transitioned', delivered_on__isnull=True,
+                    attempts=1)
+            self.assertEqual(True, 'Delivery failed' in failed.last_error)
+            self.assertEqual(True, failed.available_on >
+                    datetime.datetime.now())
+            # Once the backoff has passed the messages are delivered in order
+            self._make_available()
+            self.assertEqual((2, 0), outbox.deliver_pending())
+            self.assertEqual([(wa1.id, 3), (wa1.id, 4)],
+                    [(m.workflowactivity_id, m.data()['state']) for m in
+                        self.handler.messages])
+
+        def test_claim(self):
+            """
+            Makes sure messages claimed by another worker are skipped until
+            the lease expires
+            """
+            wa1, wa2 = self.activities
+            wa1.start(self.user)
+            wa2.start(self.user)
+            claimed = outbox.claim()
+            self.assertEqual([wa1.id, wa2.id], [m.workflowactivity_id for m in
+                claimed])
+            self.assertEqual([], outbox.claim())
+            self._make_available()
+            self.assertEqual(2, len(outbox.claim(limit=5)))
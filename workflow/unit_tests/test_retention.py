@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+History retention tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import datetime
+
+# django
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.retention import *
+
+class RetentionTestCase(TestCase):
+        """
+        Testing the pruning of old WorkflowHistory records
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            self.workflow = Workflow.objects.get(id=1)
+            self.workflow.activate()
+            self.user = User.objects.get(id=1)
+            self.now = datetime.datetime.now()
+
+        def _activity(self):
+            wa = WorkflowActivity(workflow=self.workflow, created_by=self.user)
+            wa.save()
+            p = Participant(user=self.user, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(self.user)
+            return wa
+
+        def _age(self, days):
+            WorkflowHistory.objects.all().update(created_on=self.now -
+                    datetime.timedelta(days=days))
+
+        def test_prune_history(self):
+            """
+            Makes sure old records are deleted without touching the records
+            activities depend on
+            """
+            wa1 = self._activity()
+            old_comment = wa1.add_comment(self.user, 'old')
+            role = wa1.assign_role(self.user, self.user, Role.objects.get(
+                id=2))
+            wa1.progress(Transition.objects.get(id=1), self.user)
+            # after the latest transition
+            event = wa1.log_event(Event.objects.get(id=1), self.user)
+            latest = wa1.add_comment(self.user, 'latest')
+            wa2 = self._activity()
+            escalated = wa2.add_comment(self.user, 'escalated')
+            DeadlineEscalation(workflowhistory=escalated).save()
+            wa2.progress(Transition.objects.get(id=1), self.user)
+            self._age(100)
+            current = wa1.current_state()
+            before = WorkflowHistory.objects.count()
+            policy = {'comment': 30, 'role': 30, 'event': 30}
+            # Nothing is old enough
+            self.assertEqual({WorkflowHistory.COMMENT: [0, 0],
+                WorkflowHistory.ROLE: [0, 0], WorkflowHistory.EVENT: [0, 0]},
+                prune_history({'comment': 365, 'role': 365, 'event': 365},
+                    now=self.now))
+            reclaimed = prune_history(policy, now=self.now, dry_run=True)
+            self.assertEqual(before, WorkflowHistory.objects.count())
+            self.assertEqual([1, ROW_BYTES + 3],
+                    reclaimed[WorkflowHistory.COMMENT])
+            self.assertEqual(1, reclaimed[WorkflowHistory.ROLE][0])
+            self.assertEqual(0, reclaimed[WorkflowHistory.EVENT][0])
+            self.assertEqual(reclaimed, prune_history(policy, batch_size=1,
+                now=self.now))
+            self.assertEqual(before - 2, WorkflowHistory.objects.count())
+            for wh in (old_comment, role):
+                self.assertEqual(0, WorkflowHistory.objects.filter(
+                    id=wh.id).count())
+            for wh in (event, latest, escalated):
+                self.assertEqual(1, WorkflowHistory.objects.filter(
+                    id=wh.id).count())
+            self.assertEqual(4, WorkflowHistory.objects.filter(
+                log_type=WorkflowHistory.TRANSITION).count())
+            self.assertEqual(current, wa1.current_state())
+            # Already pruned
+            self.assertEqual([0, 0], prune_history(policy, now=self.now)[
+                WorkflowHistory.COMMENT])
+
+        def test_invalid_policy(self):
+            """
+            Makes sure TRANSITION records can't be pruned and ages must be
+            positive
+            """
+            for policy in ({'transition': 30}, {'comment': 0},
+                    {'comment': 'never'}):
+                try:
+                    prune_history(policy)
+                except InvalidRetentionPolicy:
+                    pass
+                else:
+                    self.fail('Exception expected but not thrown')
+            self.assertEqual({}, prune_history({}))
+
+        def test_prune_history_loop(self):
+            """
+            Makes sure the record of a mandatory event logged on an earlier
+            visit to a state isn't pruned so the activity can still leave the
+            state when it loops back into it
+            """
+            wa = self._activity()
+            wa.progress(Transition.objects.get(id=1), self.user)
+            mandatory = wa.log_event(Event.objects.get(id=1), self.user)
+            wa.progress(Transition.objects.get(id=2), self.user)
+            optional = wa.log_event(Event.objects.get(id=2), self.user)
+            wa.progress(Transition.objects.get(id=3), self.user)
+            # Back to state 2
+            wa.progress(Transition.objects.get(id=5), self.user)
+            # Aged in the order they were written
+            for i, pk in enumerate(wa.history.order_by('id').values_list('id',
+                    flat=True)):
+                WorkflowHistory.objects.filter(id=pk).update(
+                        created_on=self.now - datetime.timedelta(days=100,
+                            seconds=-i))
+            reclaimed = prune_history({'event': 30}, now=self.now)
+            self.assertEqual([1, ROW_BYTES + len(optional.note)],
+                    reclaimed[WorkflowHistory.EVENT])
+            self.assertEqual(0, WorkflowHistory.objects.filter(
+                id=optional.id).count())
+            self.assertEqual(1, WorkflowHistory.objects.filter(
+                id=mandatory.id).count())
+            wa.progress(Transition.objects.get(id=2), self.user)
+            self.assertEqual(3, wa.current_state().state_id)
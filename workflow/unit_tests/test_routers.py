@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+"""
+Database router tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# django
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+
+# project
+from workflow.models import *
+from workflow.routers import *
+from workflow.middleware import PrimaryStickinessMiddleware
+
+class RouterTestCase(TestCase):
+        """
+        Testing the database routers
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            unpin()
+
+        def tearDown(self):
+            unpin()
+
+        def test_replica_router(self):
+            """
+            Makes sure reads go to the replica until a write is made
+            """
+            router = ReplicaRouter()
+            self.assertEqual('replica', router.db_for_read(WorkflowHistory))
+            self.assertEqual('replica', router.db_for_read(State))
+            # Other applications are left alone
+            self.assertEqual(None, router.db_for_read(User))
+            self.assertEqual(None, router.db_for_write(User))
+            self.assertEqual('replica', router.db_for_read(WorkflowHistory))
+            # Reads stick to the primary after a write
+            self.assertEqual('default', router.db_for_write(WorkflowHistory))
+            self.assertEqual('default', router.db_for_read(WorkflowHistory))
+            self.assertEqual('default', router.db_for_read(State))
+            # Until the end of the request
+            middleware = PrimaryStickinessMiddleware()
+            response = HttpResponse()
+            self.assertEqual(response, middleware.process_response(None,
+                response))
+            self.assertEqual('replica', router.db_for_read(WorkflowHistory))
+            self.assertEqual(True, router.allow_syncdb('default', State))
+            self.assertEqual(False, router.allow_syncdb('replica', State))
+            self.assertEqual(None, router.allow_syncdb('replica', User))
+
+        def test_engine_pins_to_primary(self):
+            """
+            Makes sure writes made with raw SQL by the engine also pin reads
+            to the primary
+            """
+            w = Workflow.objects.get(id=1)
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            unpin()
+            with batch():
+                wa.start(u)
+                self.assertEqual(False, is_pinned())
+            self.assertEqual(True, is_pinned())
@@ -0,0 +1,174 @@
+# -*- coding: UTF-8 -*-
+"""
+Deadline scheduler tests for Workflow 
+
+Author: Nicholas H.Tollervey
+
+"""
+# python
+import datetime
+
+# django
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+# project
+from workflow.models import *
+from workflow.scheduler import DeadlineScheduler
+
+class SchedulerTestCase(TestCase):
+        """
+        Testing the deadline scheduler
+        """
+        # Reference fixtures here
+        fixtures = ['workflow_test_data']
+
+        def setUp(self):
+            self.user = User.objects.get(id=1)
+            # The start state has a deadline of a day, the second a week
+            s1 = State.objects.get(id=1)
+            s1.deadline_action = State.DEADLINE_TRANSITION
+            s1.deadline_transition = Transition.objects.get(id=1)
+            s1.deadline_note = 'Timed out'
+            s1.save()
+            s2 = State.objects.get(id=2)
+            s2.deadline_action = State.DEADLINE_COMMENT
+            s2.save()
+            self.clock = datetime.datetime.now()
+            self.passed = []
+            workflow_deadline_passed.connect(self.on_deadline_passed)
+
+        def tearDown(self):
+            workflow_deadline_passed.disconnect(self.on_deadline_passed)
+
+        def on_deadline_passed(self, sender, **kwargs):
+            self.passed.append(sender)
+
+        def _scheduler(self):
+            return DeadlineScheduler(horizon=datetime.timedelta(days=2),
+                    now=lambda: self.clock)
+
+        def _activity(self):
+            wa = WorkflowActivity(workflow=Workflow.objects.get(id=1),
+                    created_by=self.user)
+            wa.save()
+            p = Participant(user=self.user, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(self.user)
+            return wa
+
+        def test_scheduler(self):
+            """
+            Makes sure deadline actions are carried out once as deadlines pass
+            """
+            wa1 = self._activity()
+            wa2 = self._activity()
+            wa2.progress(Transition.objects.get(id=1), self.user)
+            wa3 = self._activity()
+            wa3.force_stop(self.user, 'test')
+            scheduler = self._scheduler()
+            scheduler.start()
+            # Only the deadlines of open activities within the horizon are
+            # loaded
+            self.assertEqual(set([wa1.history.all()[0].id,
+                wa2.history.all()[1].id]), scheduler.queued)
+            self.assertEqual(0, scheduler.run_once())
+            # The start state's deadline passes
+            self.clock += datetime.timedelta(days=1, minutes=1)
+            self.assertEqual(1, scheduler.run_once())
+            wh = wa1.current_state()
+            self.assertEqual(State.objects.get(id=2), wh.state)
+            self.assertEqual(u'Timed out', wh.note)
+            self.assertEqual(1, len(self.passed))
+            # wa2 moved on before its deadline so nothing happened
+            self.assertEqual(2, wa2.history.all().count())
+            # The second state's deadline passes
+            self.clock += datetime.timedelta(days=7)
+            self.assertEqual(2, scheduler.run_once())
+            for wa in (wa1, wa2):
+                wh = wa.current_state()
+                self.assertEqual(WorkflowHistory.COMMENT, wh.log_type)
+                self.assertEqual(u'Deadline passed', wh.note)
+                self.assertEqual(State.objects.get(id=2), wh.state)
+            self.assertEqual(3, len(self.passed))
+            self.assertEqual(0, scheduler.run_once())
+
+        def test_scheduler_restart(self):
+            """
+            Makes sure a restarted scheduler deals with deadlines that passed
+            whilst it wasn't running but not with those already dealt with
+            """
+            wa1 = self._activity()
+            scheduler = self._scheduler()
+            scheduler.start()
+            self.assertEqual(0, scheduler.run_once())
+            wa2 = self._activity()
+            self.clock += datetime.timedelta(days=1, minutes=1)
+            scheduler = self._scheduler()
+            scheduler.start()
+            self.assertEqual(2, scheduler.run_once())
+            self.assertEqual(2, DeadlineEscalation.objects.all().count())
+            # A deadline is only dealt with once
+            self.assertEqual(False, scheduler.fire(wa1.history.all()[1].id))
+            scheduler = self._scheduler()
+            scheduler.start()
+            self.assertEqual(0, scheduler.run_once())
+
+        def test_refused_deadline_action(self):
+            """
+            Makes sure a deadline action the engine refuses is skipped rather
+            than stopping the scheduler
+            """
+            # Saved before deadline transitions were checked
+            State.objects.filter(id=1).update(
+                    deadline_transition=Transition.objects.get(id=2))
+            wa1 = self._activity()
+            wa2 = self._activity()
+            scheduler = self._scheduler()
+            scheduler.start()
+            self.clock += datetime.timedelta(days=1, minutes=1)
+            self.assertEqual(0, scheduler.run_once())
+            self.assertEqual(self.clock, SchedulerCheckpoint.objects.get(
+                name='default').position)
+            for wa in (wa1, wa2):
+                self.assertEqual(1, wa.current_state().state_id)
+                self.assertEqual(1, DeadlineEscalation.objects.filter(
+                    workflowhistory=wa.current_state()).count())
+            # Not tried again after a restart
+            scheduler = self._scheduler()
+            scheduler.start()
+            self.assertEqual(0, scheduler.run_once())
+
+        def test_late_commit(self):
+            """
+            Makes sure a record committed after a refresh that saw records with
+            higher pks is still picked up
+            """
+            wa1 = self._activity()
+            placeholder = wa1.add_comment(self.user, 'pk in use')
+            wa2 = self._activity()
+            wa3 = WorkflowActivity(workflow=Workflow.objects.get(id=1),
+                    created_by=self.user)
+            wa3.save()
+            p = Participant(user=self.user, workflowactivity=wa3)
+            p.save()
+            scheduler = self._scheduler()
+            scheduler.start()
+            self.assertEqual(0, scheduler.run_once())
+            # wa3 is started by a transaction that got its pk before wa2's
+            # records but is committed after the refresh
+            late_id = placeholder.id
+            placeholder.delete()
+            WorkflowHistory(id=late_id, workflowactivity=wa3,
+                    state=State.objects.get(id=1),
+                    log_type=WorkflowHistory.TRANSITION, participant=p,
+                    note='Started workflow',
+                    deadline=self.clock + datetime.timedelta(days=1)).save()
+            self.clock += datetime.timedelta(seconds=10)
+            self.assertEqual(0, scheduler.run_once())
+            self.assertEqual(True, late_id in scheduler.queued)
+            self.clock += datetime.timedelta(days=1, minutes=1)
+            self.assertEqual(3, scheduler.run_once())
+            self.assertEqual(State.objects.get(id=2),
+                    wa3.current_state().state)
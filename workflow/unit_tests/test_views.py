@@ -7,15 +7,24 @@ Author: Nicholas H.Tollervey
 """
 # python
 import datetime
+import shutil
+import tempfile
 
 # django
 from django.test.client import Client
 from django.test import TestCase
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
 
 # project
 from workflow.views import *
-from workflow.models import Workflow
+from workflow import diagrams
+from workflow.deferred import InlineExecutor, get_executor, set_executor
+from workflow.models import Workflow, State, Transition, Role,\
+        WorkflowActivity, Participant
+from django.contrib.auth.models import User
+from django.utils import simplejson
 
 class ViewTestCase(TestCase):
         """
@@ -58,6 +67,33 @@ class ViewTestCase(TestCase):
             self.assertContains(response, 'A definition for a diagram of the'\
                 ' workflow: test workflow')
 
+        def test_diff(self):
+            """
+            Makes sure a GET to the url results in the differences between a
+            clone and its source as JSON
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            clone = w.clone(User.objects.get(id=1))
+            State.objects.create(name='New state', workflow=clone)
+            c = Client()
+            response = c.get('/test_workflow_clone/diff/')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('application/json', response['Content-Type'])
+            result = simplejson.loads(response.content)
+            self.assertEqual([u'New state'], [s['name'] for s in
+                result['states']['added']])
+            response = c.get('/test_workflow_clone/diff/dotfile/')
+            self.assertContains(response, 'A diagram of the changes made to'\
+                ' the workflow: test workflow')
+            # Workflows that are not clones have nothing to compare against
+            try:
+                diff(None, 'test_workflow')
+            except Http404:
+                pass
+            else:
+                self.fail('Exception expected but not thrown')
+
         def test_graphviz(self):
             """
             Makes sure a GET to the url results in a .png file
@@ -84,3 +120,93 @@ class ViewTestCase(TestCase):
                         " graphviz's dot command)", instance.args[0])
             else:
                 self.fail('Exception expected but not thrown')
+
+        def test_prerendered_diagrams(self):
+            """
+            Makes sure activating a workflow stores its diagrams and that the
+            stored diagrams are what's served
+            """
+            old_storage, old_executor = diagrams.storage, get_executor()
+            location = tempfile.mkdtemp()
+            diagrams.storage = FileSystemStorage(location=location)
+            set_executor(InlineExecutor())
+            try:
+                w = Workflow.objects.get(id=1)
+                c = Client()
+                # in definition so rendered on demand and not stored
+                response = c.get('/test_workflow.svg')
+                self.assertEqual(200, response.status_code)
+                self.assertEqual('image/svg+xml', response['Content-Type'])
+                self.assertEqual(False, diagrams.storage.exists(
+                    diagrams.diagram_name(w.id, w.get_fingerprint(), 'svg')))
+                w.activate()
+                for format in diagrams.FORMATS:
+                    name = diagrams.diagram_name(w.id, w.get_fingerprint(),
+                            format)
+                    self.assertEqual(True, diagrams.storage.exists(name))
+                # make sure what's in storage is served
+                name = diagrams.diagram_name(w.id, w.get_fingerprint(), 'png')
+                diagrams.storage.delete(name)
+                diagrams.storage.save(name, diagrams.ContentFile('STORED'))
+                response = c.get('/test_workflow.png')
+                self.assertEqual('STORED', response.content)
+                # retiring doesn't render the stored diagrams again
+                w.retire()
+                response = c.get('/test_workflow.png')
+                self.assertEqual('STORED', response.content)
+                # missing diagrams are rendered and stored when asked for
+                name = diagrams.diagram_name(w.id, w.get_fingerprint(), 'dot')
+                diagrams.storage.delete(name)
+                response = c.get('/test_workflow/dotfile/')
+                self.assertEqual(get_dotfile(w), response.content)
+                self.assertEqual(True, diagrams.storage.exists(name))
+            finally:
+                diagrams.storage = old_storage
+                set_executor(old_executor)
+                shutil.rmtree(location)
+
+        def test_activity_graphviz(self):
+            """
+            Makes sure the diagram of an activity highlights its current state
+            and the transitions it has taken and is cached until it moves on
+            """
+            w = Workflow.objects.get(id=1)
+            w.activate()
+            u = User.objects.get(id=1)
+            wa = WorkflowActivity(workflow=w, created_by=u)
+            wa.save()
+            p = Participant(user=u, workflowactivity=wa)
+            p.save()
+            p.roles.add(Role.objects.get(id=1))
+            wa.start(u)
+            c = Client()
+            response = c.get('/activity/%d.dot' % wa.id)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('text/plain', response['Content-Type'])
+            self.assertEqual(True, response.content.find(
+                'state1 [ \n        shape=box, color=blue, fontcolor=white,'\
+                ' fillcolor=blue, style=filled') > -1)
+            self.assertEqual(True, response.content.find('(1)') == -1)
+            wa.progress(Transition.objects.get(id=1), u)
+            response = c.get('/activity/%d.dot' % wa.id)
+            # state 1 was visited, state 2 is current and transition 1 taken
+            self.assertEqual(True, response.content.find(
+                'state1 [ \n        shape=box, color=darkgreen') > -1)
+            self.assertEqual(True, response.content.find(
+                'color=blue, fontcolor=white, fillcolor=blue') > -1)
+            self.assertEqual(True, response.content.find(
+                'state1 -> state2 [label="Proceed to state 2 (1)",'\
+                ' color=darkgreen, fontcolor=darkgreen, penwidth=2]') > -1)
+            # cached against the latest history record
+            latest = wa.history.order_by('-id')[0]
+            key = 'workflow.diagrams.%s.%d.%d.%s' % (w.fingerprint, wa.id,
+                    latest.id, 'png')
+            self.assertEqual(None, cache.get(key))
+            response = c.get('/activity/%d.png' % wa.id)
+            self.assertEqual('image/png', response['Content-Type'])
+            self.assertEqual(response.content, cache.get(key))
+            cache.set(key, 'CACHED')
+            response = c.get('/activity/%d.png' % wa.id)
+            self.assertEqual('CACHED', response.content)
+            response = c.get('/activity/%d.svg' % wa.id)
+            self.assertEqual('image/svg+xml', response['Content-Type'])
@@ -5,4 +5,17 @@ urlpatterns = patterns('',
     url(r'^(?P<workflow_slug>\w+)/dotfile/$', 'workflow.views.dotfile', name='dotfile'),
     # get a png image generated by graphviz for the referenced workflow 
     url(r'^(?P<workflow_slug>\w+).png$', 'workflow.views.graphviz', name='graphviz'),
+    # get an svg image generated by graphviz for the referenced workflow
+    url(r'^(?P<workflow_slug>\w+).svg$', 'workflow.views.graphviz', {'format': 'svg'}, name='graphviz_svg'),
+    # get a png, svg or dotfile of the workflow showing the progress of the
+    # referenced activity
+    url(r'^activity/(?P<activity_id>\d+).png$', 'workflow.views.activity_graphviz', name='activity_graphviz'),
+    url(r'^activity/(?P<activity_id>\d+).svg$', 'workflow.views.activity_graphviz', {'format': 'svg'}, name='activity_graphviz_svg'),
+    url(r'^activity/(?P<activity_id>\d+).dot$', 'workflow.views.activity_graphviz', {'format': 'dot'}, name='activity_dotfile'),
+    # get the differences between the referenced workflow and the workflow it
+    # was cloned from as JSON
+    url(r'^(?P<workflow_slug>\w+)/diff/$', 'workflow.views.diff', name='diff'),
+    # get a dotfile highlighting the differences between the referenced workflow
+    # and the workflow it was cloned from
+    url(r'^(?P<workflow_slug>\w+)/diff/dotfile/$', 'workflow.views.diff_dotfile', name='diff_dotfile'),
 )
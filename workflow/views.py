@@ -1,30 +1,16 @@
 # -*- coding: UTF-8 -*-
 
-# Python
-import subprocess
-from os.path import join
-
 # django
-from django.template import Context, loader
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from django.conf import settings
+from django.utils import simplejson
 
 # Workflow app
-from workflow.models import Workflow
-
-###################
-# Utility functions
-###################
-
-def get_dotfile(workflow):
-    """
-    Given a workflow will return the appropriate contents of a .dot file for 
-    processing by graphviz
-    """
-    c = Context({'workflow': workflow})
-    t = loader.get_template('graphviz/workflow.dot')
-    return t.render(c)
+from workflow.models import Workflow, WorkflowActivity
+from workflow.diff import diff_workflows, get_diff_dotfile
+from workflow.diagrams import get_dotfile, get_diagram, get_activity_diagram,\
+        FORMATS
 
 ################
 # view functions
@@ -37,30 +23,59 @@ def dotfile(request, workflow_slug):
     w = get_object_or_404(Workflow, slug=workflow_slug)
     response = HttpResponse(mimetype='text/plain')
     response['Content-Disposition'] = 'attachment; filename=%s.dot'%w.name
-    response.write(get_dotfile(w))
+    response.write(get_diagram(w, 'dot'))
     return response
 
-def graphviz(request, workflow_slug):
+def graphviz(request, workflow_slug, format='png'):
     """
-    Returns a png representation of the workflow generated by graphviz given 
-    the workflow name (slug)
+    Returns a png (or svg) representation of the workflow generated by
+    graphviz given the workflow name (slug). Active and retired workflows
+    are served from storage (see workflow.diagrams).
 
     The following constant should be defined in settings.py:
 
     GRAPHVIZ_DOT_COMMAND - absolute path to graphviz's dot command used to
     generate the image
     """
-    if not hasattr(settings, 'GRAPHVIZ_DOT_COMMAND'):
-        # At least provide a helpful exception message
-        raise Exception("GRAPHVIZ_DOT_COMMAND constant not set in settings.py"\
-                " (to specify the absolute path to graphviz's dot command)")
     w = get_object_or_404(Workflow, slug=workflow_slug)
-    # Lots of "pipe" work to avoid hitting the file-system
-    proc = subprocess.Popen('%s -Tpng' % settings.GRAPHVIZ_DOT_COMMAND,
-                shell=True,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                )
-    response = HttpResponse(mimetype='image/png')
-    response.write(proc.communicate(get_dotfile(w).encode('utf_8'))[0])
+    response = HttpResponse(mimetype=FORMATS[format])
+    response.write(get_diagram(w, format))
+    return response
+
+def activity_graphviz(request, activity_id, format='png'):
+    """
+    Returns a png (or svg or dot file) representation of the workflow of the
+    referenced WorkflowActivity with its current state highlighted and the
+    transitions it has taken emphasised (see workflow.diagrams)
+    """
+    wa = get_object_or_404(WorkflowActivity.objects.select_related('workflow'),
+            id=activity_id)
+    response = HttpResponse(mimetype=FORMATS[format])
+    response.write(get_activity_diagram(wa, format))
+    return response
+
+def diff(request, workflow_slug):
+    """
+    Returns (as JSON) the differences between the workflow and the workflow it
+    was cloned from given the workflow name (slug)
+    """
+    w = get_object_or_404(Workflow, slug=workflow_slug)
+    if not w.cloned_from:
+        raise Http404
+    response = HttpResponse(mimetype='application/json')
+    response.write(simplejson.dumps(diff_workflows(w.cloned_from, w)))
+    return response
+
+def diff_dotfile(request, workflow_slug):
+    """
+    Returns the dot file for use with graphviz that highlights the differences
+    between the workflow and the workflow it was cloned from given the workflow
+    name (slug)
+    """
+    w = get_object_or_404(Workflow, slug=workflow_slug)
+    if not w.cloned_from:
+        raise Http404
+    response = HttpResponse(mimetype='text/plain')
+    response['Content-Disposition'] = 'attachment; filename=%s_diff.dot'%w.name
+    response.write(get_diff_dotfile(w.cloned_from, w))
     return response